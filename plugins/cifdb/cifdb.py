@@ -4,6 +4,7 @@ build American Mineralogist Crystal Structure Databse (amcsd)
 '''
 
 import os
+import hashlib
 import requests
 
 import numpy as np
@@ -85,6 +86,12 @@ QAXIS = np.arange(QMIN,QMAX+QSTEP,QSTEP)
 
 ENERGY = 19000 ## units eV
 
+## file for the q-index of a database: name of database + QINDEX_SUFFIX,
+## kept in QINDEX_DIR of the user larch folder
+QINDEX_SUFFIX = '_qindex.npz'
+QINDEX_DIR = 'cifdb'
+MAX_CACHED_QTOTALS = 16
+
 def make_engine(dbname):
     return create_engine('sqlite:///%s' % (dbname),
                          poolclass=SingletonThreadPool)
@@ -153,6 +160,132 @@ class CategoryTable(_BaseTable):
 # #      cif, zstr, qstr, url) = [None]*14
 
 
+class CifQIndex(object):
+    '''
+    inverted index of q peaks for the entries of a cif database
+
+    For each q bin of the database q axis, the index holds the entries
+    with a peak in that bin, so that searches only look at the bins
+    near observed peaks.  Bins can be merged to any larger step.
+
+    Attributes:
+    ------------
+    * self.axis        q axis of the database
+    * self.amcsd       amcsd id for each entry
+    * self.entry_ptr   entry i has peaks at bins entry_bins[entry_ptr[i]:entry_ptr[i+1]]
+    * self.bin_ptr     bin j has peaks of entries bin_entries[bin_ptr[j]:bin_ptr[j+1]]
+    '''
+    def __init__(self, axis, amcsd, entry_ptr, entry_bins, tag=''):
+
+        self.axis       = np.asarray(axis, dtype=np.float64)
+        self.amcsd      = np.asarray(amcsd, dtype=np.int64)
+        self.entry_ptr  = np.asarray(entry_ptr, dtype=np.int64)
+        self.entry_bins = np.asarray(entry_bins, dtype=np.int64)
+        self.tag        = tag
+
+        ## entry for each peak, and peaks sorted by bin
+        self.peak_entry  = np.repeat(np.arange(len(self.amcsd)), np.diff(self.entry_ptr))
+        order = np.argsort(self.entry_bins, kind='mergesort')
+        self.bin_entries = self.peak_entry[order]
+        self.bin_ptr     = np.searchsorted(self.entry_bins[order],
+                                           np.arange(len(self.axis)+1))
+        self._totals = {}
+
+    @classmethod
+    def from_qstr(cls, axis, amcsd, qstrs, tag=''):
+        '''builds index from amcsd ids and the 0/1 JSON q strings of entries'''
+        bins = [np.flatnonzero(np.array(json.loads(qstr)) == 1) for qstr in qstrs]
+        entry_ptr = np.concatenate(([0], np.cumsum([len(b) for b in bins])))
+        entry_bins = np.concatenate(bins) if len(bins) > 0 else np.zeros(0, dtype=int)
+        return cls(axis, amcsd, entry_ptr, entry_bins, tag=tag)
+
+    @classmethod
+    def load(cls, fname, tag=None):
+        '''reads index from .npz file; returns None if missing or tag does not match'''
+        if not os.path.exists(fname):
+            return None
+        try:
+            npz = np.load(fname, allow_pickle=False)
+        except (IOError, ValueError):
+            return None
+        with npz:
+            ftag = str(npz['tag'])
+            if tag is not None and ftag != tag:
+                return None
+            return cls(npz['axis'], npz['amcsd'], npz['entry_ptr'],
+                       npz['entry_bins'], tag=ftag)
+
+    def save(self, fname):
+        '''writes index to .npz file'''
+        with open(fname, 'wb') as fh:
+            np.savez(fh, tag=np.array(self.tag), axis=self.axis, amcsd=self.amcsd,
+                     entry_ptr=self.entry_ptr, entry_bins=self.entry_bins)
+
+    def bin_map(self, imin, imax, qstep=None):
+        '''
+        returns q axis for bins imin:imax of database axis, merged to
+        steps of qstep if larger than the database step, and index
+        of the merged bin for each database bin
+        '''
+        qaxis = self.axis[imin:imax]
+        stepq = (qaxis[1]-qaxis[0])
+        if qstep is None or qstep <= stepq:
+            return qaxis, np.arange(len(qaxis))
+        new_qaxis = np.arange(np.min(qaxis),np.max(qaxis)+stepq,qstep)
+        kmap = np.abs(new_qaxis[np.newaxis,:]-qaxis[:,np.newaxis]).argmin(axis=1)
+        return new_qaxis, kmap
+
+    def _entries_in_bins(self, imin, kmap, kbins):
+        '''entries and merged bins for peaks in merged bins kbins'''
+        fine = np.flatnonzero(np.isin(kmap, kbins))
+        lo, hi = self.bin_ptr[imin+fine], self.bin_ptr[imin+fine+1]
+        nper = hi - lo
+        idx = np.repeat(lo - np.cumsum(nper) + nper, nper) + np.arange(nper.sum())
+        return self.bin_entries[idx], np.repeat(kmap[fine], nper)
+
+    def total_peaks(self, imin, imax, qstep=None):
+        '''number of merged bins with peaks for every entry in bins imin:imax'''
+        key = (imin, imax, qstep)
+        if key not in self._totals:
+            if len(self._totals) >= MAX_CACHED_QTOTALS:
+                self._totals.clear()
+            qaxis, kmap = self.bin_map(imin, imax, qstep)
+            inrange = (self.entry_bins >= imin) & (self.entry_bins < imax)
+            pairs = np.unique(self.peak_entry[inrange]*len(qaxis) +
+                              kmap[self.entry_bins[inrange]-imin])
+            self._totals[key] = np.bincount(pairs//len(qaxis),
+                                            minlength=len(self.amcsd))
+        return self._totals[key]
+
+    def match_peaks(self, peaks, imin, imax, qstep=None, qtol=None):
+        '''
+        returns number of matched bins for every entry for observed peaks
+        in bins imin:imax.
+
+        Without qtol, an entry matches the merged bin nearest to each
+        peak.  With qtol, bins within qtol of a peak match with weight
+        1-|dq|/qtol, using the best matching bin of an entry for each peak.
+        '''
+        qaxis, kmap = self.bin_map(imin, imax, qstep)
+        nbins = len(qaxis)
+        match = np.zeros(len(self.amcsd))
+        if qtol is None:
+            kbins = np.unique([np.abs(qaxis-p).argmin() for p in peaks])
+            entries, kpk = self._entries_in_bins(imin, kmap, kbins)
+            pairs = np.unique(entries*nbins + kpk)
+            match += np.bincount(pairs//nbins, minlength=len(self.amcsd))
+            return match
+        for p in peaks:
+            weight = 1 - np.abs(qaxis-p)/qtol
+            kbins = np.flatnonzero(weight > 0)
+            if len(kbins) == 0:
+                continue
+            entries, kpk = self._entries_in_bins(imin, kmap, kbins)
+            best = np.zeros(len(self.amcsd))
+            np.maximum.at(best, entries, weight[kpk])
+            match += best
+        return match
+
 class cifDB(object):
     '''
     interface to the American Mineralogist Crystal Structure Database
@@ -249,6 +382,7 @@ class cifDB(object):
 
         self.load_database()
         self.axis = np.array([float(q[0]) for q in self.query(self.qtbl.c.q).all()])
+        self._qindex = None
 
 
     def query(self, *args, **kws):
@@ -592,6 +726,7 @@ class cifDB(object):
                         zstr=json.dumps(zarr.tolist(),default=str),
                         qstr=json.dumps(qarr.tolist(),default=str),
                         url=str(cifile))
+        self._qindex = None
 
         ## Build q cross-reference table
         for q in qhkl:
@@ -848,44 +983,88 @@ class cifDB(object):
 ##################################################################################
 ##################################################################################
 
-    def amcsd_by_q(self,peaks,qmin=QMIN,qmax=QMAX,qstep=QSTEP,list=None,verbose=False):
+    def qindex_file(self):
+        '''
+        returns name of the q-index file for the database, in the cifdb
+        folder of the user larch folder.
+        '''
+        dbname = os.path.abspath(self.dbname)
+        ## short hash of the full path, for databases with the same name
+        key = hashlib.md5(dbname.encode('utf-8')).hexdigest()[:8]
+        fname = '%s_%s%s' % (os.path.splitext(os.path.basename(dbname))[0],
+                             key, QINDEX_SUFFIX)
+        return os.path.join(larch.site_config.usr_larchdir, QINDEX_DIR, fname)
+
+    def get_qindex(self, rebuild=False, save=True):
+        '''
+        returns CifQIndex of q peaks for all entries, read from the index
+        file from qindex_file() if it is up to date, or built from the
+        database otherwise.  A newly built index is saved to that file if
+        save=True and the folder can be written, and is otherwise only
+        kept in memory.
+        '''
+        if self._qindex is not None and not rebuild:
+            return self._qindex
+
+        stat = os.stat(self.dbname)
+        tag = '%s %i %i' % (os.path.basename(self.dbname), stat.st_size, int(stat.st_mtime))
+        fname = self.qindex_file()
+        qindex = None
+        if not rebuild:
+            qindex = CifQIndex.load(fname, tag=tag)
+        if qindex is None or len(qindex.axis) != len(self.axis):
+            rows = self.query(self.ciftbl.c.amcsd_id,self.ciftbl.c.qstr).all()
+            qindex = CifQIndex.from_qstr(self.axis, [row[0] for row in rows],
+                                         [row[1] for row in rows], tag=tag)
+            if save:
+                try:
+                    if not os.path.exists(os.path.dirname(fname)):
+                        os.makedirs(os.path.dirname(fname))
+                    qindex.save(fname)
+                except (IOError, OSError):
+                    pass
+        self._qindex = qindex
+        return qindex
+
+    def amcsd_by_q(self,peaks,qmin=QMIN,qmax=QMAX,qstep=QSTEP,list=None,verbose=False,
+                   qtol=None):
+        '''
+        scores entries of database by matching their q peaks to observed peaks
+
+        peaks : list of observed q peaks
+        qmin  : minimum q for matching
+        qmax  : maximum q for matching
+        qstep : q step for binning peaks; larger than database step merges bins
+        list  : list of amcsd ids to search; default is all entries
+        qtol  : if not None, peaks match bins within qtol, weighted by distance
+
+        returns list of (score, amcsd id, total peaks, matched peaks, missed peaks),
+        sorted by score, where score is matched peaks - missed peaks.
+
+        Uses the q-index of the database from get_qindex().
+        '''
+        qindex = self.get_qindex()
 
         ## Defines min/max limits of q-range
         imin,imax = 0,len(self.axis)
         if qmax < np.max(self.axis): imax = abs(self.axis-qmax).argmin()
         if qmin > np.min(self.axis): imin = abs(self.axis-qmin).argmin()
-        qaxis = self.axis[imin:imax]
-        stepq = (qaxis[1]-qaxis[0])
-
-        amcsd,q_amcsd = self.return_q_matches(list=list,qmin=qmin,qmax=qmax)
-
-        ## Re-bins data if different step size is specified
-        if qstep > stepq:
-            new_qaxis   = np.arange(np.min(qaxis),np.max(qaxis)+stepq,qstep)
-            new_q_amcsd = np.zeros((np.shape(q_amcsd)[0],np.shape(new_qaxis)[0]))
-            for m,qrow in enumerate(q_amcsd):
-                for n,qn in enumerate(qrow):
-                    if qn == 1:
-                        k = np.abs(new_qaxis-qaxis[n]).argmin()
-                        new_q_amcsd[m][k] = 1
-            qaxis = new_qaxis
-            q_amcsd = new_q_amcsd
-        
-
-        ## Create data array
-        peaks_weighting = np.ones(len(qaxis),dtype=int)*-1
-        peaks_true = np.zeros(len(qaxis),dtype=int)
-        peaks_false = np.ones(len(qaxis),dtype=int)
-        for p in peaks:
-            i = np.abs(qaxis-p).argmin()
-            peaks_weighting[i],peaks_true[i],peaks_false[i] = 1,1,0
 
         ## Calculate score/matches/etc.
-        total_peaks = np.sum((q_amcsd),axis=1)
-        match_peaks = np.sum((peaks_true*q_amcsd),axis=1)
-        miss_peaks = np.sum((peaks_false*q_amcsd),axis=1)
-        scores = np.sum((peaks_weighting*q_amcsd),axis=1)
-        
+        total_peaks = qindex.total_peaks(imin, imax, qstep)
+        match_peaks = qindex.match_peaks(peaks, imin, imax, qstep, qtol=qtol)
+        if qtol is None:
+            match_peaks = match_peaks.astype(int)
+        miss_peaks = np.maximum(total_peaks - match_peaks, 0)
+        scores = match_peaks - miss_peaks
+
+        amcsd = qindex.amcsd
+        if list is not None:
+            use = np.isin(amcsd, np.array(list, dtype=np.int64))
+            amcsd,total_peaks = amcsd[use],total_peaks[use]
+            match_peaks,miss_peaks,scores = match_peaks[use],miss_peaks[use],scores[use]
+        amcsd = amcsd.tolist()
+
         return sorted(zip(scores,amcsd,total_peaks,match_peaks,miss_peaks),reverse=True)
 
 
@@ -7,11 +7,15 @@ Generic discrete convolution
 Description
 -----------
 
- This is a manual (not optimized!) implementation of discrete 1D
- convolution intended for spectroscopy analysis. The difference with
- commonly used methods is the possibility to adapt the convolution
- kernel for each convolution point, e.g. change the FWHM of the
- Gaussian kernel as a function of the energy scale.
+ This is an implementation of discrete 1D convolution intended for
+ spectroscopy analysis. The difference with commonly used methods is
+ the possibility to adapt the convolution kernel for each convolution
+ point, e.g. change the FWHM of the Gaussian kernel as a function of
+ the energy scale.
+
+ The kernels for all points are stored as a sparse, banded matrix,
+ which is cached so that repeated convolutions (as in a fit, or for
+ many spectra) need only a sparse matrix product.
 
 Resources
 ---------
@@ -49,8 +53,10 @@ from optparse import OptionParser
 from datetime import date
 from string import Template
 import numpy as np
+from scipy.sparse import csr_matrix
 
-from larch.utils import gaussian, lorentzian
+MAX_CACHED_KERNELS = 16
+_kernel_cache = {}
 
 def get_ene_index(ene, cen, hwhm):
     """ returns the min/max indexes for array ene at (cen-hwhm) and (cen+hwhm)
@@ -62,7 +68,7 @@ def get_ene_index(ene, cen, hwhm):
         else:
             ene_imin = max(np.where(ene < (cen-hwhm))[0])
         if ((cen+hwhm) >= max(ene)):
-            ene_imax = (len(e)-1)
+            ene_imax = (len(ene)-1)
         else:
             ene_imax = min(np.where(ene > (cen+hwhm))[0])
         return ene_imin, ene_imax
@@ -114,13 +120,90 @@ def atan_gamma(ene, gamma_hole, gamma_max=15., e0=0, eslope=1.):
         eslope = 1.
     return gamma_hole + gamma_max * ( ( np.arctan( (ene - e0) / eslope ) / np.pi ) + 0.5 )
 
+def conv_matrix(e, fwhm_e, kernel='gaussian'):
+    """ kernel matrix for energy-dependent convolution
+
+    Parameters
+    ----------
+    e : x-axis (energy), increasing
+    fwhm_e: array of size 'e' with the full width half maximum in
+            eV for the kernel at each energy
+    kernel : convolution kernel, 'gaussian' or 'lorentzian'
+
+    Returns
+    -------
+    kmat, wext_e, wext_1
+
+    kmat : sparse (len(e), len(e)) matrix of kernel weights
+    wext_e, wext_1 : arrays of sum(weight*energy) and sum(weight) for
+                     kernel points beyond the upper end of 'e', to be
+                     applied to the linear extrapolation of mu(energy)
+
+    Notes
+    -----
+    For each point, the kernel is sampled on an odd number of points
+    covering +/- 1.5*fwhm_e, and normalized to unit sum.  Results are
+    cached on (e, fwhm_e, kernel).
+    """
+    e = np.asarray(e, dtype='float64')
+    fwhm_e = np.asarray(fwhm_e, dtype='float64')
+    if ('gauss' in kernel.lower()):
+        kname = 'gaussian'
+    elif ('lor' in kernel.lower()):
+        kname = 'lorentzian'
+    else:
+        raise ValueError("convolution kernel '{0}' not implemented".format(kernel))
+
+    key = (kname, len(e), hash(e.tobytes()), hash(fwhm_e.tobytes()))
+    if key in _kernel_cache:
+        return _kernel_cache[key]
+
+    npts = len(e)
+    estep = (e[-1] - e[-2])
+    # extend upper energy border to 3*fhwm_e[-1]
+    eup = np.append(e, np.arange(e[-1]+estep, e[-1]+3*fwhm_e[-1], estep))
+
+    # kernel ranges, as from get_ene_index(eup, e, 1.5*fwhm_e)
+    hw = 1.5*fwhm_e
+    eimin = np.searchsorted(eup, e-hw, side='left') - 1
+    eimin[(e-hw) <= eup[0]] = 0
+    eimax = np.searchsorted(eup, e+hw, side='right')
+    eimax[(e+hw) >= eup[-1]] = len(eup) - 1
+    # odd number of kernel points, centered at the convolution point
+    lk = eimax - eimin + ((eimax - eimin + 1) % 2)
+
+    rows = np.repeat(np.arange(npts), lk)
+    offs = np.arange(lk.sum()) - np.repeat(np.cumsum(lk) - lk, lk)
+    dx = eup[np.repeat(eimin, lk) + offs] - e[rows]
+    hwhm = np.repeat(fwhm_e/2.0, lk)
+    if kname == 'gaussian':
+        ky = np.exp(-dx**2/(2*hwhm**2))
+    else:
+        ky = 1.0/(dx**2 + hwhm**2)
+    ky = ky / np.bincount(rows, weights=ky, minlength=npts)[rows]
+
+    cols = rows + offs - np.repeat(lk//2, lk)
+    inner = (cols >= 0) & (cols < npts)
+    kmat = csr_matrix((ky[inner], (rows[inner], cols[inner])),
+                      shape=(npts, npts))
+    upper = cols >= npts
+    eext = e[-1] + (cols[upper] - (npts-1))*estep
+    wext_e = np.bincount(rows[upper], weights=ky[upper]*eext, minlength=npts)
+    wext_1 = np.bincount(rows[upper], weights=ky[upper], minlength=npts)
+
+    if len(_kernel_cache) >= MAX_CACHED_KERNELS:
+        _kernel_cache.clear()
+    _kernel_cache[key] = (kmat, wext_e, wext_1)
+    return kmat, wext_e, wext_1
+
 def conv(e, mu, kernel='gaussian', fwhm_e=None, efermi=None):
     """ linear broadening
 
     Parameters
     ----------
     e : x-axis (energy)
-    mu : f(x) to convolve with g(x) kernel, mu(energy)
+    mu : f(x) to convolve with g(x) kernel, mu(energy), or 2-d
+         array with one mu(energy) per row
     kernel : convolution kernel, g(x)
              'gaussian'
              'lorentzian'
@@ -129,50 +212,24 @@ def conv(e, mu, kernel='gaussian', fwhm_e=None, efermi=None):
             an energy-dependent values determined by a function as
             'lin_gamma()' or 'atan_gamma()'
     """
-    f = np.copy(mu)
-    z = np.zeros_like(f)
+    e = np.asarray(e)
+    f = np.array(mu, dtype='float64', ndmin=2)
     if efermi is not None:
         #ief = index_nearest(e, efermi)
         ief = np.argmin(np.abs(e-efermi))
-        f[0:ief] *= 0
+        f[:, 0:ief] *= 0
     if e.shape != fwhm_e.shape:
         print("Error: 'fwhm_e' does not have the same shape of 'e'")
         return 0
+    kmat, wext_e, wext_1 = conv_matrix(e, fwhm_e, kernel=kernel)
     # linar fit upper part of the spectrum to avoid border effects
     # polyfit => pf
-    lpf = len(e)/2.
-    cpf = np.polyfit(e[-lpf:], f[-lpf:], 1)
-    fpf = np.poly1d(cpf)
-    # extend upper energy border to 3*fhwm_e[-1]
-    estep = (e[-1] - e[-2])
-    eup = np.append(e, np.arange(e[-1]+estep, e[-1]+3*fwhm_e[-1], estep))
-    for n in range(len(f)):
-        #from now on I change e with eup
-        eimin, eimax = get_ene_index(eup, eup[n], 1.5*fwhm_e[n])
-        if ((eimin is None) or (eimax is None)):
-            if DEBUG:
-                raise IndexError('e[{0}]'.format(n))
-        if len(range(eimin, eimax)) % 2 == 0:
-            kx = eup[eimin:eimax+1] # odd range centered at the convolution point
-        else:
-            kx = eup[eimin:eimax]
-        ### kernel ###
-        hwhm = fwhm_e[n]/2.0
-        if ('gauss' in kernel.lower()):
-            ky = gaussian(kx, center=eup[n], sigma=hwhm)
-        elif ('lor' in kernel.lower()):
-            ky = lorentzian(kx, center=eup[n], sigma=hwhm)
-        else:
-            raise ValueError("convolution kernel '{0}' not implemented".format(kernel))
-        ky = ky/ky.sum() # normalize
-        zn = 0
-        lk = len(kx)
-        for mf, mg in zip( range(-(lk/2), (lk/2)+1), range(lk) ):
-            if ( ((n+mf) >= 0) and ((n+mf) < len(f)) ):
-                zn += f[n+mf] * ky[mg]
-            elif ((n+mf) >= 0):
-                zn += fpf(eup[n+mf]) * ky[mg]
-        z[n] = zn
+    lpf = len(e)//2
+    cpf = np.polyfit(e[-lpf:], f[:, -lpf:].T, 1)
+    z = (kmat.dot(f.T).T + np.outer(cpf[0], wext_e) +
+         np.outer(cpf[1], wext_1))
+    if np.ndim(mu) == 1:
+        z = z[0]
     return z
 
 def glinbroad(e, mu, fwhm_e=None, efermi=None, _larch=None):
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
+import multiprocessing as mp
 import numpy as np
-from scipy.interpolate import splrep, splev, UnivariateSpline
+from scipy.interpolate import splrep, splev, UnivariateSpline, CubicSpline
+from scipy.optimize import leastsq
 from scipy.stats import t
 from scipy.special import erf
 
@@ -13,7 +15,8 @@ from larch import (Group, Make_CallArgs, ValidateLarchPlugin,
 from larch.utils import (index_of, index_nearest, realimag, remove_dups)
 
 from larch_plugins.xafs import (ETOK, set_xafsGroup, ftwindow, xftf_fast,
-                                find_e0, pre_edge)
+                                XAFSFTEngine, find_e0, pre_edge,
+                                preedge_batch)
 
 
 # check for uncertainties package
@@ -26,6 +29,9 @@ except ImportError:
 
 FMT_COEF = 'coef_%2.2i'
 
+# setups kept per chunk in autobk_batch(), for spectra with the same e0
+MAX_CACHED_SETUPS = 8
+
 def spline_eval(kraw, mu, knots, coefs, order, kout):
     """eval bkg(kraw) and chi(k) for knots, coefs, order"""
     bkg = splev(kraw, [knots, coefs, order])
@@ -34,14 +40,17 @@ def spline_eval(kraw, mu, knots, coefs, order, kout):
 
 def __resid(pars, ncoefs=1, knots=None, order=3, irbkg=1, nfft=2048,
             kraw=None, mu=None, kout=None, ftwin=1, kweight=1, chi_std=None,
-            nclamp=0, clamp_lo=1, clamp_hi=1, **kws):
+            nclamp=0, clamp_lo=1, clamp_hi=1, ftengine=None, **kws):
 
     # coefs = [getattr(pars, FMT_COEF % i) for i in range(ncoefs)]
     coefs = [pars[FMT_COEF % i].value for i in range(ncoefs)]
     bkg, chi = spline_eval(kraw, mu, knots, coefs, order, kout)
     if chi_std is not None:
         chi = chi - chi_std
-    out =  realimag(xftf_fast(chi*ftwin, nfft=nfft)[:irbkg])
+    if ftengine is None:
+        out =  realimag(xftf_fast(chi*ftwin, nfft=nfft)[:irbkg])
+    else:
+        out =  realimag(ftengine.fftf(chi*ftwin)[:irbkg])
     if nclamp == 0:
         return out
     # spline clamps:
@@ -186,7 +195,8 @@ def autobk(energy, mu=None, group=None, rbkg=1, nknots=None, e0=None,
                                  mu=mu[ie0:iemax+1], irbkg=irbkg, kout=kout,
                                  ftwin=ftwin, kweight=kweight,
                                  nfft=nfft, nclamp=nclamp,
-                                 clamp_lo=clamp_lo, clamp_hi=clamp_hi))
+                                 clamp_lo=clamp_lo, clamp_hi=clamp_hi,
+                                 ftengine=XAFSFTEngine(nfft=nfft)))
 
     # write final results
     coefs = [result.params[FMT_COEF % i].value for i in range(len(coefs))]
@@ -268,5 +278,278 @@ def autobk(energy, mu=None, group=None, rbkg=1, nknots=None, e0=None,
         group.delta_bkg[ie0:ie0+len(dbkg)] = dbkg
 
 
+def _autobk_setup(energy, e0, rbkg=1, kmin=0, kmax=None, kweight=1,
+                  dk=0.1, win='hanning', nfft=2048, kstep=0.05):
+    """precompute the arrays used for autobk fits of spectra with a given
+    e0 and energy array, as a dictionary.
+
+    With the spline knots fixed, the background is linear in the spline
+    coefficients (bkg = B.c), and so is the interpolation of mu-bkg onto
+    the uniform k grid (chi = S.(mu-bkg)) and the windowed Fourier
+    transform up to rbkg (F.chi), so all of these are stored as matrices.
+    """
+    ie0 = index_of(energy, e0)
+    rgrid = np.pi/(kstep*nfft)
+    if rbkg < 2*rgrid: rbkg = 2*rgrid
+    irbkg = int(1.01 + rbkg/rgrid)
+
+    enpe = energy[ie0:] - e0
+    kraw = np.sign(enpe)*np.sqrt(ETOK*abs(enpe))
+    if kmax is None:
+        kmax = max(kraw)
+    else:
+        kmax = max(0, min(max(kraw), kmax))
+    kout  = kstep * np.arange(int(1.01+kmax/kstep), dtype='float64')
+    iemax = min(len(energy), 2+index_of(energy, e0+kmax*kmax/ETOK)) - 1
+    ftwin = kout**kweight * ftwindow(kout, xmin=kmin, xmax=kmax,
+                                     window=win, dx=dk, dx2=dk)
+
+    nspl = max(5, min(64, int(2*rbkg*(kmax-kmin)/np.pi) + 2))
+    spl_ik = np.array([index_nearest(kraw, kmin + i*(kmax-kmin)/(nspl - 1))
+                       for i in range(nspl)])
+    knots, coefs, order = splrep(kraw[spl_ik], np.zeros(nspl))
+
+    kr = kraw[:iemax-ie0+1]
+    ident = np.identity(len(coefs))
+    bmat = np.array([splev(kr, [knots, ident[i], order])
+                     for i in range(len(coefs))]).T
+    # UnivariateSpline(s=0) is the not-a-knot cubic spline interpolant
+    smat = CubicSpline(kr, np.identity(len(kr)), axis=0)(kout)
+    amat = smat.dot(bmat)
+
+    # FT up to irbkg, scaled as xftf_fast(nfft=nfft) in autobk's residual,
+    # as real/imag pairs
+    ftmat = np.exp(-2j*np.pi*np.outer(np.arange(irbkg),
+                                      np.arange(len(kout)))/nfft)
+    ftmat = (0.05/np.sqrt(np.pi)) * ftmat * ftwin
+    fmat = np.zeros((2*irbkg, len(kout)))
+    fmat[0::2], fmat[1::2] = ftmat.real, ftmat.imag
+
+    return dict(e0=e0, ie0=ie0, iemax=iemax, kraw=kraw, kout=kout,
+                kmax=kmax, nspl=nspl, spl_ik=spl_ik, knots=knots,
+                order=order, ncoefs=len(coefs), bmat=bmat, smat=smat,
+                amat=amat, fmat=fmat, famat=fmat.dot(amat[:, :nspl]))
+
+def _autobk_fit(mu, setup, coefs0=None, chi_std=None, kweight=1, nclamp=4,
+                clamp_lo=1, clamp_hi=1, calc_uncertainties=True,
+                err_sigma=1):
+    """fit background spline for one spectrum with precomputed setup,
+    starting from spline coefficients coefs0 (or an initial guess from
+    mu at the knots, as in autobk).  The residual is the same as for
+    autobk(), with the Jacobian given analytically."""
+    ie0, iemax, nspl = setup['ie0'], setup['iemax'], setup['nspl']
+    kout, amat = setup['kout'], setup['amat']
+    fmat, famat = setup['fmat'], setup['famat']
+    kraw = setup['kraw']
+    mux = mu[ie0:iemax+1]
+    if coefs0 is None:
+        spl_y = np.zeros(nspl)
+        for i, ik in enumerate(setup['spl_ik']):
+            i1 = min(len(kraw)-1, ik + 5)
+            i2 = max(0, ik - 5)
+            spl_y[i] = (2*mu[ik+ie0] + mu[i1+ie0] + mu[i2+ie0] ) / 4.0
+        coefs0 = splrep(kraw[setup['spl_ik']], spl_y)[1][:nspl]
+
+    # chi = chi0 - A.c  where only the first nspl coefs vary (others are 0)
+    chi0 = setup['smat'].dot(mux)
+    if chi_std is not None:
+        chi0 = chi0 - chi_std
+    avary = amat[:, :nspl]
+    kwt = kout**kweight
+    ftchi0 = fmat.dot(chi0)
+    nout = len(ftchi0)
+    clo, chhi = abs(clamp_lo), abs(clamp_hi)
+
+    def resid(coefs):
+        out = ftchi0 - famat.dot(coefs)
+        if nclamp == 0:
+            return out
+        scale = (1.0 + 100*(out*out).sum())/(nout*nclamp)
+        chik = (chi0 - avary.dot(coefs)) * kwt
+        return np.concatenate((out, clo*scale*chik[:nclamp],
+                               chhi*scale*chik[-nclamp:]))
+
+    def jacob(coefs):
+        out = ftchi0 - famat.dot(coefs)
+        if nclamp == 0:
+            return -famat
+        scale = (1.0 + 100*(out*out).sum())/(nout*nclamp)
+        dscale = -200*out.dot(famat)/(nout*nclamp)
+        chik = (chi0 - avary.dot(coefs)) * kwt
+        dchik = -avary * kwt[:, np.newaxis]
+        dclamp = scale*dchik + np.outer(chik, dscale)
+        return np.concatenate((-famat, clo*dclamp[:nclamp],
+                               chhi*dclamp[-nclamp:]))
+
+    coefs, covar, info, mesg, ier = leastsq(resid, coefs0, Dfun=jacob,
+                                            full_output=True, gtol=1.e-5,
+                                            ftol=1.e-5, xtol=1.e-5)
+    allcoefs = np.zeros(setup['ncoefs'])
+    allcoefs[:nspl] = coefs
+    bkg = setup['bmat'].dot(allcoefs)
+    out = dict(coefs=coefs, bkg=bkg, chi=setup['smat'].dot(mux - bkg),
+               nfev=info['nfev'], delta_chi=None, delta_bkg=None)
+
+    if calc_uncertainties and covar is not None:
+        resid_ = info['fvec']
+        nfree = len(resid_) - nspl
+        redchi = (resid_**2).sum() / max(1, nfree)
+        jac_chi = avary.T
+        jac_bkg = setup['bmat'][:, :nspl].T
+        dfchi = np.einsum('ik,ij,jk->k', jac_chi, covar, jac_chi)
+        dfbkg = np.einsum('ik,ij,jk->k', jac_bkg, covar, jac_bkg)
+        prob = 0.5*(1.0 + erf(err_sigma/np.sqrt(2.0)))
+        out['delta_chi'] = t.ppf(prob, len(kout)-nspl) * np.sqrt(dfchi*redchi)
+        out['delta_bkg'] = t.ppf(prob, len(mux)-nspl) * np.sqrt(dfbkg*redchi)
+    return out
+
+def _autobk_batch_chunk(args):
+    """run autobk fits for a chunk of spectra, in order, warm-starting
+    each fit from the previous spectrum's spline coefficients"""
+    energy, mu, e0, edge_step, kws = args
+    warm_start = kws.pop('warm_start', True)
+    setup_kws = {}
+    for key in ('rbkg', 'kmin', 'kmax', 'kweight', 'dk', 'win', 'nfft',
+                'kstep'):
+        setup_kws[key] = kws.pop(key)
+    k_std = kws.pop('k_std', None)
+    chi_std = kws.pop('chi_std', None)
+
+    nspec, npts = mu.shape
+    setups = {}
+    out = None
+    coefs = None
+    for i in range(nspec):
+        if e0[i] not in setups:
+            # each setup holds several (nk, nenergy) matrices
+            if len(setups) >= MAX_CACHED_SETUPS:
+                setups.clear()
+            setups[e0[i]] = _autobk_setup(energy, e0[i], **setup_kws)
+        setup = setups[e0[i]]
+        chistd = None
+        if chi_std is not None and k_std is not None:
+            chistd = np.interp(setup['kout'], k_std, chi_std)
+        if not warm_start or coefs is None or len(coefs) != setup['nspl']:
+            coefs = None
+        fit = _autobk_fit(mu[i], setup, coefs0=coefs, chi_std=chistd,
+                          kweight=setup_kws['kweight'], **kws)
+        coefs = fit['coefs']
+        if out is None:
+            nk = len(setup['kout'])
+            out = dict(k=setup['kout'], bkg=mu.copy(),
+                       chi=np.zeros((nspec, nk)),
+                       delta_chi=np.zeros((nspec, nk)),
+                       delta_bkg=np.zeros((nspec, npts)),
+                       knots_y=np.zeros((nspec, len(coefs))),
+                       nfev=np.zeros(nspec, dtype='int'))
+        ie0 = setup['ie0']
+        nbkg = len(fit['bkg'])
+        out['bkg'][i, ie0:ie0+nbkg] = fit['bkg']
+        out['chi'][i] = fit['chi']/edge_step[i]
+        out['knots_y'][i] = coefs
+        out['nfev'][i] = fit['nfev']
+        if fit['delta_chi'] is not None:
+            out['delta_chi'][i] = fit['delta_chi']
+            out['delta_bkg'][i, ie0:ie0+nbkg] = fit['delta_bkg']
+    out['chie'] = (mu - out['bkg'])/edge_step[:, np.newaxis]
+    return out
+
+@ValidateLarchPlugin
+def autobk_batch(energy, mu, group=None, rbkg=1, e0=None, edge_step=None,
+                 kmin=0, kmax=None, kweight=1, dk=0.1, win='hanning',
+                 k_std=None, chi_std=None, nfft=2048, kstep=0.05,
+                 pre_edge_kws=None, nclamp=4, clamp_lo=1, clamp_hi=1,
+                 calc_uncertainties=True, err_sigma=1, warm_start=True,
+                 nproc=1, _larch=None):
+    """Use Autobk algorithm to remove XAFS background for a stack of
+    spectra sharing one energy array, as for a time-resolved series.
+
+    Parameters:
+    -----------
+      energy:    1-d array of x-ray energies, in eV
+      mu:        2-d array of mu(E), shape (nspectra, len(energy))
+      group:     output group
+      e0:        edge energy, or array of e0 for each spectrum.
+                 If None, it will be determined with pre_edge_batch().
+      edge_step: edge step, or array of edge steps.
+                 If None, it will be determined with pre_edge_batch().
+      warm_start: whether to start each fit from the spline coefficients
+                 of the previous spectrum [True]
+      nproc:     number of processes to use, each fitting one contiguous
+                 block of spectra [1]
+      other arguments are as for autobk()
+
+    Returns:
+    --------
+      group with arrays, with one row (or value) per spectrum:
+        bkg, chie, chi, delta_chi, delta_bkg, e0, edge_step,
+        knots_y (fitted spline coefficients), nfev
+      and the shared arrays 'energy' and 'k'.
+
+    Notes:
+    ------
+      1. The spline knots depend only on e0, so for each distinct e0 the
+         background spline, the interpolation onto the k grid, and the
+         Fourier transform up to rbkg are precomputed as matrices, and
+         the fit of each spectrum needs only small matrix products.
+      2. If kmax is None, the smallest k range of all spectra is used,
+         so that all chi(k) share one k array.
+    """
+    energy = remove_dups(np.asarray(energy, dtype='float64'))
+    mu = np.atleast_2d(np.asarray(mu, dtype='float64'))
+    nspec = mu.shape[0]
+
+    if e0 is None or edge_step is None:
+        pre_kws = dict(nnorm=3, nvict=0, pre1=None,
+                       pre2=-50., norm1=100., norm2=None)
+        if pre_edge_kws is not None:
+            pre_kws.update(pre_edge_kws)
+        pre_dat = preedge_batch(energy, mu, e0=e0, make_flat=False, **pre_kws)
+        if e0 is None:
+            e0 = pre_dat['e0']
+        if edge_step is None:
+            edge_step = pre_dat['edge_step']
+    e0 = np.ones(nspec)*e0
+    edge_step = np.ones(nspec)*edge_step
+
+    if kmax is None:
+        kmax = min([np.sqrt(ETOK*(max(energy) - e)) for e in set(e0)])
+
+    kws = dict(rbkg=rbkg, kmin=kmin, kmax=kmax, kweight=kweight, dk=dk,
+               win=win, nfft=nfft, kstep=kstep, k_std=k_std,
+               chi_std=chi_std, nclamp=nclamp, clamp_lo=clamp_lo,
+               clamp_hi=clamp_hi, calc_uncertainties=calc_uncertainties,
+               err_sigma=err_sigma, warm_start=warm_start)
+
+    nproc = max(1, min(nproc, nspec))
+    bounds = np.linspace(0, nspec, nproc+1).astype(int)
+    tasks = [(energy, mu[i0:i1], e0[i0:i1], edge_step[i0:i1], dict(kws))
+             for i0, i1 in zip(bounds[:-1], bounds[1:])]
+    if nproc > 1:
+        pool = mp.Pool(nproc)
+        try:
+            results = pool.map(_autobk_batch_chunk, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [_autobk_batch_chunk(task) for task in tasks]
+
+    if group is None:
+        group = Group()
+    group.energy = energy
+    group.k = results[0]['k']
+    group.e0 = e0
+    group.edge_step = edge_step
+    for key in ('bkg', 'chie', 'chi', 'delta_chi', 'delta_bkg',
+                'knots_y', 'nfev'):
+        setattr(group, key, np.concatenate([r[key] for r in results]))
+    if not calc_uncertainties:
+        del group.delta_chi, group.delta_bkg
+    return group
+
+
 def registerLarchPlugin():
-    return ('_xafs', {'autobk': autobk})
+    return ('_xafs', {'autobk': autobk,
+                      'autobk_batch': autobk_batch})
@@ -23,10 +23,80 @@
 # 2014-Apr M Newville : translated to Python for Larch
 
 import numpy as np
+
+# scipy.fft (scipy >= 1.4) caches FFT plans between calls
+try:
+    from scipy.fft import fft, ifft
+except ImportError:
+    from numpy.fft import fft, ifft
+
 from larch import ValidateLarchPlugin, parse_group_args
 from larch.utils import complex_phase
 from larch_plugins.xafs import set_xafsGroup
 
+MAX_CACHED_FILTERS = 16
+CWT_CHUNKSIZE = 128
+_filter_cache = {}
+
+def cauchy_filters(kstep, nfft, rmax, nrpts):
+    """
+    Cauchy wavelet filter bank, for the R grid linspace(0, rmax, nrpts)
+
+    Parameters:
+    -----------
+      kstep:   k step of chi(k)
+      nfft:    value to use for N_fft
+      rmax:    highest R
+      nrpts:   number of R points
+
+    Returns:
+    --------
+      r, filters  -- the R array (with r[0] set to 1.e-19) and the
+                     (nrpts, nfft) array of filters in frequency space.
+
+    Notes:
+    ------
+      results are cached on (kstep, nfft, rmax, nrpts), and should
+      not be modified.
+    """
+    key = (kstep, nfft, rmax, nrpts)
+    if key not in _filter_cache:
+        if len(_filter_cache) >= MAX_CACHED_FILTERS:
+            _filter_cache.clear()
+        omega = np.pi*np.arange(nfft)/(kstep*nfft)
+        r = np.linspace(0, rmax, nrpts)
+        r[0] = 1.e-19
+        aom = np.outer(nrpts/(2*r), omega)
+        aom[np.where(aom==0)] = 1.e-19
+        # Characteristic values for Cauchy wavelet:
+        cauchy_sum = np.log(2*np.pi) - np.log(1.0+np.arange(nrpts)).sum()
+        with np.errstate(under='ignore', over='ignore'):
+            filters = np.exp(cauchy_sum + nrpts*np.log(aom) - aom)
+        r.flags.writeable = False
+        filters.flags.writeable = False
+        _filter_cache[key] = (r, filters)
+    return _filter_cache[key]
+
+def cauchy_transform(chi, kstep, nfft, rmax, nrpts, nkout, rslice=None,
+                     chunksize=CWT_CHUNKSIZE):
+    """
+    Cauchy wavelet transform of chi, as an (nrpts, nkout) complex array,
+    or only the rows in rslice.
+
+    The inverse FFTs for all R are done as 2-d FFTs of chunksize rows
+    at a time, to bound the memory used.
+    """
+    filters = cauchy_filters(kstep, nfft, rmax, nrpts)[1]
+    if rslice is not None:
+        filters = filters[rslice]
+    tff = fft(chi, n=2*nfft)[:nfft]
+    nrows = len(filters)
+    out = np.empty((nrows, nkout), dtype='complex128')
+    for i0 in range(0, nrows, chunksize):
+        i1 = min(nrows, i0 + chunksize)
+        out[i0:i1] = ifft(filters[i0:i1]*tff, n=2*nfft, axis=1)[:, :nkout]
+    return out
+
 @ValidateLarchPlugin
 def cauchy_wavelet(k, chi=None, group=None, kweight=0, rmax_out=10,
                    nfft=2048, _larch=None):
@@ -82,30 +152,8 @@ def cauchy_wavelet(k, chi=None, group=None, kweight=0, rmax_out=10,
         knew = k[:NFT]
         xnew = chi[:NFT]
 
-    # FT parameters
-    freq = (1.0/kstep)*np.arange(nfft)/(2*nfft)
-    omega = 2*np.pi*freq
-
-    # simple FT calculation
-    tff = np.fft.fft(xnew, n= 2*nfft)
-
-    # scale parameter
-    r  = np.linspace(0, rmax, nrpts)
-    r[0] = 1.e-19
-    a  = nrpts/(2*r)
-
-    # Characteristic values for Cauchy wavelet:
-    cauchy_sum = np.log(2*np.pi) - np.log(1.0+np.arange(nrpts)).sum()
-
-    # Main calculation:
-    out = np.zeros(nkout*nrpts,
-                   dtype='complex128').reshape(nrpts, nkout)
-    for i in range(nrpts):
-        aom = a[i]*omega
-        aom[np.where(aom==0)] = 1.e-19
-        filt = cauchy_sum + nrpts*np.log(aom) - aom
-        tmp  = np.conj(np.exp(filt))*tff[:nfft]
-        out[i, :] = np.fft.ifft(tmp, 2*nfft)[:nkout]
+    r = cauchy_filters(kstep, nfft, rmax, nrpts)[0].copy()
+    out = cauchy_transform(xnew, kstep, nfft, rmax, nrpts, nkout)
 
     group = set_xafsGroup(group, _larch=_larch)
     group.r  =  r
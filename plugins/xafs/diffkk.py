@@ -2,6 +2,7 @@
 import time
 import numpy as np
 from scipy.special import erfc
+from scipy.signal import fftconvolve
 
 from larch import Group
 from larch.utils import interp
@@ -21,6 +22,8 @@ pi = np.pi
 TINY = 1e-20
 FOPI = 4/pi
 MAXORDER = 6
+# grids with at least this many points use the FFT transform by default
+KK_FFT_MINPTS = 1024
 
 ##
 ## to test the advantage of the vectorized MacLaurin series algorithm:
@@ -78,7 +81,7 @@ def kkmclf_sca(e, finp):
     fout = [0.0]*npts
     if npts >= 2:
         factor = FOPI * (e[npts-1] - e[0]) / (npts - 1)
-        nptsk = npts / 2
+        nptsk = npts // 2
         for i in range(npts):
             fout[i] = 0.0
             ei2 = e[i]*e[i]
@@ -113,7 +116,7 @@ def kkmclr_sca(e, finp):
     fout = [0.0]*npts
 
     factor = -FOPI * (e[npts-1] - e[0]) / (npts - 1)
-    nptsk  = npts / 2
+    nptsk  = npts // 2
     for i in range(npts):
         fout[i] = 0.0
         ei2 = e[i]*e[i]
@@ -154,7 +157,7 @@ def kkmclf(e, finp):
     ei2    = e**2
     ioff   = np.mod(np.arange(npts), 2) - 1
 
-    nptsk  = npts/2
+    nptsk  = npts//2
     k      = np.arange(nptsk)
 
     for i in range(npts):
@@ -188,7 +191,7 @@ def kkmclr(e, finp):
     ei2    = e**2
     ioff   = np.mod(np.arange(npts), 2) - 1
 
-    nptsk  = npts/2
+    nptsk  = npts//2
     k      = np.arange(nptsk)
 
     for i in range(npts):
@@ -200,6 +203,72 @@ def kkmclr(e, finp):
     return fout
 
 
+###
+###  These are FFT forms of the MacLaurin series algorithm.  Writing
+###     e_j/(e_j^2 - e_i^2) = [1/(e_j - e_i) + 1/(e_j + e_i)]/2
+###  turns both sums over points of opposite parity into discrete
+###  convolutions on the even grid, with kernels 1/(j-i) and
+###  1/(e_0 + e_0 + (i+j)*de), which are done with zero-padded FFTs.
+###  The results are the same as for the scalar and vector forms, in
+###  O(N log N) time.  As for those, finp is taken to be 0 outside the grid.
+###
+def _kkmcl_sums(e, finp):
+    """
+    return the sums over points j of opposite parity to i of
+      finp[j]/(j-i)   and   de*finp[j]/(e[j]+e[i])
+    for an even grid e, using FFT convolutions.
+    """
+    npts = len(e)
+    finp = np.asarray(finp, dtype='float64')
+    de = (e[-1] - e[0]) / (npts-1)
+    m = np.arange(1-npts, npts)
+    odd = (m % 2 == 1)
+    hdiff = np.zeros(2*npts-1)
+    hdiff[odd] = -1.0/m[odd]
+    s = np.arange(2*npts-1)
+    hsum = np.zeros(2*npts-1)
+    hsum[1::2] = de/(2*e[0] + s[1::2]*de)
+    sdiff = fftconvolve(finp, hdiff)[npts-1:2*npts-1]
+    ssum = fftconvolve(finp[::-1], hsum)[npts-1:2*npts-1]
+    return sdiff, ssum
+
+def kkmclf_fft(e, finp):
+    """
+    forward (f'->f'') kk transform, using maclaurin series algorithm
+    with FFT convolutions
+
+    arguments:
+      e      energy array *must be on an even grid with an even number of points* [npts] (in)
+      finp   f' array [npts] (in)
+      fout   f'' array [npts] (out)
+    """
+    npts = len(e)
+    if npts != len(finp):
+        raise ValueError("Input arrays not of same length for diff KK transform in kkmclf_fft")
+    if npts < 2:
+        raise ValueError("Array too short for diff KK transform in kkmclf_fft")
+    sdiff, ssum = _kkmcl_sums(e, finp)
+    return (FOPI/2) * (sdiff - ssum)
+
+def kkmclr_fft(e, finp):
+    """
+    reverse (f''->f') kk transform, using maclaurin series algorithm
+    with FFT convolutions
+
+    arguments:
+      e      energy array *must be on an even grid with an even number of points* [npts] (in)
+      finp   f'' array [npts] (in)
+      fout   f' array [npts] (out)
+    """
+    npts = len(e)
+    if npts != len(finp):
+        raise ValueError("Input arrays not of same length for diff KK transform in kkmclr_fft")
+    if npts < 2:
+        raise ValueError("Array too short for diff KK transform in kkmclr_fft")
+    sdiff, ssum = _kkmcl_sums(e, finp)
+    return -(FOPI/2) * (sdiff + ssum)
+
+
 class diffKKGroup(Group):
     """
     A Larch Group for generating f'(E) and f"(E) from a XAS measurement of mu(E).
@@ -225,7 +294,7 @@ class diffKKGroup(Group):
 
 
 # e0=None, z=None, edge=None, order=3, form='mback', whiteline=False, how=None
-    def kk(self, energy=None, mu=None, z=None, edge='K', how='scalar', mback_kws=None):
+    def kk(self, energy=None, mu=None, z=None, edge='K', how=None, mback_kws=None):
         """
         Convert mu(E) data into f'(E) and f"(E).  f"(E) is made by
         matching mu(E) to the tabulated values of the imaginary part
@@ -239,6 +308,9 @@ class diffKKGroup(Group):
             z:          Z number of absorber
             edge:       absorption edge, usually 'K' or 'L3'
             mback_kws:  arguments for the mback algorithm
+            how:        KK transform to use: 'scalar', 'vector', or 'fft'.
+                        If None, 'fft' is used for grids of at least
+                        KK_FFT_MINPTS points, and 'vector' otherwise.
 
           Returns
             self.f1, self.f2:  CL values over on the input energy grid
@@ -270,7 +342,7 @@ class diffKKGroup(Group):
         if self.mback_kws is not None:
             mb_kws.update(self.mback_kws)
 
-        start = time.clock()
+        start = time.time()
 
         mback(self.energy, self.mu, group=self, _larch=self._larch, **mb_kws)
 
@@ -280,10 +352,15 @@ class diffKKGroup(Group):
         fpp = interp(self.energy, self.f2-self.fpp, self.grid, fill_value=0.0)
 
         ## do difference KK
-        if repr(how).startswith('sca'):
+        if how is None:
+            how = 'fft' if npts >= KK_FFT_MINPTS else 'vector'
+        if str(how).startswith('sca'):
             fp = kkmclr_sca(self.grid, fpp)
+        elif str(how).startswith('fft'):
+            fp = kkmclr_fft(self.grid, fpp)
         else:
             fp = kkmclr(self.grid, fpp)
+        self.how = how
 
         ## interpolate back to original grid and add diffKK result to f1 to make fp array
         self.fp = self.f1 + interp(self.grid, fp, self.energy, fill_value=0.0)
@@ -291,7 +368,7 @@ class diffKKGroup(Group):
         ## clean up group
         #for att in ('normalization_function', 'weight', 'grid'):
         #    if hasattr(self, att): delattr(self, att)
-        finish = time.clock()
+        finish = time.time()
         self.time_elapsed = float(finish-start)
 
 
@@ -14,7 +14,7 @@ creates a group that contains the chi(k) for the sum of paths.
 """
 import six
 import numpy as np
-from scipy.interpolate import UnivariateSpline
+from scipy.interpolate import UnivariateSpline, CubicSpline
 from lmfit import Parameters
 from larch import (Group, Parameter, isParameter,
                    ValidateLarchPlugin,
@@ -429,6 +429,193 @@ class FeffPathGroup(Group):
         self.chi = cchi.imag
         self.chi_imag = -cchi.real
 
+class FeffPathStack(object):
+    """stacked Feff.dat tables for a list of FeffPath Groups, used to
+    calculate chi(k) for all paths with a single set of array operations.
+
+    The tabulated pha, amp, rep, lam arrays for all paths sharing a
+    Feff.dat k grid are held as one interpolating cubic spline (identical
+    to UnivariateSpline(s=0) as used in FeffPathGroup._calc_chi), with
+    polynomial coefficients arranged as (npaths, nintervals, 4, 4) so
+    that interpolation for all paths onto their e0-shifted q arrays is a
+    single gather and Horner evaluation.
+
+    The stack depends only on the Feff.dat files, so it can be built
+    once per fit and reused for every residual evaluation.
+    """
+    def __init__(self, pathlist, _larch=None):
+        self._larch = _larch
+        self.pathlist = list(pathlist)
+        self.npaths = len(self.pathlist)
+        self.reff = np.array([p._feffdat.reff for p in self.pathlist])
+        self.valid = self.reff >= 0.05
+        # group paths by Feff.dat k grid -- normally there is only one
+        kgrids = {}
+        for ipath, path in enumerate(self.pathlist):
+            key = path._feffdat.k.tobytes()
+            if key not in kgrids:
+                kgrids[key] = []
+            kgrids[key].append(ipath)
+
+        self.blocks = []
+        for key, index in kgrids.items():
+            fdats = [self.pathlist[i]._feffdat for i in index]
+            kfeff = fdats[0].k
+            # tables: (nk, 4, npaths) for (pha, amp, rep, lam)
+            tables = np.array([[f.pha, f.amp, f.rep, f.lam] for f in fdats])
+            spl = CubicSpline(kfeff, tables.transpose(2, 1, 0), axis=0)
+            # spline coefs (order, interval, quantity, path) ->
+            #              (path, interval, order, quantity)
+            coefs = np.ascontiguousarray(spl.c.transpose(3, 1, 0, 2))
+            self.blocks.append((np.array(index), kfeff, coefs))
+
+    def __getstate__(self):
+        "pickle only the stacked arrays, not the FeffPath Groups"
+        state = self.__dict__.copy()
+        state['pathlist'] = None
+        state['_larch'] = None
+        return state
+
+    def interpolate(self, q, deriv=False):
+        """interpolate Feff.dat tables for all paths
+
+        Parameters:
+            q:      2-D array (npaths, nk) of wavenumbers at which to
+                    evaluate each path
+            deriv:  whether to also return derivatives with q [False]
+
+        Returns:
+            array (4, npaths, nk) for pha, amp, rep, lam, and with
+            deriv=True, a second array of the derivatives d/dq.
+        """
+        out = np.zeros((4,) + q.shape)
+        dout = np.zeros((4,) + q.shape) if deriv else None
+        for index, kfeff, coefs in self.blocks:
+            qx = q[index]
+            iseg = np.searchsorted(kfeff, qx, side='right') - 1
+            iseg = np.clip(iseg, 0, len(kfeff)-2)
+            dq = (qx - kfeff[iseg])[..., np.newaxis]
+            c = coefs[np.arange(len(index))[:, np.newaxis], iseg]
+            val = ((c[..., 0, :]*dq + c[..., 1, :])*dq + c[..., 2, :])*dq + c[..., 3, :]
+            out[:, index] = np.moveaxis(val, -1, 0)
+            if deriv:
+                dval = (3*c[..., 0, :]*dq + 2*c[..., 1, :])*dq + c[..., 2, :]
+                dout[:, index] = np.moveaxis(dval, -1, 0)
+        if deriv:
+            return out, dout
+        return out
+
+    def calc_chi(self, k, pathpars):
+        """calculate complex chi(k) for all paths
+
+        Parameters:
+            k:         1-D array of k values
+            pathpars:  2-D array (npaths, 8) of path parameter values,
+                       ordered as PATH_PARS
+
+        Returns:
+            complex array (npaths, len(k)) of chi(k), and complex
+            wavenumber p, of the same shape.  chi(k) is zero for paths
+            with reff too small to calculate chi(k).
+        """
+        cchi, p, dchi = self._xafs_equation(k, pathpars, deriv=False)
+        return cchi, p
+
+    def calc_chi_deriv(self, k, pathpars):
+        """calculate complex chi(k) for all paths and its derivatives
+        with respect to each of the path parameters
+
+        Parameters:
+            k:         1-D array of k values
+            pathpars:  2-D array (npaths, 8) of path parameter values,
+                       ordered as PATH_PARS
+
+        Returns:
+            complex array (npaths, len(k)) of chi(k), and complex array
+            (npaths, 8, len(k)) of d(chi)/d(path parameter), with path
+            parameters ordered as PATH_PARS.
+        """
+        cchi, p, dchi = self._xafs_equation(k, pathpars, deriv=True)
+        return cchi, dchi
+
+    def _xafs_equation(self, k, pathpars, deriv=False):
+        pars = np.asarray(pathpars, dtype='float64').reshape(self.npaths, -1)
+        degen, s02, e0, ei, deltar, sigma2, third, fourth = \
+               [a[:, np.newaxis] for a in pars.T]
+        reff = self.reff[:, np.newaxis]
+
+        # create e0-shifted energy and k, careful to look for |e0| ~= 0.
+        en = k*k - e0*ETOK
+        en[np.where(abs(en) < 2*SMALL)] = SMALL
+        # q is the e0-shifted wavenumber
+        q = np.sign(en)*np.sqrt(abs(en))
+
+        if deriv:
+            (pha, amp, rep, lam), dtabs = self.interpolate(q, deriv=True)
+        else:
+            pha, amp, rep, lam = self.interpolate(q)
+
+        # p = complex wavenumber, and its square:
+        pp   = (rep + 1j/lam)**2 + 1j * ei * ETOK
+        p    = np.sqrt(pp)
+
+        # the xafs equation:
+        expo = np.exp(-2*reff*p.imag - 2*pp*(sigma2 - pp*fourth/3) +
+                      1j*(2*q*reff + pha +
+                          2*p*(deltar - 2*sigma2/reff - 2*pp*third/3) ))
+
+        rnorm = q*(reff + deltar)**2
+        cchi = degen * s02 * amp * expo / rnorm
+        cchi[:, 0] = 2*cchi[:, 1] - cchi[:, 2]
+        cchi[~self.valid] = 0
+        if not deriv:
+            return cchi, p, None
+
+        def dphase(dq, dpp, dpha):
+            "derivative of the exponent, given derivatives of q, p**2, pha"
+            dp = dpp/(2*p)
+            return (-2*reff*dp.imag - 2*dpp*(sigma2 - pp*fourth/3) +
+                    2*pp*dpp*fourth/3 +
+                    1j*(2*dq*reff + dpha +
+                        2*dp*(deltar - 2*sigma2/reff - 2*pp*third/3) -
+                        4*p*dpp*third/3))
+
+        unit = amp * expo / rnorm
+        dchi = np.zeros((self.npaths, len(PATH_PARS), len(k)),
+                        dtype='complex128')
+        dchi[:, 0] = s02 * unit
+        dchi[:, 1] = degen * unit
+        # e0 changes q, and so all of the interpolated Feff.dat values
+        dq = -ETOK/(2*abs(q))
+        dpha, damp, drep, dlam = dtabs * dq
+        dpp = 2*(rep + 1j/lam)*(drep - 1j*dlam/lam**2)
+        dchi[:, 2] = (degen*s02*unit*(dphase(dq, dpp, dpha) - dq/q) +
+                      degen*s02*damp*expo/rnorm)
+        dchi[:, 3] = degen*s02*unit*dphase(0, 1j*ETOK, 0)
+        dchi[:, 4] = degen*s02*unit*(2j*p - 2/(reff + deltar))
+        dchi[:, 5] = degen*s02*unit*(-2*pp - 4j*p/reff)
+        dchi[:, 6] = degen*s02*unit*(-4j*p*pp/3)
+        dchi[:, 7] = degen*s02*unit*(2*pp*pp/3)
+        dchi[:, :, 0] = 2*dchi[:, :, 1] - dchi[:, :, 2]
+        dchi[~self.valid] = 0
+        return cchi, p, dchi
+
+
+def _pathlist_params(pathlist, paramgroup=None, _larch=None):
+    """evaluate path parameters for a list of FeffPath Groups, using
+    the current fiteval namespace.
+
+    Returns:
+        2-d array (npaths, len(PATH_PARS)) of path parameter values
+    """
+    group2params(paramgroup, _larch=_larch)
+    out = []
+    for path in pathlist:
+        path.create_path_params()
+        pvals = path.path_paramvals()
+        out.append([pvals[pname] for pname in PATH_PARS])
+    return np.array(out, dtype='float64')
+
 @ValidateLarchPlugin
 def _path2chi(path, paramgroup=None, _larch=None, **kws):
     """calculate chi(k) for a Feff Path,
@@ -457,7 +644,8 @@ def _path2chi(path, paramgroup=None, _larch=None, **kws):
 
 @ValidateLarchPlugin
 def _ff2chi(pathlist, group=None, paramgroup=None, _larch=None,
-            k=None, kmax=None, kstep=0.05, **kws):
+            k=None, kmax=None, kstep=0.05, pathstack=None, pathpars=None,
+            **kws):
     """sum chi(k) for a list of FeffPath Groups.
 
     Parameters:
@@ -467,34 +655,55 @@ def _ff2chi(pathlist, group=None, paramgroup=None, _larch=None,
       kmax:        maximum k value for chi calculation [20].
       kstep:       step in k value for chi calculation [0.05].
       k:           explicit array of k values to calculate chi.
+      pathstack:   FeffPathStack for pathlist, to reuse between calls [None]
+      pathpars:    array of already evaluated path parameters [None]
     Returns:
     ---------
        group contain arrays for k and chi
 
-    This essentially calls path2chi() for each of the paths in the
-    pathlist and writes the resulting arrays to group.k and group.chi.
+    This evaluates the path parameters for each of the paths in the
+    pathlist, calculates chi(k) for all paths at once, and writes the
+    resulting arrays to group.k and group.chi.  The chi(k) for each path
+    is also written to each path group, as for path2chi().
 
     """
-    params = group2params(paramgroup, _larch=_larch)
-
     msg = _larch.writer.write
     for path in pathlist:
         if not isNamedClass(path, FeffPathGroup):
             msg('%s is not a valid Feff Path' % path)
             return
-        path.create_path_params()
-        path._calc_chi(k=k, kstep=kstep, kmax=kmax)
-    k = pathlist[0].k[:]
-    out = np.zeros_like(k)
-    for path in pathlist:
-        out += path.chi
+
+    if pathpars is None:
+        pathpars = _pathlist_params(pathlist, paramgroup=paramgroup,
+                                    _larch=_larch)
+
+    if (pathstack is None or len(pathstack.pathlist) != len(pathlist) or
+        any(a is not b for a, b in zip(pathstack.pathlist, pathlist))):
+        pathstack = FeffPathStack(pathlist, _larch=_larch)
+
+    if k is None:
+        if kmax is None:
+            kmax = 30.0
+        kmax = min(max(pathlist[0]._feffdat.k), kmax)
+        if kstep is None: kstep = 0.05
+        k = kstep * np.arange(int(1.01 + kmax/kstep), dtype='float64')
+
+    cchi, p = pathstack.calc_chi(k, pathpars)
+    for i, path in enumerate(pathlist):
+        if not pathstack.valid[i]:
+            msg('reff is too small to calculate chi(k)')
+            continue
+        path.k = k
+        path.p = p[i]
+        path.chi = cchi[i].imag
+        path.chi_imag = -cchi[i].real
 
     if group is None:
         group = Group()
     else:
         group = set_xafsGroup(group, _larch=_larch)
     group.k = k
-    group.chi = out
+    group.chi = cchi.imag.sum(axis=0)
     return group
 
 def feffpath(filename=None, _larch=None, label=None, s02=None,
@@ -2,6 +2,9 @@
 """
    feffit sums Feff paths to match xafs data
 """
+import time
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 from collections import Iterable
 from copy import copy, deepcopy
 from functools import partial
@@ -16,11 +19,14 @@ from lmfit import Parameters, Parameter, Minimizer, asteval, fit_report
 from larch import (Group, isParameter, ValidateLarchPlugin, isNamedClass)
 
 from larch.utils import index_of, realimag, complex_phase
-from larch_plugins.xafs import (xftf_fast, xftr_fast, ftwindow,
-                                set_xafsGroup, FeffPathGroup, _ff2chi)
-
-from larch_plugins.xafs.sigma2_models import sigma2_correldebye, sigma2_debye
-from larch_plugins.xafs.feffdat import PATHPAR_FMT
+from larch_plugins.xafs import (set_xafsGroup, FeffPathGroup,
+                                FeffPathStack, XAFSFTEngine, _ff2chi)
+
+from larch_plugins.xafs.cauchy_wavelet import cauchy_transform
+from larch_plugins.xafs.sigma2_models import (sigma2_correldebye, sigma2_debye,
+                                              sigma2_debye_feffdat)
+from larch_plugins.xafs.feffdat import (PATHPAR_FMT, PATH_PARS,
+                                        _pathlist_params)
 # use larch's uncertainties package
 from larch.fitting import (correlated_values, eval_stderr,
                            group2params, params2group)
@@ -28,13 +34,11 @@ from larch.fitting import (correlated_values, eval_stderr,
 class TransformGroup(Group):
     """A Group of transform parameters.
     The apply() method will return the result of applying the transform,
-    ready to use in a Fit.   This caches the FT windows (k and r windows)
-    and assumes that once created (not None), these do not need to be
-    recalculated....
+    ready to use in a Fit.   The FFTs are done with an XAFSFTEngine for
+    the current (nfft, kstep), which caches the FT windows (k and r windows)
+    by the window parameters and reuses its work buffers between calls.
 
-    That is: don't simply change the parameters and expect different results.
-    If you do change parameters, reset kwin / rwin to None to cause them to be
-    recalculated.
+    The kwin / rwin attributes hold the most recently used windows.
     """
     def __init__(self, kmin=0, kmax=20, kweight=2, dk=4, dk2=None,
                  window='kaiser', nfft=2048, kstep=0.05,
@@ -58,6 +62,7 @@ class TransformGroup(Group):
         self.rwindow = rwindow
         self.__nfft = 0
         self.__kstep = None
+        self._engine = None
         self.nfft  = nfft
         self.kstep = kstep
         self.rstep = pi/(self.kstep*self.nfft)
@@ -104,9 +109,10 @@ class TransformGroup(Group):
         self.__kstep = self.kstep
         self.__nfft = self.nfft
 
-        self.rstep = pi/(self.kstep*self.nfft)
-        self.k_ = self.kstep * arange(self.nfft, dtype='float64')
-        self.r_ = self.rstep * arange(self.nfft, dtype='float64')
+        self._engine = XAFSFTEngine(nfft=self.nfft, kstep=self.kstep)
+        self.rstep = self._engine.rstep
+        self.k_ = self._engine.k_
+        self.r_ = self._engine.r_
 
     def _xafsft(self, chi, group=None, rmax_out=10, **kws):
         "returns "
@@ -137,46 +143,55 @@ class TransformGroup(Group):
             return self.kweight[0]
         return self.kweight
 
-    def fftf(self, chi, kweight=None):
-        """ forward FT -- meant to be used internally.
-        chi must be on self.k_ grid"""
+    def get_kwin(self):
+        "return k window for current parameters, from the FT engine cache"
         if self.kstep != self.__kstep or self.nfft != self.__nfft:
             self.make_karrays()
-        if self.kwin is None:
-            self.kwin = ftwindow(self.k_, xmin=self.kmin, xmax=self.kmax,
-                                 dx=self.dk, dx2=self.dk2, window=self.window)
-        if kweight is None:
-            kweight = self.get_kweight()
-        cx = chi * self.kwin[:len(chi)] * self.k_[:len(chi)]**kweight
-        return xftf_fast(cx, kstep=self.kstep, nfft=self.nfft)
+        self.kwin = self._engine.window('k', xmin=self.kmin, xmax=self.kmax,
+                                        dx=self.dk, dx2=self.dk2,
+                                        window=self.window)
+        return self.kwin
 
-    def fftr(self, chir):
-        " reverse FT -- meant to be used internally"
+    def get_rwin(self):
+        "return R window for current parameters, from the FT engine cache"
         if self.kstep != self.__kstep or self.nfft != self.__nfft:
             self.make_karrays()
-        if self.rwin is None:
-            self.rwin = ftwindow(self.r_, xmin=self.rmin, xmax=self.rmax,
-                                 dx=self.dr, dx2=self.dr2, window=self.rwindow)
+        self.rwin = self._engine.window('r', xmin=self.rmin, xmax=self.rmax,
+                                        dx=self.dr, dx2=self.dr2,
+                                        window=self.rwindow)
+        return self.rwin
+
+    def fftf(self, chi, kweight=None):
+        """ forward FT -- meant to be used internally.
+        chi must be on self.k_ grid.
 
-        cx = chir * self.rwin[:len(chir)]
-        return xftr_fast(cx, kstep=self.kstep, nfft=self.nfft)
+        kweight can be a list of k-weights, in which case all are
+        transformed with a single FFT call, and a 2-d array with one
+        chi(R) per k-weight is returned."""
+        kwin = self.get_kwin()
+        if kweight is None:
+            kweight = self.get_kweight()
+        return self._engine.fftf(chi, kwin=kwin, kweight=kweight)
+
+    def fftr(self, chir):
+        """ reverse FT -- meant to be used internally.
+        chir can be 2-d, with one chi(R) per row"""
+        rwin = self.get_rwin()
+        return self._engine.fftr(chir, rwin=rwin)
 
 
     def make_cwt_arrays(self, nkpts, nrpts):
-        if self.kstep != self.__kstep or self.nfft != self.__nfft:
-            self.make_karrays()
-        if self.kwin is None:
-            self.kwin = ftwindow(self.k_, xmin=self.kmin, xmax=self.kmax,
-                                 dx=self.dk, dx2=self.dk2, window=self.window)
+        self.get_kwin()
 
         if self._cauchymask is None:
             if self.wavelet_mask is not None:
                 self._cauchymask = self.wavelet_mask
+                self._cauchyslice = (slice(None), slice(None))
             else:
                 ikmin = max(0, int(0.01 + self.kmin/self.kstep))
-                ikmax = min(self.nfft/2,  int(0.01 + self.kmax/self.kstep))
+                ikmax = min(self.nfft//2,  int(0.01 + self.kmax/self.kstep))
                 irmin = max(0, int(0.01 + self.rmin/self.rstep))
-                irmax = min(self.nfft/2,  int(0.01 + self.rmax/self.rstep))
+                irmax = min(self.nfft//2,  int(0.01 + self.rmax/self.rstep))
                 cm = np.zeros(nrpts*nkpts, dtype='int').reshape(nrpts, nkpts)
                 cm[irmin:irmax, ikmin:ikmax] = 1
                 self._cauchymask = cm
@@ -191,8 +206,6 @@ class TransformGroup(Group):
         if self.kwin is None:
             self.make_cwt_arrays(nkpts, nrpts)
 
-        omega = pi*np.arange(self.nfft)/(self.kstep*self.nfft)
-
         if kweight is None:
             kweight = self.get_kweight()
         if kweight != 0:
@@ -201,28 +214,23 @@ class TransformGroup(Group):
         if rmax is not None:
             self.rmax = rmax
 
-        chix   = np.zeros(self.nfft/2) * self.kstep
-        chix[:nkpts] = chi
-        chix   = chix[:self.nfft/2]
-        _ffchi = np.fft.fft(chix, n=2*self.nfft)[:self.nfft]
+        chix   = np.zeros(self.nfft//2)
+        chix[:nkpts] = chi[:self.nfft//2]
 
         nrpts = int(np.round(self.rmax/self.rstep))
-        r   = self.rstep * arange(nrpts)
-        r[0] = 1.e-19
-        alpha = nrpts/(2*r)
-
         self.make_cwt_arrays(nkpts, nrpts)
 
-        cauchy_sum = np.log(2*pi) - np.log(1.0+np.arange(nrpts)).sum()
-
-        out = np.zeros(nrpts*nkpts, dtype='complex128').reshape(nrpts, nkpts)
-
-        for i in range(nrpts):
-            aom = alpha[i]*omega
-            filt = cauchy_sum + nrpts*np.log(aom) - aom
-            out[i, :] = np.fft.ifft(np.exp(filt)*_ffchi, 2*self.nfft)[:nkpts]
-
-        return (out*self._cauchymask)[self._cauchyslice]
+        # with the default mask, only the rows inside it are calculated
+        rslice, kslice = self._cauchyslice
+        mask = self._cauchymask[:, kslice]
+        if self.wavelet_mask is None:
+            mask = mask[rslice]
+        else:
+            rslice = None
+        out = cauchy_transform(chix, self.kstep, self.nfft,
+                               self.rstep*(nrpts-1), nrpts, nkpts,
+                               rslice=rslice)
+        return out[:, kslice]*mask
 
 class FeffitDataSet(Group):
     def __init__(self, data=None, pathlist=None, transform=None,
@@ -242,7 +250,9 @@ class FeffitDataSet(Group):
         self.model = Group()
         self.model.k = None
         self.__chi = None
+        self._pathstack = None
         self.__prepared = False
+        self.reset_timing()
 
     def __repr__(self):
         return '<FeffitDataSet Group: %s>' % self.__name__
@@ -295,6 +305,7 @@ class FeffitDataSet(Group):
             path.create_path_params()
             if path.spline_coefs is None:
                 path.create_spline_coefs()
+        self._pathstack = FeffPathStack(self.pathlist, _larch=self._larch)
 
         self.__prepared = True
 
@@ -309,7 +320,7 @@ class FeffitDataSet(Group):
 
         all_kweights = all_kweights and isinstance(trans.kweight, Iterable)
         if all_kweights:
-            chir = [trans.fftf(chi, kweight=kw) for kw in trans.kweight]
+            chir = trans.fftf(chi, kweight=list(trans.kweight))
         else:
             chir = [trans.fftf(chi)]
         irmin = int(0.01 + rmin/trans.rstep)
@@ -376,61 +387,67 @@ class FeffitDataSet(Group):
         if not self.__prepared:
             self.prepare_fit()
 
-        _ff2chi(self.pathlist, paramgroup=paramgroup, k=self.model.k,
-                _larch=self._larch, group=self.model)
-
-        eps_k = self.epsilon_k
-        if isinstance(eps_k, np.ndarray):
-            eps_k[np.where(eps_k<1.e-12)[0]] = 1.e-12
+        t0 = time.time()
+        pathpars = self._pathparams(paramgroup)
+        t1 = time.time()
+        _ff2chi(self.pathlist, k=self.model.k, _larch=self._larch,
+                group=self.model, pathstack=self._pathstack,
+                pathpars=pathpars)
 
         diff  = (self.__chi - self.model.chi)
         if data_only:  # for extracting transformed data separately from residual
             diff  = self.__chi
-        trans = self.transform
-        k     = trans.k_[:len(diff)]
+        out = _transform_residual(diff, self.transform,
+                                  self.epsilon_k, self.epsilon_r)
+        self._add_timing(t1-t0, time.time()-t1)
+        return out
+
+    def _jacobian(self, pathpars, dpathpars):
+        """return the Jacobian of the residual for this data set,
+        shape (len(residual), nvarys), given the path parameter values
+        and their derivatives dpathpars (nvarys, npaths, 8) with respect
+        to the fit variables.
+
+        The derivatives of chi(k) for each path are calculated
+        analytically, and since the transform of (data - model) is
+        linear, each column is the transform of -d(model)/d(variable).
+        """
+        cchi, dchi = self._pathstack.calc_chi_deriv(self.model.k, pathpars)
+        dmodel = np.einsum('vpj,pjk->vk', dpathpars, dchi.imag)
+        return np.array([-_transform_residual(dm, self.transform,
+                                              self.epsilon_k, self.epsilon_r)
+                         for dm in dmodel]).T
+
+    def _pathparams(self, paramgroup):
+        """evaluate path parameters for all paths in the pathlist.
+        This uses the shared fiteval namespace, and so must be run
+        in the main thread."""
+        return _pathlist_params(self.pathlist, paramgroup=paramgroup,
+                                _larch=self._larch)
+
+    def _residual_kernel(self):
+        """return a picklable _ResidualKernel for this dataset, for
+        evaluating the residual from path parameter values in worker
+        threads or processes"""
+        if not self.__prepared:
+            self.prepare_fit()
+        trans = copy(self.transform)
+        trans._larch = None
+        return _ResidualKernel(self._pathstack, self.model.k, self.__chi,
+                               trans, self.epsilon_k, self.epsilon_r)
+
+    def reset_timing(self):
+        """reset timing for residual evaluations:
+           timing.nevals   number of residual evaluations
+           timing.params   time (sec) evaluating path parameters
+           timing.model    time (sec) summing paths and transforming
+        """
+        self.timing = Group(nevals=0, params=0.0, model=0.0)
 
-        all_kweights = isinstance(trans.kweight, Iterable)
-        if trans.fitspace == 'k':
-            iqmin = max(0, int(0.01 + trans.kmin/trans.kstep))
-            iqmax = min(trans.nfft/2,  int(0.01 + trans.kmax/trans.kstep))
-            if all_kweights:
-                out = []
-                for i, kw in enumerate(trans.kweight):
-                    out.append(((diff/eps_k[i])*k**kw)[iqmin:iqmax])
-                return np.concatenate(out)
-            else:
-                return ((diff/eps_k) * k**trans.kweight)[iqmin:iqmax]
-        elif trans.fitspace == 'w':
-            if all_kweights:
-                out = []
-                for i, kw in enumerate(trans.kweight):
-                    cwt = trans.cwt(diff/eps_k, kweight=kw)
-                    out.append(realimag(cwt).ravel())
-                return np.concatenate(out)
-            else:
-                cwt = trans.cwt(diff/eps_k, kweight=trans.kweight)
-                return realimag(cwt).ravel()
-        else: # 'r' space
-            out = []
-            if all_kweights:
-                chir = [trans.fftf(diff, kweight=kw) for kw in trans.kweight]
-                eps_r = self.epsilon_r
-            else:
-                chir = [trans.fftf(diff)]
-                eps_r = [self.epsilon_r]
-            if trans.fitspace == 'r':
-                irmin = max(0, int(0.01 + trans.rmin/trans.rstep))
-                irmax = min(trans.nfft/2,  int(0.01 + trans.rmax/trans.rstep))
-                for i, chir_ in enumerate(chir):
-                    chir_ = chir_ / (eps_r[i])
-                    out.append(realimag(chir_[irmin:irmax]))
-            else:
-                chiq = [trans.fftr(c)/eps for c, eps in zip(chir, eps_r)]
-                iqmin = max(0, int(0.01 + trans.kmin/trans.kstep))
-                iqmax = min(trans.nfft/2,  int(0.01 + trans.kmax/trans.kstep))
-                for chiq_ in chiq:
-                    out.append( realimag(chiq_[iqmin:iqmax])[::2])
-            return np.concatenate(out)
+    def _add_timing(self, tparams, tmodel):
+        self.timing.nevals += 1
+        self.timing.params += tparams
+        self.timing.model  += tmodel
 
     def save_ffts(self, rmax_out=10, path_outputs=True):
         "save fft outputs"
@@ -441,6 +458,172 @@ class FeffitDataSet(Group):
             for p in self.pathlist:
                 xft(p.chi, group=p, rmax_out=rmax_out)
 
+def _transform_residual(diff, trans, eps_k, eps_r):
+    """apply transform to the difference of data and model chi(k),
+    scaled by the uncertainties eps_k and eps_r, returning the
+    residual array for a fit in the transform's fitspace.
+    """
+    if isinstance(eps_k, np.ndarray):
+        eps_k[np.where(eps_k<1.e-12)[0]] = 1.e-12
+
+    k     = trans.k_[:len(diff)]
+
+    all_kweights = isinstance(trans.kweight, Iterable)
+    if trans.fitspace == 'k':
+        iqmin = max(0, int(0.01 + trans.kmin/trans.kstep))
+        iqmax = min(trans.nfft/2,  int(0.01 + trans.kmax/trans.kstep))
+        if all_kweights:
+            out = []
+            for i, kw in enumerate(trans.kweight):
+                out.append(((diff/eps_k[i])*k**kw)[iqmin:iqmax])
+            return np.concatenate(out)
+        else:
+            return ((diff/eps_k) * k**trans.kweight)[iqmin:iqmax]
+    elif trans.fitspace == 'w':
+        if all_kweights:
+            out = []
+            for i, kw in enumerate(trans.kweight):
+                cwt = trans.cwt(diff/eps_k, kweight=kw)
+                out.append(realimag(cwt).ravel())
+            return np.concatenate(out)
+        else:
+            cwt = trans.cwt(diff/eps_k, kweight=trans.kweight)
+            return realimag(cwt).ravel()
+    else: # 'r' space
+        out = []
+        if all_kweights:
+            # all k-weights in a single FFT call
+            chir = trans.fftf(diff, kweight=list(trans.kweight))
+        else:
+            chir = [trans.fftf(diff)]
+            eps_r = [eps_r]
+        if trans.fitspace == 'r':
+            irmin = max(0, int(0.01 + trans.rmin/trans.rstep))
+            irmax = min(trans.nfft/2,  int(0.01 + trans.rmax/trans.rstep))
+            for i, chir_ in enumerate(chir):
+                chir_ = chir_ / (eps_r[i])
+                out.append(realimag(chir_[irmin:irmax]))
+        else:
+            chiq = [c/eps for c, eps in zip(trans.fftr(np.array(chir)), eps_r)]
+            iqmin = max(0, int(0.01 + trans.kmin/trans.kstep))
+            iqmax = min(trans.nfft/2,  int(0.01 + trans.kmax/trans.kstep))
+            for chiq_ in chiq:
+                out.append( realimag(chiq_[iqmin:iqmax])[::2])
+        return np.concatenate(out)
+
+def _pathparam_derivs(params, paramgroup, datasets, var_names):
+    """derivatives of the path parameters for each dataset with respect
+    to the fit variables, as list of arrays (nvarys, npaths, 8).
+
+    Path parameters can be any constraint expression of the variables,
+    so these are found by central differences of the path parameter
+    values (not of chi(k)), updating constrained parameters as for
+    each evaluation of the residual.
+    """
+    out = [np.zeros((len(var_names),) + ds._pathstack.reff.shape +
+                    (len(PATH_PARS),)) for ds in datasets]
+    for ivar, name in enumerate(var_names):
+        par = params[name]
+        val0 = par.value
+        step = 1.e-5*max(abs(val0), 1.e-2)
+        vals = []
+        for val in (min(val0 + step, par.max), max(val0 - step, par.min)):
+            par.value = val
+            params.update_constraints()
+            params2group(params, paramgroup)
+            vals.append([ds._pathparams(paramgroup) for ds in datasets])
+        par.value = val0
+        delta = (min(val0 + step, par.max) - max(val0 - step, par.min))
+        for ids in range(len(datasets)):
+            out[ids][ivar] = (vals[0][ids] - vals[1][ids]) / delta
+    params.update_constraints()
+    params2group(params, paramgroup)
+    return out
+
+class _ResidualKernel(object):
+    """the part of a FeffitDataSet residual that depends only on the
+    values of the path parameters: the sum of paths with a FeffPathStack
+    and the transform of data - model.  This holds no reference to the
+    Larch interpreter, and can be pickled to worker processes."""
+    def __init__(self, pathstack, k, chi, transform, epsilon_k, epsilon_r):
+        self.pathstack = pathstack
+        self.k = k
+        self.chi = chi
+        self.transform = transform
+        self.epsilon_k = epsilon_k
+        self.epsilon_r = epsilon_r
+
+    def __call__(self, pathpars):
+        cchi, p = self.pathstack.calc_chi(self.k, pathpars)
+        return _transform_residual(self.chi - cchi.imag.sum(axis=0),
+                                   self.transform, self.epsilon_k,
+                                   self.epsilon_r)
+
+def _timed_kernel(args):
+    "evaluate kernel(pathpars), returning residual and elapsed time"
+    kernel, pathpars = args
+    t0 = time.time()
+    out = kernel(pathpars)
+    return out, time.time()-t0
+
+_WORKER_KERNELS = []
+def _init_worker(kernels):
+    "initializer for feffit worker processes"
+    global _WORKER_KERNELS
+    _WORKER_KERNELS = kernels
+
+def _worker_kernel(args):
+    "evaluate residual kernel by index in a feffit worker process"
+    index, pathpars = args
+    return _timed_kernel((_WORKER_KERNELS[index], pathpars))
+
+class _ParallelResidual(object):
+    """evaluate the residuals for a list of FeffitDataSets concurrently.
+
+    Path parameters are evaluated serially in the main thread (they
+    use the shared fiteval namespace), then the sum of paths and
+    transform for each dataset are run in a pool of worker threads
+    (executor='thread') or processes (executor='process').  The
+    results are identical to serial evaluation.
+    """
+    def __init__(self, datasets, executor='thread', nworkers=None):
+        self.datasets = datasets
+        kernels = [ds._residual_kernel() for ds in datasets]
+        if nworkers is None:
+            nworkers = min(len(datasets), mp.cpu_count())
+        self.use_threads = executor.lower().startswith('thread')
+        if self.use_threads:
+            self.kernels = kernels
+            self.pool = ThreadPool(nworkers)
+        else:
+            self.kernels = None
+            self.pool = mp.Pool(nworkers, initializer=_init_worker,
+                                initargs=(kernels,))
+
+    def __call__(self, paramgroup):
+        tasks, tparams = [], []
+        for i, ds in enumerate(self.datasets):
+            t0 = time.time()
+            pathpars = ds._pathparams(paramgroup)
+            tparams.append(time.time()-t0)
+            if self.use_threads:
+                tasks.append((self.kernels[i], pathpars))
+            else:
+                tasks.append((i, pathpars))
+        if self.use_threads:
+            results = self.pool.map(_timed_kernel, tasks)
+        else:
+            results = self.pool.map(_worker_kernel, tasks)
+        out = []
+        for ds, tpar, (resid, tmodel) in zip(self.datasets, tparams, results):
+            ds._add_timing(tpar, tmodel)
+            out.append(resid)
+        return concatenate(out)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
 @ValidateLarchPlugin
 def feffit_dataset(data=None, pathlist=None, transform=None,
                    epsilon_k=None, _larch=None):
@@ -491,7 +674,9 @@ def feffit_transform(_larch=None, **kws):
     return TransformGroup(_larch=_larch, **kws)
 
 @ValidateLarchPlugin
-def feffit(paramgroup, datasets, rmax_out=10, path_outputs=True, _larch=None, **kws):
+def feffit(paramgroup, datasets, rmax_out=10, path_outputs=True,
+           executor=None, nworkers=None, analytic_jacobian=False,
+           _larch=None, **kws):
     """execute a Feffit fit: a fit of feff paths to a list of datasets
 
     Parameters:
@@ -500,6 +685,13 @@ def feffit(paramgroup, datasets, rmax_out=10, path_outputs=True, _larch=None, **
       datasets:     Feffit Dataset group or list of Feffit Dataset group.
       rmax_out:     maximum R value to calculate output arrays.
       path_output:  Flag to set whether all Path outputs should be written.
+      executor:     None, 'thread', or 'process': how to evaluate the
+                    residuals of multiple datasets [None: serially]
+      nworkers:     number of worker threads or processes [None:
+                    number of datasets, up to the number of CPUs]
+      analytic_jacobian: whether to calculate the Jacobian from the
+                    derivatives of the XAFS equation instead of by
+                    finite differences of the full model [False]
 
     Returns:
     ---------
@@ -520,15 +712,45 @@ def feffit(paramgroup, datasets, rmax_out=10, path_outputs=True, _larch=None, **
         chir_pha     phase of chi(R).
         chir_re      real part of chi(R).
         chir_im      imaginary part of chi(R).
+
+     Each dataset will also have a 'timing' subgroup, with the number
+     of residual evaluations (nevals) and the time in seconds spent
+     evaluating path parameters (params) and summing paths and
+     transforming (model), to show which datasets dominate the fit.
+
+     With executor='thread' or 'process', the datasets are evaluated
+     concurrently, with identical results to serial evaluation.  Path
+     parameters are still evaluated in the main thread.
+
+     With analytic_jacobian=True, the derivatives of chi(k) with respect
+     to s02, e0, deltar, sigma2, third, fourth (and degen, ei) for all
+     paths are calculated analytically and propagated through the
+     transform, so each Jacobian evaluation needs one calculation of
+     chi(k) instead of one per variable.  Derivatives of path parameters
+     with respect to variables are found from their constraint
+     expressions.
     """
 
 
-    def _resid(params, datasets=None, paramgroup=None,
+    def _resid(params, datasets=None, paramgroup=None, parallel=None,
                _larch=None, **kwargs):
         """ this is the residual function"""
         params2group(params, paramgroup)
+        if parallel is not None:
+            return parallel(paramgroup)
         return concatenate([d._residual(paramgroup) for d in datasets])
 
+    def _jacob(params, datasets=None, paramgroup=None, _larch=None,
+               **kwargs):
+        """ analytic Jacobian of the residual function"""
+        var_names = [name for name, par in params.items()
+                     if par.vary and par.expr is None]
+        params2group(params, paramgroup)
+        pathpars = [d._pathparams(paramgroup) for d in datasets]
+        dpathpars = _pathparam_derivs(params, paramgroup, datasets, var_names)
+        return concatenate([d._jacobian(p, dp) for d, p, dp in
+                            zip(datasets, pathpars, dpathpars)])
+
     if isNamedClass(datasets, FeffitDataSet):
         datasets = [datasets]
 
@@ -539,13 +761,30 @@ def feffit(paramgroup, datasets, rmax_out=10, path_outputs=True, _larch=None, **
             print( "feffit needs a list of FeffitDataSets")
             return
         ds.prepare_fit()
+        ds.reset_timing()
+
+    parallel = None
+    if executor is not None:
+        if executor.lower()[:6] not in ('thread', 'proces'):
+            print("feffit executor must be None, 'thread', or 'process'")
+            return
+        parallel = _ParallelResidual(datasets, executor=executor,
+                                     nworkers=nworkers)
 
     fit = Minimizer(_resid, params,
                     fcn_kws=dict(datasets=datasets,
-                                 paramgroup=paramgroup),
+                                 paramgroup=paramgroup,
+                                 parallel=parallel),
                     scale_covar=True, **kws)
 
-    result = fit.leastsq()
+    leastsq_kws = {}
+    if analytic_jacobian:
+        leastsq_kws['Dfun'] = _jacob
+    try:
+        result = fit.leastsq(**leastsq_kws)
+    finally:
+        if parallel is not None:
+            parallel.close()
 
     params2group(result.params, paramgroup)
     dat = concatenate([d._residual(paramgroup, data_only=True) for d in datasets])
@@ -807,24 +1046,7 @@ def sigma2_eins(t, theta):
 def sigma2_debye(t, theta):
     if feffpath is None:
          return 0.
-
-    if theta < 1.e-5: theta = 1.e-5
-    if t < 1.e-5:     t = 1.e-5
-
-    tempk  = float(t)
-    thetad = float(theta)
-
-    natoms = len(feffpath.geom)
-    rnorm  = feffpath.rnorman
-    atomx, atomy, atomz, atomm = [], [], [], []
-    for sym, iz, ipot, am, x, y, z in feffpath.geom:
-        atomx.append(x)
-        atomy.append(y)
-        atomz.append(z)
-        atomm.append(am)
-
-    return sigma2_correldebye(natoms, tempk, thetad, rnorm,
-                              atomx, atomy, atomz, atomm)
+    return sigma2_debye_feffdat(t, theta, feffpath)
 """
 
 def initializeLarchPlugin(_larch=None):
@@ -839,6 +1061,7 @@ def initializeLarchPlugin(_larch=None):
     add(('const_kboltz', constants.k))
     add(('const_amu', constants.atomic_mass))
     add(('sigma2_correldebye', sigma2_correldebye))
+    add(('sigma2_debye_feffdat', sigma2_debye_feffdat))
     add(sigma2xafs_)
 
 def registereLarchGroups():
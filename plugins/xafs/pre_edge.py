@@ -3,6 +3,7 @@
   XAFS pre-edge subtraction, normalization algorithms
 """
 
+import multiprocessing as mp
 import numpy as np
 from scipy import polyfit
 from scipy.signal import find_peaks_cwt
@@ -328,6 +329,274 @@ def pre_edge(energy, mu=None, group=None, e0=None, step=None,
     return
 
 
+def _index_of_sorted(array, values):
+    "index_of() for an increasing array and an array of values"
+    return np.maximum(0, np.searchsorted(array, values, side='right') - 1)
+
+def _index_nearest_sorted(array, values):
+    "index_nearest() for an increasing array and an array of values"
+    values = np.asarray(values)
+    ihi = np.clip(np.searchsorted(array, values), 0, len(array)-1)
+    ilo = np.maximum(0, ihi - 1)
+    use_lo = abs(array[ilo] - values) <= abs(array[ihi] - values)
+    return np.where(use_lo, ilo, ihi)
+
+def _polyfit_matrix(x, deg):
+    """return matrix M of shape (deg+1, len(x)) for which M.dot(y) gives
+    the coefficients of polyfit(x, y, deg), highest power first.  Like
+    polyfit(), the columns of the Vandermonde matrix are scaled."""
+    lhs = np.vander(x, deg+1)
+    scale = np.sqrt((lhs*lhs).sum(axis=0))
+    rcond = len(x)*np.finfo(x.dtype).eps
+    return np.linalg.pinv(lhs/scale, rcond=rcond) / scale[:, np.newaxis]
+
+def _find_e0_index(dmu):
+    """index of e0 for each row of a 2-d array of d(mu)/dE, following
+    find_e0(): the highest derivative at a point whose neighbors also
+    have a derivative above 5% of the maximum derivative"""
+    high = dmu > np.nanmax(dmu, axis=1)[:, np.newaxis]*0.05
+    valid = np.zeros(high.shape, dtype=bool)
+    valid[:, 1:-1] = high[:, 1:-1] & high[:, :-2] & high[:, 2:]
+    dmu_valid = np.where(valid, dmu, 0)
+    idx = dmu_valid.argmax(axis=1)
+    idx[dmu_valid.max(axis=1) <= 0] = 0
+    return idx
+
+def preedge_batch(energy, mu, e0=None, step=None, nnorm=2, nvict=0,
+                  pre1=None, pre2=-50, norm1=100, norm2=None,
+                  make_flat=True, _design=None):
+    """pre edge subtraction, normalization for many XAFS spectra sharing
+    an energy array (straight python).
+
+    This follows preedge() (and the flattening of pre_edge()) for each
+    spectrum, but does the regressions for all spectra as matrix
+    products: spectra with the same fit ranges share one precomputed
+    least-squares matrix for each of the pre-edge line, post-edge
+    polynomial, and flattening quadratic.
+
+    Arguments
+    ----------
+    energy:  1-d array of x-ray energies, in eV
+    mu:      2-d array of mu(E), shape (nspectra, len(energy))
+    e0:      edge energy, in eV, or array of e0 for each spectrum.
+             If None, it will be determined here for each spectrum.
+    step:    edge jump, or array of edge jumps.  If None, it will be
+             determined here for each spectrum.
+    other arguments are as for preedge()
+
+    Returns
+    -------
+      dictionary of arrays, with one row (or value) per spectrum:
+          e0, edge_step, norm, flat, pre_edge, post_edge, dmude,
+          pre_slope, pre_offset, norm_coefs, nnorm, pre1, pre2,
+          norm1, norm2
+
+    Notes
+    -----
+      Spectra containing NaN or Inf are processed one at a time with
+      preedge().
+    """
+    energy = remove_dups(np.asarray(energy, dtype='float64'))
+    mu = np.atleast_2d(np.asarray(mu, dtype='float64'))
+    nspec, npts = mu.shape
+    if _design is None:
+        _design = {}
+
+    def design(i1, i2, deg):
+        key = (i1, i2, deg)
+        if key not in _design:
+            _design[key] = _polyfit_matrix(energy[i1:i2], deg)
+        return _design[key]
+
+    dmude = np.gradient(mu, axis=1)/np.gradient(energy)
+    ie0 = _find_e0_index(dmude)
+    e0_input = e0
+    if e0 is not None:
+        e0 = np.ones(nspec)*e0
+        use = (e0 >= energy[0]) & (e0 <= energy[-1])
+        ie0[use] = _index_nearest_sorted(energy, e0[use])
+    e0 = energy[ie0]
+
+    # spectra with NaN or Inf are done with preedge()
+    finite = np.isfinite(mu).all(axis=1)
+    nonfinite = {}
+    for i in np.where(~finite)[0]:
+        e0_i = e0_input
+        if e0_input is not None and not np.isscalar(e0_input):
+            e0_i = e0_input[i]
+        nonfinite[i] = preedge(energy, mu[i], e0=e0_i, step=None,
+                               nnorm=nnorm, nvict=nvict, pre1=pre1,
+                               pre2=pre2, norm1=norm1, norm2=norm2)
+        e0[i] = nonfinite[i]['e0']
+        ie0[i] = _index_nearest_sorted(energy, e0[i])
+
+    emin, emax = energy[0], energy[-1]
+    nnorm = max(min(nnorm, MAX_NNORM), 0)
+    vpre1 = emin - e0 if pre1 is None else np.maximum(pre1, emin - e0)
+    vpre2 = pre2 * np.ones(nspec)
+    vnorm1 = norm1 * np.ones(nspec)
+    if norm2 is None:
+        vnorm2 = emax - e0
+    elif norm2 < 0:
+        vnorm2 = emax - e0 - norm2
+    else:
+        vnorm2 = norm2 * np.ones(nspec)
+    vnorm2 = np.minimum(vnorm2, emax - e0)
+    swap = vpre1 > vpre2
+    vpre1, vpre2 = np.where(swap, vpre2, vpre1), np.where(swap, vpre1, vpre2)
+    swap = vnorm1 > vnorm2
+    vnorm1, vnorm2 = (np.where(swap, vnorm2, vnorm1),
+                      np.where(swap, vnorm1, vnorm2))
+
+    pa = _index_of_sorted(energy, vpre1 + e0)
+    pb = _index_nearest_sorted(energy, vpre2 + e0)
+    pb = np.where(pb - pa < 2, np.minimum(npts, pa + 2), pb)
+    na = _index_of_sorted(energy, vnorm1 + e0)
+    nb = _index_nearest_sorted(energy, vnorm2 + e0)
+    nb = np.where(nb - na < 2, np.minimum(npts, na + 2), nb)
+    # reduce dimension to linear if less than 75 eV given
+    vnnorm = np.where(abs(vnorm2 - vnorm1) < 75.0, min(nnorm, 1), nnorm)
+
+    pre_edge = np.zeros((nspec, npts))
+    post_edge = np.zeros((nspec, npts))
+    precoefs = np.zeros((nspec, 2))
+    norm_coefs = np.zeros((nspec, MAX_NNORM+1))
+    omu = mu*energy**nvict
+    evict = energy**(-nvict)
+
+    ranges = np.column_stack((pa, pb, na, nb, vnnorm))
+    keys, inverse = np.unique(ranges[finite], axis=0, return_inverse=True)
+    rows_finite = np.where(finite)[0]
+    for ikey, (i1, i2, j1, j2, nn) in enumerate(keys):
+        rows = rows_finite[inverse.ravel() == ikey]
+        pc = omu[rows, i1:i2].dot(design(i1, i2, 1).T)
+        nc = omu[rows, j1:j2].dot(design(j1, j2, nn).T)
+        precoefs[rows] = pc
+        norm_coefs[rows, :nn+1] = nc[:, ::-1]
+        pre_edge[rows] = (pc[:, :1]*energy + pc[:, 1:]) * evict
+        post_edge[rows] = nc.dot(np.vander(energy, nn+1).T) * evict
+
+    for i, out in nonfinite.items():
+        pre_edge[i] = out['pre_edge']
+        post_edge[i] = out['post_edge']
+        precoefs[i] = out['precoefs']
+        norm_coefs[i, :len(out['norm_coefs'])] = out['norm_coefs']
+
+    irow = np.arange(nspec)
+    edge_step = post_edge[irow, ie0] - pre_edge[irow, ie0]
+    if step is not None:
+        edge_step = step * np.ones(nspec)
+    norm = (mu - pre_edge)/edge_step[:, np.newaxis]
+
+    # generate flattened spectra, by fitting a quadratic to .norm
+    # and removing that.
+    flat = norm.copy()
+    if make_flat:
+        for i1, i2 in np.unique(np.column_stack((na, nb)), axis=0):
+            if i2 - i1 <= 4:
+                continue
+            rows = np.where((na == i1) & (nb == i2))[0]
+            fc = norm[rows, i1:i2].dot(design(i1, i2, 2).T)
+            bad = ~np.isfinite(fc).all(axis=1)
+            for j in np.where(bad)[0]:
+                enx, mux = remove_nans2(energy[i1:i2], norm[rows[j], i1:i2])
+                fc[j] = polyfit(enx, mux, 2)
+            flat_diff = fc.dot(np.vander(energy, 3).T)
+            flat[rows] = (norm[rows] - flat_diff +
+                          flat_diff[np.arange(len(rows)), ie0[rows]][:, np.newaxis])
+        below_e0 = np.arange(npts) < ie0[:, np.newaxis]
+        flat[below_e0] = norm[below_e0]
+
+    return {'e0': e0, 'edge_step': edge_step, 'norm': norm, 'flat': flat,
+            'pre_edge': pre_edge, 'post_edge': post_edge, 'dmude': dmude,
+            'pre_slope': precoefs[:, 0], 'pre_offset': precoefs[:, 1],
+            'norm_coefs': norm_coefs, 'nnorm': vnnorm,
+            'pre1': vpre1, 'pre2': vpre2, 'norm1': vnorm1, 'norm2': vnorm2}
+
+def _preedge_batch_chunk(args):
+    "run preedge_batch() on one chunk of spectra, for multiprocessing"
+    energy, mu, kws = args
+    return preedge_batch(energy, mu, **kws)
+
+@ValidateLarchPlugin
+def pre_edge_batch(energy, mu, group=None, e0=None, step=None, nnorm=3,
+                   nvict=0, pre1=None, pre2=-50, norm1=100, norm2=None,
+                   make_flat=True, chunksize=4096, nproc=1, _larch=None):
+    """pre edge subtraction, normalization for a stack of XAFS spectra
+    that share one energy array, as from quick-XAS or XANES mapping.
+
+    This performs the same steps as pre_edge() on each spectrum, but
+    with all regressions done as matrix products over many spectra at
+    once, and writes stacked arrays to a single output group.
+
+    Arguments
+    ----------
+    energy:    1-d array of x-ray energies, in eV
+    mu:        2-d array of mu(E), shape (nspectra, len(energy))
+    group:     output group
+    e0:        edge energy, or array of e0 for each spectrum.  If None,
+               e0 will be determined for each spectrum.
+    step:      edge jump, or array of edge jumps.  If None, it will be
+               determined for each spectrum.
+    chunksize: number of spectra to process at a time [4096]
+    nproc:     number of processes to use for chunks [1]
+    other arguments are as for pre_edge()
+
+    Returns
+    -------
+      group with arrays, each with one row (or value) per spectrum:
+        e0          energy origin
+        edge_step   edge step
+        norm        normalized mu(E)
+        flat        flattened, normalized mu(E)  (if make_flat=True)
+        pre_edge    determined pre-edge curve
+        post_edge   determined post-edge, normalization curve
+        dmude       derivative of mu(E)
+        pre_slope, pre_offset, norm_coefs, nnorm, pre1, pre2, norm1, norm2
+                    details of the pre-edge and normalization fits
+      and 'energy', the (shared) energy array.
+    """
+    energy = remove_dups(np.asarray(energy, dtype='float64'))
+    mu = np.atleast_2d(np.asarray(mu, dtype='float64'))
+    nspec = mu.shape[0]
+    chunksize = max(1, int(chunksize))
+
+    def chunkval(val, i0, i1):
+        if val is None or np.isscalar(val):
+            return val
+        return np.asarray(val)[i0:i1]
+
+    kws = dict(nnorm=nnorm, nvict=nvict, pre1=pre1, pre2=pre2,
+               norm1=norm1, norm2=norm2, make_flat=make_flat)
+    tasks = []
+    for i0 in range(0, nspec, chunksize):
+        i1 = min(nspec, i0 + chunksize)
+        ckws = dict(e0=chunkval(e0, i0, i1), step=chunkval(step, i0, i1))
+        ckws.update(kws)
+        tasks.append((energy, mu[i0:i1], ckws))
+
+    if nproc > 1 and len(tasks) > 1:
+        pool = mp.Pool(min(nproc, len(tasks)))
+        try:
+            results = pool.map(_preedge_batch_chunk, tasks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        design = {}
+        results = [preedge_batch(en, mux, _design=design, **ckws)
+                   for en, mux, ckws in tasks]
+
+    if group is None:
+        group = Group()
+    group.energy = energy
+    for key in results[0]:
+        if key == 'flat' and not make_flat:
+            continue
+        setattr(group, key, np.concatenate([r[key] for r in results]))
+    return group
+
 @ValidateLarchPlugin
 @Make_CallArgs(["energy", "norm"])
 def pre_edge_baseline(energy, norm=None, group=None, form='lorentzian',
@@ -499,4 +768,5 @@ def pre_edge_baseline(energy, norm=None, group=None, form='lorentzian',
 def registerLarchPlugin():
     return (MODNAME, {'find_e0': find_e0,
                       'pre_edge': pre_edge,
+                      'pre_edge_batch': pre_edge_batch,
                       'pre_edge_baseline': pre_edge_baseline})
@@ -16,6 +16,9 @@ EINS_FACTOR = 1.e20*consts.hbar**2/(2*consts.k*consts.atomic_mass)
 
 FEFF6LIB = None
 
+MAX_CACHED_SIGMA2 = 8192
+_sigma2_cache = {}
+
 @ValidateLarchPlugin
 def sigma2_eins(t, theta, path=None, _larch=None):
     """calculate sigma2 for a Feff Path wih the einstein model
@@ -80,24 +83,79 @@ def sigma2_debye(t, theta, path=None, _larch=None):
 
     if feffpath is None:
         return 0.
+    return sigma2_debye_feffdat(t, theta, feffpath)
 
-    if theta < 1.e-5: theta = 1.e-5
-    if t < 1.e-5:     t = 1.e-5
+@ValidateLarchPlugin
+def sigma2_debye_pathlist(t, theta, pathlist, _larch=None):
+    """calculate sigma2 with the correlated Debye model for a list of
+    Feff Paths at once
+
+    sigma2 = sigma2_debye_pathlist(t, theta, pathlist)
+
+    Parameters:
+    -----------
+      t        sample temperature (in K)
+      theta    Debye temperature (in K)
+      pathlist list of FeffPaths
 
-    tempk  = float(t)
-    thetad = float(theta)
+    Returns:
+    --------
+      array of sigma2, one per path
 
-    natoms = len(feffpath.geom)
-    rnorm  = feffpath.rnorman
-    atomx, atomy, atomz, atomm = [], [], [], []
-    for sym, iz, ipot, am, x, y, z in feffpath.geom:
-        atomx.append(x)
-        atomy.append(y)
-        atomz.append(z)
-        atomm.append(am)
+    Notes:
+       the pairwise sums for all paths not already calculated are done
+       together, and the results are saved, so that later calls to
+       sigma2_debye() for these paths with the same t and theta are free.
+    """
+    return sigma2_debye_feffdats(t, theta, [p._feffdat for p in pathlist])
 
-    return sigma2_correldebye(natoms, tempk, thetad, rnorm,
-                              atomx, atomy, atomz, atomm)
+def _geom_key(feffdat):
+    """hashable description of the geometry of a FeffDatFile"""
+    return (feffdat.rnorman,
+            tuple((am, x, y, z) for sym, iz, ipot, am, x, y, z in feffdat.geom))
+
+def _clamp_temps(t, theta):
+    if theta < 1.e-5: theta = 1.e-5
+    if t < 1.e-5:     t = 1.e-5
+    return float(t), float(theta)
+
+def sigma2_debye_feffdat(t, theta, feffdat):
+    """
+    sigma2 for a FeffDatFile with the correlated Debye model,
+    memoized on (geometry, t, theta)
+    """
+    tempk, thetad = _clamp_temps(t, theta)
+    key = (_geom_key(feffdat), tempk, thetad)
+    if key not in _sigma2_cache:
+        rnorm, geom = key[0]
+        atomm, atomx, atomy, atomz = zip(*geom)
+        if len(_sigma2_cache) >= MAX_CACHED_SIGMA2:
+            _sigma2_cache.clear()
+        _sigma2_cache[key] = sigma2_correldebye(len(geom), tempk, thetad,
+                                                rnorm, atomx, atomy, atomz,
+                                                atomm)
+    return _sigma2_cache[key]
+
+def sigma2_debye_feffdats(t, theta, feffdats):
+    """
+    sigma2 for a list of FeffDatFiles with the correlated Debye model,
+    with all uncached paths calculated together.
+    """
+    tempk, thetad = _clamp_temps(t, theta)
+    keys = [(_geom_key(fdat), tempk, thetad) for fdat in feffdats]
+    todo = list(set([key for key in keys if key not in _sigma2_cache]))
+    if len(todo) > 0:
+        geoms = []
+        for key in todo:
+            rnorm, geom = key[0]
+            atomm, atomx, atomy, atomz = zip(*geom)
+            geoms.append((rnorm, atomx, atomy, atomz, atomm))
+        sig2 = _correldebye_geoms(geoms, tempk, thetad)
+        if len(_sigma2_cache) + len(todo) > MAX_CACHED_SIGMA2:
+            _sigma2_cache.clear()
+        for key, val in zip(todo, sig2):
+            _sigma2_cache[key] = val
+    return np.array([_sigma2_cache[key] for key in keys])
 
 def sigma2_correldebye(natoms, tk, theta, rnorm, x, y, z, atwt):
     """
@@ -121,7 +179,13 @@ def sigma2_correldebye(natoms, tk, theta, rnorm, x, y, z, atwt):
     global FEFF6LIB
     if FEFF6LIB is None:
         FEFF6LIB = get_dll('feff6')
-        FEFF6LIB.sigma2_debye.restype = ctypes.c_double
+        if FEFF6LIB is None:
+            FEFF6LIB = False
+        else:
+            FEFF6LIB.sigma2_debye.restype = ctypes.c_double
+    if not FEFF6LIB:
+        return sigma2_correldebye_np(natoms, tk, theta, rnorm,
+                                     x, y, z, atwt)
 
     na = ctypes.pointer(ctypes.c_int(natoms))
     t  = ctypes.pointer(ctypes.c_double(tk))
@@ -205,6 +269,68 @@ def sigma2_correldebye_py(natoms, tk, theta, rnorm, x, y, z, atwt):
     return sig2/2.0
 
 
+def sigma2_correldebye_np(natoms, tk, theta, rnorm, x, y, z, atwt):
+    """calculate the XAFS debye-waller factor for a path with the
+    correlated Debye model, as sigma2_correldebye_py(), but with
+    all atom pairs calculated together with numpy arrays.
+
+    Arguments:
+      natoms  *int, lengths for x, y, z, atwt        [in]
+      tk      *double, sample temperature (K)        [in]
+      theta   *double, Debye temperature (K)         [in]
+      rnorm   *double, Norman radius (Ang)           [in]
+      x       *double, array of x coord (Ang)        [in]
+      y       *double, array of y coord (Ang)        [in]
+      x       *double, array of z coord (Ang)        [in]
+      atwt    *double, array of atomic_weight (amu)  [in]
+
+   Returns:
+      sig2_cordby  double, calculated sigma2
+    """
+    geom = (rnorm, x[:natoms], y[:natoms], z[:natoms], atwt[:natoms])
+    return _correldebye_geoms([geom], tk, theta)[0]
+
+def _correldebye_geoms(geoms, tk, theta):
+    """correlated Debye sigma2 for a list of path geometries
+    (rnorm, x, y, z, atwt), with the pair terms of all paths
+    calculated together, and each distinct Debye integral done once.
+    """
+    ipath, rnorms, dists, masses, cosines = [], [], [], [], []
+    for ip, (rnorm, x, y, z, atwt) in enumerate(geoms):
+        pos = np.array([x, y, z], dtype='float64').T
+        atwt = np.asarray(atwt, dtype='float64')
+        natoms = len(atwt)
+        i0, j0 = np.triu_indices(natoms)
+        i1, j1 = (i0 + 1) % natoms, (j0 + 1) % natoms
+        pairs = ((i0, j0), (i1, j1), (i0, j1), (i1, j0))
+        dists.append(np.array([np.sqrt(((pos[a]-pos[b])**2).sum(axis=1))
+                               for a, b in pairs]))
+        masses.append(np.array([np.sqrt(atwt[a]*atwt[b]) for a, b in pairs]))
+        vi, vj = pos[i0] - pos[i1], pos[j0] - pos[j1]
+        ri0i1 = np.sqrt((vi*vi).sum(axis=1))
+        rj0j1 = np.sqrt((vj*vj).sum(axis=1))
+        # don't double count (i.eq.j) terms
+        cosines.append(np.where(i0 == j0, 0.5, 1.0) *
+                       (vi*vj).sum(axis=1) / (ri0i1*rj0j1))
+        rnorms.append(rnorm*np.ones(len(i0)))
+        ipath.append(ip*np.ones(len(i0), dtype='int'))
+
+    dists = np.concatenate(dists, axis=1)
+    masses = np.concatenate(masses, axis=1)
+    rnorms = np.concatenate(rnorms)
+    cosines = np.concatenate(cosines)
+    ipath = np.concatenate(ipath)
+
+    # corrfn() for all distances, with each distinct distance done once
+    conh = 72.7630804732553
+    conr = 4.5693349700844
+    rx = conr * dists / rnorms
+    urx, inverse = np.unique(rx, return_inverse=True)
+    corr = conh * debint_array(urx, theta/tk)[inverse.reshape(rx.shape)]
+    corr = corr / (theta * masses)
+
+    sig2ij = cosines * (corr[0] + corr[1] - corr[2] - corr[3])
+    return np.bincount(ipath, weights=sig2ij, minlength=len(geoms))/2.0
 
 def dist(x0, y0, z0, x1, y1, z1):
     """find distance between cartesian points
@@ -321,6 +447,55 @@ def debint(rx, tx):
         bo = result
     return result
 
+def debfun_array(w, rx, tx):
+    """ debye function, as debfun(), for arrays w and rx
+
+    debfun = (sin(w*rx)/rx) * coth(w*tx/2)
+    """
+    wmin = 1.e-20
+    argmax = 50.0
+    w, rx = np.broadcast_arrays(w, rx)
+    result = np.where(rx > 0, np.sin(w*rx)/np.where(rx > 0, rx, 1), w)
+    emwt = np.exp(-np.minimum(w*tx, argmax))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = result * (1 + emwt) / (1 - emwt)
+    return np.where(w > wmin, result, 2.0/tx)
+
+def debint_array(rx, tx, maxsize=2**20):
+    """ debint() for an array of rx, with romberg integration
+
+    all integrals are refined together, and each one is no longer
+    refined once it has converged, giving the same results as debint().
+    Arrays are limited to about maxsize elements at a time.
+    """
+    MAXITER = 12
+    tol = 1.e-9
+    rx = np.asarray(rx, dtype='float64')
+    bn = (debfun_array(0.0, rx, tx) + debfun_array(1.0, rx, tx))/2.0
+    bo = bn.copy()
+    result = np.zeros(len(rx))
+    active = np.arange(len(rx))
+    itn = 1
+    step = 1.0
+    for iter in range(MAXITER):
+        step = step / 2.
+        w = step*(2*np.arange(itn) + 1)
+        itn = 2*itn
+        nrows = max(1, maxsize // len(w))
+        sum = np.concatenate([debfun_array(w, rx[active[i:i+nrows], None],
+                                           tx).sum(axis=1)
+                              for i in range(0, len(active), nrows)])
+        bnp1 = step * sum + (bn[active] / 2.0)
+        result[active] = (4 * bnp1 - bn[active]) / 3.0
+        done = abs((result[active] - bo[active]) / result[active]) < tol
+        bn[active] = bnp1
+        bo[active] = result[active]
+        active = active[~done]
+        if len(active) == 0:
+            break
+    return result
+
 def registerLarchPlugin():
     return ('_xafs', {'sigma2_eins': sigma2_eins,
-                      'sigma2_debye': sigma2_debye})
+                      'sigma2_debye': sigma2_debye,
+                      'sigma2_debye_pathlist': sigma2_debye_pathlist})
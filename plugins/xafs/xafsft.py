@@ -2,13 +2,18 @@
 """
   XAFS Fourier transforms
 """
+import threading
 import numpy as np
 from numpy import (pi, arange, zeros, ones, sin, cos,
                    exp, log, sqrt, where, interp, linspace)
-# from numpy.fft import fft, ifft
-from scipy.fftpack import fft, ifft
 from scipy.special import i0 as bessel_i0
 
+# scipy.fft (scipy >= 1.4) caches FFT plans between calls
+try:
+    from scipy.fft import fft, ifft, rfft
+except ImportError:
+    from numpy.fft import fft, ifft, rfft
+
 from larch import (Group, ValidateLarchPlugin, Make_CallArgs,
                    parse_group_args)
 
@@ -18,6 +23,7 @@ from larch_plugins.xafs import set_xafsGroup
 
 MODNAME = '_xafs'
 VALID_WINDOWS = ['han', 'fha', 'gau', 'kai', 'par', 'wel', 'sin', 'bes']
+MAX_CACHED_WINDOWS = 64
 
 def ftwindow(x, xmin=None, xmax=None, dx=1, dx2=None,
              window='hanning', _larch=None, **kws):
@@ -314,9 +320,12 @@ def xftf_fast(chi, nfft=2048, kstep=0.05, _larch=None, **kws):
       complex 1-d array chi(R)
 
     """
-    cchi = zeros(nfft, dtype='complex128')
-    cchi[0:len(chi)] = chi
-    return (kstep / sqrt(pi)) * fft(cchi)[:int(nfft/2)]
+    nfft = int(nfft)
+    if np.iscomplexobj(chi):
+        out = fft(chi, n=nfft)
+    else:
+        out = rfft(chi, n=nfft)
+    return (kstep / sqrt(pi)) * out[:nfft//2]
 
 def xftr_fast(chir, nfft=2048, kstep=0.05, _larch=None, **kws):
     """
@@ -339,9 +348,137 @@ def xftr_fast(chir, nfft=2048, kstep=0.05, _larch=None, **kws):
 
     This is useful for repeated FTs, as inside loops.
     """
-    cchi = zeros(nfft, dtype='complex128')
-    cchi[0:len(chir)] = chir
-    return  (4*sqrt(pi)/kstep) * ifft(cchi)[:int(nfft/2)]
+    nfft = int(nfft)
+    return  (4*sqrt(pi)/kstep) * ifft(chir, n=nfft)[:nfft//2]
+
+
+class XAFSFTEngine(object):
+    """
+    forward and reverse XAFS Fourier transforms on a fixed (nfft, kstep)
+    grid, for repeated use inside fitting loops.
+
+    The engine keeps FT windows cached by their parameters and holds
+    work buffers (one set per thread) that are reused between calls,
+    so that neither window calculation nor array allocation is done
+    for every transform.  Forward transforms of real chi(k) use a
+    real-to-complex FFT, and several k-weights can be transformed with
+    a single FFT call.
+
+    Parameters:
+    ------------
+      nfft:     value to use for N_fft (2048).
+      kstep:    value to use for delta_k (0.05).
+    """
+    def __init__(self, nfft=2048, kstep=0.05):
+        self.nfft = int(nfft)
+        self.kstep = kstep
+        self.rstep = pi/(kstep*self.nfft)
+        self.k_ = kstep * arange(self.nfft, dtype='float64')
+        self.r_ = self.rstep * arange(self.nfft, dtype='float64')
+        self._windows = {}
+        self._kpows = {}
+        self._local = threading.local()
+
+    def __getstate__(self):
+        "work buffers are not pickled"
+        state = self.__dict__.copy()
+        state['_local'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def window(self, space='k', xmin=0, xmax=20, dx=1, dx2=None,
+               window='hanning'):
+        """return FT window on the k ('k') or R ('r') grid, cached
+        by (space, xmin, xmax, dx, dx2, window)"""
+        key = (space, xmin, xmax, dx, dx2, window)
+        win = self._windows.get(key, None)
+        if win is None:
+            x = self.r_ if space.startswith('r') else self.k_
+            win = ftwindow(x, xmin=xmin, xmax=xmax, dx=dx, dx2=dx2,
+                           window=window)
+            if len(self._windows) >= MAX_CACHED_WINDOWS:
+                self._windows = {}
+            self._windows[key] = win
+        return win
+
+    def kpow(self, kweight):
+        "return k_**kweight, cached by kweight"
+        kp = self._kpows.get(kweight, None)
+        if kp is None:
+            kp = self._kpows[kweight] = self.k_**kweight
+        return kp
+
+    def _buffer(self, name, nrows, npts, dtype):
+        """return work buffer of shape (nrows, nfft), reused between
+        calls from the same thread.  Values past npts are zeroed, the
+        first npts are to be filled in by the caller."""
+        buf = getattr(self._local, name, None)
+        if buf is None or buf.shape[0] != nrows or buf.dtype != dtype:
+            buf = zeros((nrows, self.nfft), dtype=dtype)
+            setattr(self._local, name, buf)
+        else:
+            buf[:, npts:] = 0
+        return buf
+
+    def fftf(self, chi, kwin=None, kweight=0):
+        """
+        forward FT of chi(k), on the k_ grid.
+
+        Parameters:
+        ------------
+          chi:      1-d array of chi(k), starting at k=0
+          kwin:     k window array (None for no window)
+          kweight:  exponent for k-weighting, or list of exponents
+
+        Returns:
+        --------
+          complex array of chi(R) of length nfft/2, or array of shape
+          (len(kweight), nfft/2) if kweight is a list.
+        """
+        single = not isinstance(kweight, (list, tuple, np.ndarray))
+        kweights = [kweight] if single else list(kweight)
+        npts = len(chi)
+        if kwin is not None:
+            chi = chi * kwin[:npts]
+
+        iscomplex = np.iscomplexobj(chi)
+        dtype = 'complex128' if iscomplex else 'float64'
+        buf = self._buffer('kbuf_%s' % dtype, len(kweights), npts, dtype)
+        for i, kw in enumerate(kweights):
+            np.multiply(chi, self.kpow(kw)[:npts], out=buf[i, :npts])
+        if iscomplex:
+            out = fft(buf, axis=-1)
+        else:
+            out = rfft(buf, axis=-1)
+        out = (self.kstep / sqrt(pi)) * out[:, :self.nfft//2]
+        return out[0] if single else out
+
+    def fftr(self, chir, rwin=None):
+        """
+        reverse FT of chi(R), on the r_ grid.
+
+        Parameters:
+        ------------
+          chir:     complex chi(R), 1-d or 2-d array with one chi(R) per row
+          rwin:     R window array (None for no window)
+
+        Returns:
+        --------
+          complex array of chi(q) of length nfft/2 (per row)
+        """
+        single = (chir.ndim == 1)
+        chir = np.atleast_2d(chir)
+        nrows, npts = chir.shape
+        buf = self._buffer('rbuf', nrows, npts, 'complex128')
+        if rwin is None:
+            buf[:, :npts] = chir
+        else:
+            np.multiply(chir, rwin[:npts], out=buf[:, :npts])
+        out = (4*sqrt(pi)/self.kstep) * ifft(buf, axis=-1)[:, :self.nfft//2]
+        return out[0] if single else out
 
 
 def registerLarchPlugin():
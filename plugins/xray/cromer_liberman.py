@@ -1,7 +1,8 @@
 import os
 import ctypes
+import hashlib
 import numpy as np
-from scipy.signal import convolve
+from scipy.signal import fftconvolve
 
 import larch
 from larch import  ValidateLarchPlugin
@@ -12,6 +13,76 @@ from larch_plugins.xray import core_width, atomic_number
 
 MODNAME = '_xray'
 CLLIB = None
+MAX_CACHED_F1F2 = 256
+_f1f2_cache = {}
+
+def _cl_f1f2(z, energies):
+    """f1, f2 from the cldata library for an element and energies,
+    passing numpy buffers to the library without copying"""
+    global CLLIB
+    if CLLIB is None:
+        CLLIB = get_dll('cldata')
+    en = np.ascontiguousarray(energies, dtype=np.float64)
+    f1 = np.zeros(len(en), dtype=np.float64)
+    f2 = np.zeros(len(en), dtype=np.float64)
+    p_double = ctypes.POINTER(ctypes.c_double)
+    CLLIB.f1f2(ctypes.byref(ctypes.c_int(int(z))),
+               ctypes.byref(ctypes.c_int(len(en))),
+               en.ctypes.data_as(p_double),
+               f1.ctypes.data_as(p_double),
+               f2.ctypes.data_as(p_double))
+    return f1, f2
+
+def _cl_f1f2_convolved(z, energies, width):
+    """f1, f2 from the cldata library, convolved with a lorentzian
+    of the given width, calculated on an evenly spaced energy grid
+    extending beyond the energies"""
+    en = np.asarray(energies, dtype=np.float64)
+    e_extra = int(width*80.0)
+    estep = (en[1:] - en[:-1]).min()
+    emin = min(en) - e_extra
+    emax = max(en) + e_extra
+
+    npts = 1 + int(abs(emax-emin+estep*0.02)/abs(estep))
+    egrid = np.linspace(emin, emax, npts)
+    nk   = int(e_extra / estep)
+    sig  = width/2.0
+    lor  = (1./(1 + ((np.arange(2*nk+1)-nk*1.0)/sig)**2))/(np.pi*sig)
+    scale = lor.sum()
+
+    f1, f2 = _cl_f1f2(z, egrid)
+    f1 = np.interp(en, egrid, fftconvolve(f1, lor, mode='same'))/scale
+    f2 = np.interp(en, egrid, fftconvolve(f2, lor, mode='same'))/scale
+    return f1, f2
+
+def _f1f2_element(z, en, width=None, edge=None, _larch=None):
+    "f1, f2 for one element, cached on (z, energies, width)"
+    if isinstance(z, np.integer):
+        z = int(z)
+    if not isinstance(z, int):
+        z  = atomic_number(z, _larch=_larch)
+        if z is None:
+            return None
+
+    if z > 92:
+        print( 'Cromer-Liberman data not available for Z>92')
+        return
+
+    if edge is not None or width is not None and _larch is not None:
+        natwid = core_width(element=z, edge=edge, _larch=_larch)
+        if width is None and natwid not in (None, []):
+            width = natwid
+
+    key = (z, width, len(en), hashlib.md5(en.tobytes()).hexdigest())
+    if key not in _f1f2_cache:
+        if len(_f1f2_cache) >= MAX_CACHED_F1F2:
+            _f1f2_cache.clear()
+        if width is not None: # will convolve!
+            _f1f2_cache[key] = _cl_f1f2_convolved(z, en, width)
+        else:
+            _f1f2_cache[key] = _cl_f1f2(z, en)
+    f1, f2 = _f1f2_cache[key]
+    return f1.copy(), f2.copy()
 
 @ValidateLarchPlugin
 def f1f2(z, energies, width=None, edge=None, _larch=None):
@@ -22,7 +93,7 @@ def f1f2(z, energies, width=None, edge=None, _larch=None):
 
     Parameters
     ----------
-    z:         atomic number of element
+    z:         atomic number of element, or list of atomic numbers
     energies:  array of x-ray energies (in eV)
     width:     width used to convolve values with lorentzian profile
     edge:      x-ray edge ('K', 'L3', etc) used to lookup energy
@@ -30,60 +101,23 @@ def f1f2(z, energies, width=None, edge=None, _larch=None):
 
     Returns:
     ---------
-    f1, f2:    anomalous scattering factors
+    f1, f2:    anomalous scattering factors, with shape (len(z), len(energies))
+               for a list of elements
 
+    Notes:
+    ------
+    results are cached on element, energies, and width, so that
+    repeated calls with the same energies are fast.
     """
-    global CLLIB
-    if CLLIB is None:
-        CLLIB = get_dll('cldata')
+    en = np.ascontiguousarray(as_ndarray(energies), dtype=np.float64)
 
-    en = as_ndarray(energies)
-
-    if not isinstance(z, int):
-        z  = atomic_number(z, _larch=_larch)
-        if z is None:
+    if isinstance(z, (list, tuple, np.ndarray)):
+        out = [_f1f2_element(iz, en, width=width, edge=edge, _larch=_larch)
+               for iz in z]
+        if any(o is None for o in out):
             return None
-
-    if z > 92:
-        print( 'Cromer-Liberman data not available for Z>92')
-        return
-
-    if edge is not None or width is not None and _larch is not None:
-        natwid = core_width(element=z, edge=edge, _larch=_larch)
-        if width is None and natwid not in (None, []):
-            width = natwid
-
-    if width is not None: # will convolve!
-        e_extra = int(width*80.0)
-        estep = (en[1:] - en[:-1]).min()
-        emin = min(en) - e_extra
-        emax = max(en) + e_extra
-
-        npts = 1 + abs(emax-emin+estep*0.02)/abs(estep)
-        en   = np.linspace(emin, emax, npts)
-        nk   = int(e_extra / estep)
-        sig  = width/2.0
-        lor  = (1./(1 + ((np.arange(2*nk+1)-nk*1.0)/sig)**2))/(np.pi*sig)
-        scale = lor.sum()
-
-    # create ctypes pointers for the C function
-    npts   = len(en)
-    p_z    = ctypes.pointer(ctypes.c_int(int(z)))
-    p_npts = ctypes.pointer(ctypes.c_int(npts))
-    p_en   = (npts*ctypes.c_double)()
-    p_f1   = (npts*ctypes.c_double)()
-    p_f2   = (npts*ctypes.c_double)()
-
-    for i in range(npts):
-        p_en[i] = en[i]
-
-    nout = CLLIB.f1f2(p_z, p_npts, p_en, p_f1, p_f2)
-    f1 = np.array([i for i in p_f1[:]])
-    f2 = np.array([i for i in p_f2[:]])
-    if width is not None: # do the convolution
-        f1 = np.interp(energies, en, convolve(f1, lor)[nk:-nk])/scale
-        f2 = np.interp(energies, en, convolve(f2, lor)[nk:-nk])/scale
-    return (f1, f2)
+        return (np.array([o[0] for o in out]), np.array([o[1] for o in out]))
+    return _f1f2_element(z, en, width=width, edge=edge, _larch=_larch)
 
 def loren(x, cen=0, sigma=1):
     return
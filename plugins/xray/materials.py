@@ -2,9 +2,11 @@ import os
 import numpy as np
 from larch import ValidateLarchPlugin, site_config
 
-from larch_plugins.xray import chemparse, mu_elam, atomic_mass
+from larch_plugins.xray import chemparse, atomic_mass
+from larch_plugins.xray.xraydb_plugin import get_xraydb
 
 MODNAME = '_xray'
+CHANTLER_KINDS = ('f1', 'f2', 'mu_photo', 'mu_incoh', 'mu_total')
 
 def get_materials(_larch):
     """return _materials dictionary, creating it if needed"""
@@ -33,6 +35,70 @@ def get_materials(_larch):
     _larch.symtable.set_symbol(symname, mat)
     return mat
 
+def _composition(elements, xdb):
+    """atomic symbols of all elements and (n_items, n_elements) array
+    of stoichiometric fractions for a list of elements and formulas"""
+    comps, symbols = [], []
+    for item in elements:
+        if isinstance(item, int) or item in xdb.atomic_symbols:
+            comp = {xdb.symbol(item): 1.0}
+        else:
+            comp = chemparse(item)
+        comps.append(comp)
+        for sym in comp:
+            if sym not in symbols:
+                symbols.append(sym)
+    frac = np.zeros((len(comps), len(symbols)))
+    for i, comp in enumerate(comps):
+        for sym, num in comp.items():
+            frac[i, symbols.index(sym)] = num
+    return symbols, frac
+
+@ValidateLarchPlugin
+def cross_section_matrix(elements, energy, kind='total', _larch=None):
+    """
+    cross_section_matrix(elements, energy, kind='total')
+
+    return X-ray cross-sections or anomalous scattering factors for a
+    list of elements or formulas at an array of energies
+
+    arguments
+    ---------
+     elements: list of atomic symbols, atomic numbers, or chemical formulas
+     energy:   energy or array of energies in eV
+     kind:     one of 'total' (default), 'photo', 'coh', 'incoh' for
+               cross-sections from Elam, or 'f1', 'f2', 'mu_photo',
+               'mu_incoh', 'mu_total' for data from Chantler.
+    returns
+    -------
+     array of values, with shape (len(elements), len(energy))
+
+    notes
+    -----
+      1.  cross-sections are in cm^2/gr, with formulas giving the
+          mass-weighted cross-section of the compound, as for material_mu()
+          with a density of 1.
+      2.  f1 and f2 are in electrons, with formulas giving the sum over
+          the atoms of the formula.  f1 is the anomalous part, as from
+          f1_chantler().
+      3.  all elements are evaluated together, which is much faster than
+          calling mu_elam() or f1_chantler() for each element.
+
+    example
+    -------
+      >>> cross_section_matrix(['Fe', 'O', 'Fe2O3'], [7000, 7200], kind='photo')
+    """
+    xdb = get_xraydb(_larch)
+    symbols, frac = _composition(elements, xdb)
+    kind = kind.lower()
+    if kind in CHANTLER_KINDS:
+        vals = xdb.chantler_matrix(symbols, energy, column=kind)
+        return frac.dot(vals)
+    vals = xdb.cross_section_elam_matrix(symbols, energy, kind=kind)
+    weights = frac * np.array([xdb.molar_mass(sym) for sym in symbols])
+    weights = weights / weights.sum(axis=1)[:, np.newaxis]
+    return weights.dot(vals)
+
 @ValidateLarchPlugin
 def material_mu(name, energy, density=None, kind='total', _larch=None):
     """
@@ -56,7 +122,8 @@ def material_mu(name, energy, density=None, kind='total', _larch=None):
     -----
       1.  material names are not case sensitive,
           chemical compounds are case sensitive.
-      2.  mu_elam() is used for mu calculation.
+      2.  cross_section_elam_matrix() is used for mu calculation, with
+          all elements evaluated together.
 
     example
     -------
@@ -79,12 +146,11 @@ def material_mu(name, energy, density=None, kind='total', _larch=None):
     if density is None:
         raise Warning('material_mu(): must give density for unknown materials')
 
-    mass_tot, mu = 0.0, 0.0
-    for elem, frac in chemparse(formula).items():
-        mass  = frac * atomic_mass(elem, _larch=_larch)
-        mu   += mass * mu_elam(elem, energy, kind=kind, _larch=_larch)
-        mass_tot += mass
-    return density*mu/mass_tot
+    mu = density*cross_section_matrix([formula], energy, kind=kind,
+                                      _larch=_larch)[0]
+    if len(mu) == 1:
+        return mu[0]
+    return mu
 
 @ValidateLarchPlugin
 def material_mu_components(name, energy, density=None, kind='total',
@@ -96,7 +162,7 @@ def material_mu_components(name, energy, density=None, kind='total',
      name:     material name or compound formula
      energy:   energy or array of energies at which to calculate mu
      density:  compound density in gr/cm^3
-     kind:     cross-section to use ('total', 'photo') for mu_elam())
+     kind:     cross-section to use ('total', 'photo'), as for mu_elam()
 
     returns
     -------
@@ -120,10 +186,17 @@ def material_mu_components(name, energy, density=None, kind='total',
         formula, density = mater
 
 
+    xdb = get_xraydb(_larch)
+    comp = chemparse(formula)
+    atoms = list(comp.keys())
+    mus = xdb.cross_section_elam_matrix(atoms, energy, kind=kind)
+
     out = {'mass': 0.0, 'density': density, 'elements':[]}
-    for atom, frac in chemparse(formula).items():
+    for atom, mu in zip(atoms, mus):
+        frac  = comp[atom]
         mass  = atomic_mass(atom, _larch=_larch)
-        mu    = mu_elam(atom, energy, kind=kind, _larch=_larch)
+        if len(mu) == 1:
+            mu = mu[0]
         out['mass'] += frac*mass
         out[atom] = (frac, mass, mu)
         out['elements'].append(atom)
@@ -169,4 +242,5 @@ def registerLarchPlugin():
                       'material_add': material_add,
                       'material_mu':  material_mu,
                       'material_mu_components': material_mu_components,
+                      'cross_section_matrix': cross_section_matrix,
                       })
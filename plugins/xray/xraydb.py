@@ -93,13 +93,12 @@ def elam_spline(xin, yin, yspl_in, x):
     Returns:
         ndarray: interpolated values
     """
-    x = as_ndarray(x)
-    x[np.where(x < min(xin))] =  min(xin)
-    x[np.where(x > max(xin))] =  max(xin)
+    x = np.clip(as_ndarray(x), xin[0], xin[-1])
 
-    lo, hi = np.array([(np.flatnonzero(xin < e)[-1],
-                        np.flatnonzero(xin > e)[0])
-                       for e in x]).transpose()
+    # lo: last point below x, hi: first point above x.  Points at x,
+    # as for the repeated energies at absorption edges, are skipped.
+    lo = np.clip(np.searchsorted(xin, x, side='left') - 1, 0, len(xin)-2)
+    hi = np.clip(np.searchsorted(xin, x, side='right'), 1, len(xin)-1)
 
     diff = xin[hi] - xin[lo]
     if any(diff <= 0):
@@ -111,6 +110,25 @@ def elam_spline(xin, yin, yspl_in, x):
                              (b*b - 1) * b * yspl_in[hi] ))
 
 
+def _column(values, numeric=True):
+    "column of values from database rows as an ndarray"
+    if numeric:
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=np.float64)
+    return np.array([str(v) for v in values])
+
+def _tolist(column):
+    "list of values from a numeric column, with NaN as None"
+    return [None if v != v else v for v in column.tolist()]
+
+# decoded table data, shared by all XrayDB instances for a database file,
+# keyed by (table, element) with values of dicts of column arrays
+_table_cache = {}
+SNAPSHOT_VERSION = '1'
+# number of concatenated tables for lists of elements kept by each XrayDB
+MAX_CACHED_STACKS = 64
+
+
 class DBException(Exception):
     """DB Access Exception: General Errors"""
     pass
@@ -198,8 +216,20 @@ class XrayDB(object):
     a complete listing.
     """
 
-    def __init__(self, dbname='xraydb.sqlite', read_only=True):
-        "connect to an existing database"
+    def __init__(self, dbname='xraydb.sqlite', read_only=True, snapshot=None):
+        """connect to an existing database
+
+        Parameters:
+            dbname (string): name of XrayDB file ['xraydb.sqlite']
+            read_only (bool): whether to open database read-only [True]
+            snapshot (string or None): name of .npz file with decoded tables,
+                 read if it is up to date, written otherwise [None]
+
+        Notes:
+            Tabulated data is decoded from the database once per element
+            and table, and kept in memory for all XrayDB instances using
+            the same database file.
+        """
         if not os.path.exists(dbname):
             parent, child = os.path.split(__file__)
             dbname = os.path.join(parent, dbname)
@@ -242,6 +272,17 @@ class XrayDB(object):
         self.atomic_symbols = [e.element for e in self.tables['elements'].select(
             ).execute().fetchall()]
 
+        self._cache = _table_cache.setdefault(os.path.abspath(dbname), {})
+        self._elements = None
+        self._version_id = None
+        self._stacks = {}
+        if snapshot is not None:
+            if not self.read_snapshot(snapshot):
+                try:
+                    self.write_snapshot(snapshot)
+                except IOError:
+                    pass
+
 
     def close(self):
         "close session"
@@ -252,6 +293,131 @@ class XrayDB(object):
         "generic query"
         return self.session.query(*args, **kws)
 
+    def _table(self, table, key):
+        """return dict of column arrays of decoded data for a table
+        and element (or ion), from the in-memory cache
+
+        Notes:
+           this function is meant for internal use.
+        """
+        if (table, key) not in self._cache:
+            self._cache[(table, key)] = self._read_table(table, key)
+        return self._cache[(table, key)]
+
+    def _read_table(self, table, key):
+        "read and decode data for a table and element from the database"
+        out = {}
+        if table in ('photoabsorption', 'scattering', 'Chantler'):
+            tab = {'photoabsorption': PhotoAbsorptionTable,
+                   'scattering': ScatteringTable,
+                   'Chantler': ChantlerTable}[table]
+            cols = {'photoabsorption': ('log_energy', 'log_photoabsorption',
+                                        'log_photoabsorption_spline'),
+                    'scattering': ('log_energy', 'log_coherent_scatter',
+                                   'log_coherent_scatter_spline',
+                                   'log_incoherent_scatter',
+                                   'log_incoherent_scatter_spline'),
+                    'Chantler': ('energy', 'f1', 'f2', 'mu_photo',
+                                 'mu_incoh', 'mu_total')}[table]
+            row = self.query(tab).filter(tab.element==key).first()
+            if row is None:
+                return None
+            for col in cols:
+                out[col] = np.array(json.loads(getattr(row, col)), dtype=np.float64)
+        elif table == 'Waasmaier':
+            tab = WaasmaierTable
+            row = self.query(tab)
+            if key.isdigit():
+                row = row.filter(tab.atomic_number==int(key)).first()
+            else:
+                row = row.filter(tab.ion==key).first()
+            if row is None:
+                return None
+            out['offset'] = np.array(row.offset, dtype=np.float64)
+            out['scale'] = np.array(json.loads(row.scale), dtype=np.float64)
+            out['exponents'] = np.array(json.loads(row.exponents), dtype=np.float64)
+        elif table == 'xray_levels':
+            tab = XrayLevelsTable
+            rows = self.query(tab).filter(tab.element==key).all()
+            out['edge'] = _column([r.iupac_symbol for r in rows], numeric=False)
+            out['energy'] = _column([r.absorption_edge for r in rows])
+            out['fyield'] = _column([r.fluorescence_yield for r in rows])
+            out['jump_ratio'] = _column([r.jump_ratio for r in rows])
+        elif table == 'xray_transitions':
+            tab = XrayTransitionsTable
+            rows = self.query(tab).filter(tab.element==key).all()
+            out['line'] = _column([r.siegbahn_symbol for r in rows], numeric=False)
+            out['energy'] = _column([r.emission_energy for r in rows])
+            out['intensity'] = _column([r.intensity for r in rows])
+            out['initial_level'] = _column([r.initial_level for r in rows], numeric=False)
+            out['final_level'] = _column([r.final_level for r in rows], numeric=False)
+        elif table in ('KeskiRahkonen_Krause', 'corelevel_widths'):
+            tab = KeskiRahkonenKrauseTable
+            if table == 'corelevel_widths':
+                tab = CoreWidthsTable
+            rows = self.query(tab).filter(tab.element==key).all()
+            out['edge'] = _column([r.edge for r in rows], numeric=False)
+            out['width'] = _column([r.width for r in rows])
+        else:
+            raise ValueError("unknown table '%s'" % table)
+        return out
+
+    def _snapshot_tag(self):
+        "tag identifying the database version for snapshots"
+        return '%s %s' % (SNAPSHOT_VERSION, self.get_version(with_history=True))
+
+    def write_snapshot(self, fname):
+        """
+        write decoded tables for all elements to a .npz file, for
+        fast loading with read_snapshot()
+
+        Parameters:
+            fname (string): name of .npz file
+        """
+        tables = ('photoabsorption', 'scattering', 'Chantler', 'xray_levels',
+                  'xray_transitions', 'KeskiRahkonen_Krause', 'corelevel_widths')
+        for sym in self.atomic_symbols:
+            for table in tables:
+                self._table(table, sym)
+        for ion in self.f0_ions():
+            self._table('Waasmaier', ion)
+        arrays = {'__tag__': np.array(self._snapshot_tag())}
+        for (table, key), data in self._cache.items():
+            if data is None:
+                continue
+            for col, val in data.items():
+                arrays['%s/%s/%s' % (table, key, col)] = val
+        with open(fname, 'wb') as fh:
+            np.savez(fh, **arrays)
+
+    def read_snapshot(self, fname):
+        """
+        read decoded tables from a .npz file written by write_snapshot()
+
+        Parameters:
+            fname (string): name of .npz file
+
+        Returns:
+            bool: whether the snapshot was read.  A snapshot from
+                  another version of the database is not read.
+        """
+        if not os.path.exists(fname):
+            return False
+        try:
+            npz = np.load(fname, allow_pickle=False)
+        except (IOError, ValueError):
+            return False
+        with npz:
+            if ('__tag__' not in npz.files or
+                str(npz['__tag__']) != self._snapshot_tag()):
+                return False
+            for name in npz.files:
+                if name == '__tag__':
+                    continue
+                table, key, col = name.split('/')
+                self._cache.setdefault((table, key), {})[col] = npz[name]
+        return True
+
     def get_version(self, long=False, with_history=False):
         """
         return sqlite3 database and python library version numbers
@@ -338,19 +504,17 @@ class XrayDB(object):
         References:
             Waasmaier and Kirfel
         """
-        tab = WaasmaierTable
-        row = self.query(tab)
         if isinstance(ion, int):
-            row = row.filter(tab.atomic_number==ion).all()
+            ion = '%d' % ion
         else:
-            row = row.filter(tab.ion==ion.title()).all()
-        if len(row) > 0:
-            row = row[0]
-        if isinstance(row, tab):
+            ion = ion.title()
+        dat = self._table('Waasmaier', ion)
+        if dat is not None:
             q = as_ndarray(q)
-            f0 = row.offset
-            for s, e in zip(json.loads(row.scale), json.loads(row.exponents)):
-                f0 += s * np.exp(-e*q*q)
+            q2 = q*q
+            f0 = float(dat['offset'])
+            for s, e in zip(dat['scale'], dat['exponents']):
+                f0 = f0 + s * np.exp(-e*q2)
             return f0
 
     def _from_chantler(self, element, energy, column='f1', smoothing=0):
@@ -365,23 +529,19 @@ class XrayDB(object):
         Notes:
            this function is meant for internal use.
         """
-        tab = ChantlerTable
-        row = self.query(tab)
-        row = row.filter(tab.element==self.symbol(element)).all()
-        if len(row) > 0:
-            row = row[0]
-        if isinstance(row, tab):
+        dat = self._table('Chantler', self.symbol(element))
+        if dat is not None:
             energy = as_ndarray(energy)
             emin, emax = min(energy), max(energy)
             # te = self.chantler_energies(element, emin=emin, emax=emax)
-            te = np.array(json.loads(row.energy))
+            te = dat['energy']
             nemin = max(0, -5 + max(np.where(te<=emin)[0]))
             nemax = min(len(te), 6 + max(np.where(te<=emax)[0]))
             region = np.arange(nemin, nemax)
             te = te[region]
             if column == 'mu':
                 column = 'mu_total'
-            ty = np.array(json.loads(getattr(row, column)))[region]
+            ty = dat[column][region]
             if column == 'f1':
                 out = UnivariateSpline(te, ty, s=smoothing)(energy)
             else:
@@ -408,15 +568,10 @@ class XrayDB(object):
         References:
             Chantler
         """
-        tab = ChantlerTable
-        row = self.query(tab).filter(tab.element==self.symbol(element)).all()
-        if len(row) > 0:
-            row = row[0]
-        if not isinstance(row, tab):
+        dat = self._table('Chantler', self.symbol(element))
+        if dat is None:
             return None
-        te = np.array(json.loads(row.energy))
-        tf1 = np.array(json.loads(row.f1))
-        tf2 = np.array(json.loads(row.f2))
+        te = dat['energy']
 
         if emin <= min(te):
             nemin = 0
@@ -490,20 +645,19 @@ class XrayDB(object):
 
     def _elem_data(self, element):
         "return data from elements table: internal use"
-        if isinstance(element, int):
-            elem = ElementsTable.atomic_number
-        else:
-            elem = ElementsTable.element
+        if self._elements is None:
+            elements = {}
+            for row in self.query(ElementsTable).all():
+                dat = ElementData(int(row.atomic_number),
+                                  row.element.title(),
+                                  row.molar_mass, row.density)
+                elements[dat.atomic_number] = elements[dat.symbol] = dat
+            self._elements = elements
+        if not isinstance(element, int):
             element = element.title()
             if not element in self.atomic_symbols:
                 raise ValueError("unknown element '%s'" % repr(element))
-
-        row = self.query(ElementsTable).filter(elem==element).all()
-        if len(row) > 0:
-            row = row[0]
-        return ElementData(int(row.atomic_number),
-                           row.element.title(),
-                           row.molar_mass, row.density)
+        return self._elements[element]
 
     def atomic_number(self, element):
         """
@@ -568,14 +722,11 @@ class XrayDB(object):
         References:
            Elam, Ravel, and Sieber.
         """
-        element = self.symbol(element)
-        tab = XrayLevelsTable
-        out = {}
-        for r in self.query(tab).filter(tab.element==element).all():
-            out[str(r.iupac_symbol)] = XrayEdge(r.absorption_edge,
-                                                r.fluorescence_yield,
-                                                r.jump_ratio)
-        return out
+        dat = self._table('xray_levels', self.symbol(element))
+        return dict(zip(dat['edge'].tolist(),
+                        map(XrayEdge, _tolist(dat['energy']),
+                            _tolist(dat['fyield']),
+                            _tolist(dat['jump_ratio']))))
 
     def xray_edge(self, element, edge):
         """
@@ -633,23 +784,29 @@ class XrayDB(object):
            Elam, Ravel, and Sieber.
         """
         element = self.symbol(element)
-        tab = XrayTransitionsTable
-        row = self.query(tab).filter(tab.element==element)
+        dat = self._table('xray_transitions', element)
         if excitation_energy is not None:
             initial_level = []
-            for ilevel, dat in self.xray_edges(element).items():
-                if dat[0] < excitation_energy:
+            for ilevel, edge in self.xray_edges(element).items():
+                if edge[0] < excitation_energy:
                     initial_level.append(ilevel.title())
 
+        lines = dat['line'].tolist()
+        energy = _tolist(dat['energy'])
+        intensity = _tolist(dat['intensity'])
+        ilevels = dat['initial_level'].tolist()
+        flevels = dat['final_level'].tolist()
         if initial_level is not None:
-            if isinstance(initial_level, (list, tuple)):
-                row = row.filter(tab.initial_level.in_(initial_level))
-            else:
-                row = row.filter(tab.initial_level==initial_level.title())
+            if not isinstance(initial_level, (list, tuple)):
+                initial_level = [initial_level.title()]
+            use = [i in initial_level for i in ilevels]
+        else:
+            use = [True]*len(lines)
         out = {}
-        for r in row.all():
-            out[str(r.siegbahn_symbol)] = XrayLine(r.emission_energy, r.intensity,
-                                               r.initial_level, r.final_level)
+        for i, line in enumerate(lines):
+            if use[i]:
+                out[line] = XrayLine(energy[i], intensity[i],
+                                     ilevels[i], flevels[i])
         return out
 
     def xray_line_strengths(self, element, excitation_energy=None):
@@ -735,21 +892,20 @@ class XrayDB(object):
             Keski-Rahkonen and Krause, 1974
 
         """
-        version_qy = self.tables['Version'].select().order_by('date')
-        version_id = version_qy.execute().fetchall()[-1].id
+        if self._version_id is None:
+            version_qy = self.tables['Version'].select().order_by('date')
+            self._version_id = version_qy.execute().fetchall()[-1].id
 
-        tab = KeskiRahkonenKrauseTable
-        if not use_keski and version_id > 3:
-            tab = CoreWidthsTable
+        table = 'KeskiRahkonen_Krause'
+        if not use_keski and self._version_id > 3:
+            table = 'corelevel_widths'
 
-        rows = self.query(tab).filter(tab.element==self.symbol(element))
+        dat = self._table(table, self.symbol(element))
+        result = list(zip(dat['edge'].tolist(), _tolist(dat['width'])))
         if edge is not None:
-            rows = rows.filter(tab.edge==edge.title())
-        result = rows.all()
+            result = [r for r in result if r[0] == edge.title()]
         if len(result) == 1:
-            result = result[0].width
-        else:
-            result = [(r.edge, r.width) for r in result]
+            result = result[0][1]
         return result
 
 
@@ -777,25 +933,20 @@ class XrayDB(object):
         if kind not in ('coh', 'incoh', 'photo'):
             raise ValueError('unknown cross section kind=%s' % kind)
 
-        tab = ScatteringTable
-        if kind == 'photo':
-            tab = PhotoAbsorptionTable
-
-        row = self.query(tab).filter(tab.element==element).all()
-        if len(row) > 0:
-            row = row[0]
-        if not isinstance(row, tab):
+        dat = self._table('photoabsorption' if kind == 'photo' else 'scattering',
+                          element)
+        if dat is None:
             return None
-        tab_lne = np.array(json.loads(row.log_energy))
+        tab_lne = dat['log_energy']
         if kind.startswith('coh'):
-            tab_val = np.array(json.loads(row.log_coherent_scatter))
-            tab_spl = np.array(json.loads(row.log_coherent_scatter_spline))
+            tab_val = dat['log_coherent_scatter']
+            tab_spl = dat['log_coherent_scatter_spline']
         elif kind.startswith('incoh'):
-            tab_val = np.array(json.loads(row.log_incoherent_scatter))
-            tab_spl = np.array(json.loads(row.log_incoherent_scatter_spline))
+            tab_val = dat['log_incoherent_scatter']
+            tab_spl = dat['log_incoherent_scatter_spline']
         else:
-            tab_val = np.array(json.loads(row.log_photoabsorption))
-            tab_spl = np.array(json.loads(row.log_photoabsorption_spline))
+            tab_val = dat['log_photoabsorption']
+            tab_spl = dat['log_photoabsorption_spline']
 
         emin_tab = 10*int(0.102*np.exp(tab_lne[0]))
         energies[np.where(energies < emin_tab)] = emin_tab
@@ -804,6 +955,136 @@ class XrayDB(object):
             return out[0]
         return out
 
+    def _stacked_table(self, symbols, table, xcol, ycols, logx=False):
+        """concatenate tabulated data for a list of elements, with the x
+        values of each element shifted to lie above those of the previous
+        elements, so that all elements can be searched at once.
+
+        Notes:
+           this function is meant for internal use.
+        """
+        key = (tuple(symbols), table, xcol, tuple(ycols), logx)
+        if key in self._stacks:
+            return self._stacks[key]
+        if len(self._stacks) >= MAX_CACHED_STACKS:
+            self._stacks.clear()
+
+        dats = [self._table(table, sym) for sym in symbols]
+        for sym, dat in zip(symbols, dats):
+            if dat is None:
+                raise ValueError("no %s data for '%s'" % (table, sym))
+        xs = [np.log(d[xcol]) if logx else d[xcol] for d in dats]
+        lo = min(x[0] for x in xs)
+        span = max(x[-1] for x in xs) - lo + 1.0
+        shift = span*np.arange(len(xs)) - lo
+        npts = np.array([len(x) for x in xs])
+        out = {'x': np.concatenate([x + sh for x, sh in zip(xs, shift)]),
+               'shift': shift,
+               'first': np.array([x[0] for x in xs]),
+               'last': np.array([x[-1] for x in xs]),
+               'start': np.cumsum(npts) - npts,
+               'stop': np.cumsum(npts)}
+        for col in ycols:
+            out[col] = np.concatenate([d[col] for d in dats])
+        self._stacks[key] = out
+        return out
+
+    def cross_section_elam_matrix(self, elements, energies, kind='photo'):
+        """
+        returns Elam Cross Section values for several elements and energies
+
+        Parameters:
+            elements (list of strings or ints):  atomic numbers or symbols
+            energies (float or ndarray): energies (in eV) to calculate cross-sections
+            kind (string):  one of 'photo', 'coh', 'incoh', and 'total' for
+                  photo-absorption, coherent scattering, incoherent scattering,
+                  and total cross sections, respectively. Default is 'photo'.
+
+        Returns:
+            ndarray of cross sections (n_elements, n_energies) in cm^2/gr
+
+        Notes:
+            the Elam log-log spline is evaluated for all elements and
+            energies at once, giving the values of cross_section_elam().
+            As for mu_elam(), kind is matched by its leading characters
+            ('coherent', 'incoherent', and 'total' are all allowed), and
+            any other kind gives photo-absorption.
+
+        References:
+            Elam, Ravel, and Sieber.
+        """
+        kind = kind.lower()
+        if kind.startswith('tot'):
+            return (self.cross_section_elam_matrix(elements, energies, 'photo') +
+                    self.cross_section_elam_matrix(elements, energies, 'coh') +
+                    self.cross_section_elam_matrix(elements, energies, 'incoh'))
+
+        symbols = [self.symbol(e) for e in elements]
+        energies = 1.0 * as_ndarray(energies).ravel()
+        if kind.startswith('coh'):
+            table, ycol = 'scattering', 'log_coherent_scatter'
+        elif kind.startswith('incoh'):
+            table, ycol = 'scattering', 'log_incoherent_scatter'
+        else:
+            table, ycol = 'photoabsorption', 'log_photoabsorption'
+        scol = '%s_spline' % ycol
+        tab = self._stacked_table(symbols, table, 'log_energy', (ycol, scol))
+        xin, yin, yspl = tab['x'], tab[ycol], tab[scol]
+
+        emin_tab = 10*(0.102*np.exp(tab['first'])).astype(int)
+        x = np.log(np.maximum(energies[np.newaxis, :], emin_tab[:, np.newaxis]))
+        x = np.clip(x, tab['first'][:, np.newaxis], tab['last'][:, np.newaxis])
+        x = x + tab['shift'][:, np.newaxis]
+
+        start = tab['start'][:, np.newaxis]
+        stop  = tab['stop'][:, np.newaxis]
+        lo = np.clip(np.searchsorted(xin, x, side='left') - 1, start, stop-2)
+        hi = np.clip(np.searchsorted(xin, x, side='right'), start+1, stop-1)
+        diff = xin[hi] - xin[lo]
+        a = (xin[hi] - x) / diff
+        b = (x - xin[lo]) / diff
+        return np.exp(a * yin[lo] + b * yin[hi] +
+                      (diff*diff/6) * ((a*a - 1) * a * yspl[lo] +
+                                       (b*b - 1) * b * yspl[hi]))
+
+    def chantler_matrix(self, elements, energies, column='f1', smoothing=0):
+        """
+        returns energy-dependent data from Chantler table for several
+        elements and energies
+
+        Parameters:
+            elements (list of strings or ints):  atomic numbers or symbols
+            energies (float or ndarray): energies (in eV)
+            column (string): one of 'f1', 'f2', 'mu_photo', 'mu_incoh',
+                  and 'mu_total' ['f1']
+            smoothing (float): smoothing for f1 spline [0]
+
+        Returns:
+            ndarray of values (n_elements, n_energies)
+
+        Notes:
+            columns other than f1 are interpolated in log-log for all
+            elements and energies at once. f1 is interpolated with a
+            spline for each element, as for f1_chantler().
+
+        References:
+            Chantler
+        """
+        symbols = [self.symbol(e) for e in elements]
+        energies = 1.0 * as_ndarray(energies).ravel()
+        if column == 'mu':
+            column = 'mu_total'
+        if column == 'f1':
+            return np.array([self._from_chantler(sym, energies, column='f1',
+                                                 smoothing=smoothing)
+                             for sym in symbols]).reshape(len(symbols), len(energies))
+
+        tab = self._stacked_table(symbols, 'Chantler', 'energy', (column,),
+                                  logx=True)
+        x = np.clip(np.log(energies)[np.newaxis, :], tab['first'][:, np.newaxis],
+                    tab['last'][:, np.newaxis]) + tab['shift'][:, np.newaxis]
+        return np.exp(np.interp(x, tab['x'], np.log(tab[column])))
+
     def mu_elam(self, element, energies, kind='total'):
         """
         returns attenuation cross section for an element at energies (in eV)
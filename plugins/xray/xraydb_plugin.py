@@ -102,7 +102,7 @@ def chantler_data(element, energy, column, _larch=None, **kws):
     column:   one of 'f1', 'f2', 'mu_photo', 'mu_incoh', 'mu_total'
     """
     xdb = get_xraydb(_larch)
-    return xdb._getChantler(element, energy, column=column, **kws)
+    return xdb._from_chantler(element, energy, column=column, **kws)
 
 @ValidateLarchPlugin
 def f1_chantler(element, energy, _larch=None, **kws):
@@ -118,7 +118,7 @@ def f1_chantler(element, energy, _larch=None, **kws):
     energy:   energy or array of energies in eV
     """
     xdb = get_xraydb(_larch)
-    return xdb._getChantler(element, energy, column='f1', **kws)
+    return xdb._from_chantler(element, energy, column='f1', **kws)
 
 @ValidateLarchPlugin
 def f2_chantler(element, energy, _larch=None):
@@ -134,7 +134,7 @@ def f2_chantler(element, energy, _larch=None):
     energy:   energy or array of energies in eV
     """
     xdb = get_xraydb(_larch)
-    return xdb._getChantler(element, energy, column='f2')
+    return xdb._from_chantler(element, energy, column='f2')
 
 @ValidateLarchPlugin
 def mu_chantler(element, energy, incoh=False, photo=False, _larch=None):
@@ -157,7 +157,7 @@ def mu_chantler(element, energy, incoh=False, photo=False, _larch=None):
     col = 'mu_total'
     if photo: col = 'mu_photo'
     if incoh: col = 'mu_incoh'
-    return xdb._getChantler(element, energy, column=col)
+    return xdb._from_chantler(element, energy, column=col)
 
 @ValidateLarchPlugin
 def mu_elam(element, energy, kind='total', _larch=None):
@@ -536,18 +536,26 @@ def xray_delta_beta(material, density, energy, photo_only=False, _larch=None):
 
     Adapted for Larch from code by Yong Choi
     """
+    xdb = get_xraydb(_larch)
     lamb_cm = 1.e-8 * PLANCK_HC / energy # lambda in cm
-    elements = []
-    for symbol, number in chemparse(material).items():
-        elements.append((number, Scatterer(symbol, energy, _larch=_larch)))
-
-    total_mass, delta, beta_photo, beta_total = 0, 0, 0, 0
-    for (number, scat) in elements:
-        weight      = density*number*AVOGADRO
-        delta      += weight * scat.f1
-        beta_photo += weight * scat.f2
-        beta_total += weight * scat.f2*(scat.mu_total/scat.mu_photo)
-        total_mass += number * scat.mass
+    comp = chemparse(material)
+    symbols = list(comp.keys())
+    number = np.array([comp[sym] for sym in symbols])
+    znum = np.array([xdb.atomic_number(sym) for sym in symbols])
+    mass = np.array([xdb.molar_mass(sym) for sym in symbols])
+
+    f1 = xdb.chantler_matrix(symbols, energy, 'f1') + znum[:, np.newaxis]
+    f2 = xdb.chantler_matrix(symbols, energy, 'f2')
+    mu_photo = xdb.chantler_matrix(symbols, energy, 'mu_photo')
+    mu_total = xdb.chantler_matrix(symbols, energy, 'mu_total')
+
+    weight     = density*number*AVOGADRO
+    delta      = weight.dot(f1)
+    beta_photo = weight.dot(f2)
+    beta_total = weight.dot(f2*(mu_total/mu_photo))
+    total_mass = (number*mass).sum()
+    if len(delta) == 1:
+        delta, beta_photo, beta_total = delta[0], beta_photo[0], beta_total[0]
 
     scale = lamb_cm * lamb_cm * R_ELECTRON_CM / (2*pi * total_mass)
     delta = delta * scale
@@ -5,7 +5,8 @@ from .xrd import XRD,xrd1d
 from .xrd_bgr import xrd_background
 from .xrd_fitting import (peakfinder,peaklocater,peakfitter,peakfilter,peakfinder_methods,
                           data_gaussian_fit,instrumental_fit_uvw,calc_broadening)
-from .xrd_pyFAI import (integrate_xrd,integrate_xrd_row,read_lambda,calc_cake,save1D,
+from .xrd_pyFAI import (integrate_xrd,integrate_xrd_row,integrate_xrd_wedges,get_integrator,
+                        read_lambda,calc_cake,save1D,
                         return_ai,twth_from_xy,q_from_xy,eta_from_xy)
 from .xrd_tools import (d_from_q,d_from_twth,twth_from_d,twth_from_q,
                         E_from_lambda,lambda_from_E,q_from_d,q_from_twth,qv_from_hkl,
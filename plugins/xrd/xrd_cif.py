@@ -13,7 +13,6 @@ import os
 import re
 
 import math
-import cmath
 
 from larch_plugins.xray import xrayDB
 from larch_plugins.xrd import (generate_hkl, qv_from_hkl, d_from_hkl, q_from_d,
@@ -2345,6 +2344,13 @@ SPACEGROUPS = {'1':['B1','C1','A1','F1','I1'],
 ##########################################################################
 # FUNCTIONS
 
+_xraydb = None
+def get_xraydb():
+    '''returns XrayDB shared by all CIFcls structure factor calculations'''
+    global _xraydb
+    if _xraydb is None:
+        _xraydb = xrayDB()
+    return _xraydb
 
 class Symmetry(object):
     def __init__(self):
@@ -2636,83 +2642,80 @@ class CIFcls(object):
                     self.symmetry.no = no
                     return
 
-    def q_calculator(self, wvlgth=1.54056, q_min=0.2, q_max=10.0):
+    def atom_positions(self):
+        '''
+        returns element symbols and fractional coordinates (u,v,w) of all
+        atoms in the unit cell, as a list of symbols and array (natoms, 3)
+        '''
+        elems,uvw = [],[]
+        for el in self.atom.label:  ## each element
+            for pos in self.elem_uvw[el]: ## each position in unit cell
+                elems += [el]
+                uvw   += [pos]
+        return elems, np.array(uvw, dtype=np.float64).reshape(-1, 3)
 
-        hkl_list = generate_hkl(positive_only=True)
-#         xraydb = xrayDB()
-        
+    def _phase_sums(self, hkl_list, elems, uvw, qhkl=None):
+        '''
+        returns real part of structure factors for a list of hkl as one
+        (nhkl x natoms) phase matrix product; with qhkl, atoms are weighted
+        by f0 of each element, evaluated once for each unique q
+        '''
+        phase = np.cos(2*math.pi*np.dot(hkl_list, uvw.T))  ## cos(2pi(hu+kv+lw))
+        if qhkl is None:
+            return phase.sum(axis=1)
+        xraydb = get_xraydb()
+        qval, qinv = np.unique(qhkl, return_inverse=True)
+        uelems, einv = np.unique(elems, return_inverse=True)
+        f0 = np.array([xraydb.f0(el, qval/(4*math.pi)) for el in uelems])
+        f0 = f0.reshape(len(uelems), len(qval))
+        return (phase * f0[einv][:, qinv.ravel()].T).sum(axis=1)
+
+    def _calc_F2(self, hkl_list, q_min, q_max, use_f0=False):
+        '''
+        returns q and squared structure factors for hkl with q in range
+        and non-zero structure factor
+        '''
         dhkl = d_from_hkl(hkl_list,*self.unitcell)
         qhkl = q_from_d(dhkl)
-        
-        F2hkl = np.zeros(len(hkl_list))
-    
+
         ## removes q values outside of range
-        ii,jj = qhkl < q_max,qhkl > q_min
-        ii = jj*ii        
-        
-        for i,hkl in enumerate(hkl_list):
-            Fhkl = 0
-            if ii[i]:
-                for el in self.atom.label:  ## loops through each element
-                    for uvw in self.elem_uvw[el]: ## loops through each position in unit cell
-                        hukvlw = hkl[0]*uvw[0]+hkl[1]*uvw[1]+hkl[2]*uvw[2]## (hu+kv+lw)
-                        Fhkl = Fhkl + (cmath.exp(2*cmath.pi*imag*hukvlw)).real
-            if abs(Fhkl) > 1e-5: F2hkl[i] = np.float(Fhkl**2)
-        
+        ii = (qhkl < q_max) * (qhkl > q_min)
+        hkl_list,qhkl = hkl_list[ii],qhkl[ii]
+
+        elems,uvw = self.atom_positions()
+        Fhkl = self._phase_sums(hkl_list, elems, uvw,
+                                qhkl=qhkl if use_f0 else None)
+        F2hkl = np.where(abs(Fhkl) > 1e-5, Fhkl**2, 0)
+
         ## removes zero value structure factors
         jj = F2hkl > 0.001
-        ii = ii*jj
-        
-        qarr = np.array(qhkl[ii],dtype=np.float16)
-       
-        return sorted(np.array(list(set(qarr))))
+        return hkl_list[jj],qhkl[jj],F2hkl[jj]
 
+    def q_calculator(self, wvlgth=1.54056, q_min=0.2, q_max=10.0):
+
+        hkl_list = generate_hkl(positive_only=True)
+        hkl_list,qhkl,F2hkl = self._calc_F2(hkl_list, q_min, q_max)
+        return list(np.unique(np.array(qhkl, dtype=np.float16)))
 
     def structure_factors(self, wvlgth=1.54056, q_min=0.2, q_max=10.0):
 
         hkl_list = generate_hkl()
-        xraydb = xrayDB()
-        
-        dhkl = d_from_hkl(hkl_list,*self.unitcell)
-        qhkl = q_from_d(dhkl)
-        
-        F2hkl = np.zeros(len(hkl_list))
-    
-        ## removes q values outside of range
-        ii,jj = qhkl < q_max,qhkl > q_min
-        ii = jj*ii        
-        
-        for i,hkl in enumerate(hkl_list):
-            Fhkl = 0
-            if ii[i]:
-                for el in self.atom.label:  ## loops through each element
-                    f0 = xraydb.f0(el, qhkl[i]/(4*math.pi)) # xraydb.f0(el, 1/(2*dhkl[i]))
-                    for uvw in self.elem_uvw[el]: ## loops through each position in unit cell
-                        hukvlw = hkl[0]*uvw[0]+hkl[1]*uvw[1]+hkl[2]*uvw[2]## (hu+kv+lw)
-                        Fhkl = Fhkl + f0*(cmath.exp(2*cmath.pi*imag*hukvlw)).real
-            if abs(Fhkl) > 1e-5: F2hkl[i] = np.float(Fhkl**2)
-        
-        ## removes zero value structure factors
-        jj = F2hkl > 0.001
-        ii = ii*jj
-        
-        qarr = np.array(qhkl[ii],dtype=np.float16)
-        qarr = sorted(np.array(list(set(qarr))))
+        hkl_list,qhkl,F2hkl = self._calc_F2(hkl_list, q_min, q_max, use_f0=True)
+
+        ## groups equivalent reflections by q
+        qarr,inv,phkl = np.unique(np.array(qhkl, dtype=np.float16),
+                                  return_inverse=True, return_counts=True)
+        inv = inv.ravel()
         kk = len(qarr)
-        
+        last = np.zeros(kk, dtype=int)
+        np.maximum.at(last, inv, np.arange(len(inv)))
+
         self.hkl      = np.zeros(kk,dtype=np.ndarray)
-        self.qhkl     = np.zeros(kk,dtype=np.float32)
-        self.F2hkl    = np.zeros(kk,dtype=np.float32)
-        self.phkl     = np.zeros(kk,dtype=np.int)
-        
-        for i,row in enumerate(zip(list(hkl_list[ii]),qhkl[ii],F2hkl[ii])):
-            hkl,q,F2 = row
-            j = (np.abs(qarr-q)).argmin()
-
-            self.hkl[j]  = hkl
-            self.qhkl[j] = q
-            self.F2hkl[j] = F2
-            self.phkl[j] += 1
+        for j,i in enumerate(last):
+            self.hkl[j] = hkl_list[i]
+        self.qhkl     = np.array(qhkl[last],dtype=np.float32)
+        self.F2hkl    = np.array(F2hkl[last],dtype=np.float32)
+        self.phkl     = np.array(phkl,dtype=int)
         
         self.dhkl = d_from_q(self.qhkl)
         self.twthhkl = twth_from_q(self.qhkl,wvlgth)
@@ -8,6 +8,7 @@ mkak 2017.03.14
 ##########################################################################
 # IMPORT PYTHON PACKAGES
 import os
+import hashlib
 import numpy as np
 
 HAS_pyFAI = False
@@ -18,6 +19,12 @@ try:
 except ImportError:
     pass
 
+MAX_CACHED_INTEGRATORS = 8
+_ai_cache = {}
+
+# azimuthal bins per degree for the cake used to bin wedges
+CAKE_BINS_PER_DEGREE = 1
+
 ##########################################################################
 # FUNCTIONS
 
@@ -65,9 +72,74 @@ def eta_from_xy(x, y, ai=None, calfile=None, ang_units='degrees'):
 
 def read_lambda(calfile):
     
-    ai = pyFAI.load(calfile)
+    ai,mask = get_integrator(calfile)
     return ai._wavelength*1e10 ## units A
 
+def _mask_key(mask):
+    "hashable key for a mask given as None, a file name, or an array"
+    if mask is None:
+        return None
+    if isinstance(mask, str):
+        fname = os.path.abspath(mask)
+        mtime = os.stat(fname).st_mtime if os.path.exists(fname) else None
+        return (fname, mtime)
+    mask = np.ascontiguousarray(mask)
+    return (mask.shape, mask.dtype.str, hashlib.md5(mask.tobytes()).hexdigest())
+
+def read_mask(mask):
+    "mask for integration as an array, from None, a file name, or an array"
+    if mask is None:
+        return None
+    if isinstance(mask, str):
+        if not os.path.exists(mask):
+            return None
+        import fabio
+        return fabio.open(mask).data
+    return np.asarray(mask)
+
+def get_integrator(calfile, mask=None, flip=True):
+    '''
+    Returns pyFAI AzimuthalIntegrator and mask array for a poni calibration
+    file, cached so that the geometry and look-up tables built by pyFAI are
+    kept between calls.
+
+    calfile      : poni calibration file
+    mask         : mask array or mask file name
+    flip         : images are vertically flipped before integration
+
+    Integrators are cached on (poni file, modification time, mask, flip), so
+    a poni file that is changed on disk is loaded again.  Each mask has its
+    own integrator, so that pyFAI does not rebuild tables when switching.
+    '''
+    fname = os.path.abspath(calfile)
+    key = (fname, os.stat(fname).st_mtime, _mask_key(mask), bool(flip))
+    if key not in _ai_cache:
+        if len(_ai_cache) >= MAX_CACHED_INTEGRATORS:
+            _ai_cache.clear()
+        _ai_cache[key] = (pyFAI.load(fname), read_mask(mask))
+    return _ai_cache[key]
+
+def clear_integrator_cache():
+    "remove all cached pyFAI integrators"
+    _ai_cache.clear()
+
+def _integrate_attrs(unit='q', mask=None, dark=None):
+    attrs = {'mask':mask,'dark':dark}
+    if unit.startswith('2th'):
+        attrs.update({'unit':'2th_deg'})
+    else:
+        attrs.update({'unit':'q_A^-1'})
+    return attrs
+
+def _stack_row(rowxrd2d, flip=True):
+    "row of 2D XRD images as one contiguous stack, flipped if needed"
+    rowxrd2d = np.asarray(rowxrd2d)
+    if rowxrd2d.ndim == 2:
+        rowxrd2d = rowxrd2d[np.newaxis]
+    if flip:
+        rowxrd2d = rowxrd2d[:,::-1,:]
+    return np.ascontiguousarray(rowxrd2d)
+
 def integrate_xrd_row(rowxrd2d, calfile, unit='q', steps=10001, wedge_limits=None,
                       mask=None, dark=None, flip=True):
 
@@ -81,39 +153,129 @@ def integrate_xrd_row(rowxrd2d, calfile, unit='q', steps=10001, wedge_limits=Non
     unit         : unit for integration data ('2th'/'q'); default is 'q'
     steps        : number of steps in integration data; default is 10000
     wedge_limits : azimuthal slice limits
-    mask         : mask array for image
+    mask         : mask array or file for image
     dark         : dark image array
     flip         : vertically flips image to correspond with Dioptas poni file calibration
     '''
 
     if HAS_pyFAI:
         try:
-            ai = pyFAI.load(calfile)
+            ai,mask = get_integrator(calfile, mask=mask, flip=flip)
         except:
             print('Provided calibration file could not be loaded.')
             return
         
-        dir = -1 if flip else 1
-        attrs = {'mask':mask,'dark':dark}
-        if unit.startswith('2th'):
-            attrs.update({'unit':'2th_deg'})
-        else:
-            attrs.update({'unit':'q_A^-1'})
-        
+        attrs = _integrate_attrs(unit=unit, mask=mask, dark=dark)
         if wedge_limits is not None:
             attrs.update({'azimuth_range':wedge_limits})
-            
-        q,xrd1d = [],[]
 
+        rowxrd2d = _stack_row(rowxrd2d, flip=flip)
+        q     = np.zeros((len(rowxrd2d),steps))
+        xrd1d = np.zeros((len(rowxrd2d),steps))
         for i,xrd2d in enumerate(rowxrd2d):
-            row_q,row_xrd1d = calcXRD1d(xrd2d[::dir,:],ai,steps,attrs)
-            q     += [row_q]
-            xrd1d += [row_xrd1d]
+            q[i],xrd1d[i] = calcXRD1d(xrd2d,ai,steps,attrs)
         
-        return np.array(q), np.array(xrd1d)
+        return q, xrd1d
     else:
         print('pyFAI not imported. Cannot calculate 1D integration.')
 
+def integrate_xrd_wedges(rowxrd2d, calfile, nwedges, unit='q', steps=10001,
+                         mask=None, dark=None, flip=True):
+
+    '''
+    Uses pyFAI (poni) calibration file to produce 1D XRD data for azimuthal
+    wedges from a row of 2D XRD images 
+
+    Each image is integrated once to an azimuthal cake spanning -180 to 180
+    degrees, and the cake is binned into nwedges equal wedges.  All wedges
+    then share the radial axis of the full image, rather than each wedge
+    having the radial range of its own pixels as from integrate_xrd_row()
+    with wedge_limits.  If the installed pyFAI does not give the summed
+    signal and normalization for the cake (see bin_cake()), each wedge is
+    integrated separately with integrate_xrd_row() instead.
+    
+    rowxrd2d     : 2D diffraction images for integration
+    calfile      : poni calibration file
+    nwedges      : number of azimuthal wedges
+    unit         : unit for integration data ('2th'/'q'); default is 'q'
+    steps        : number of steps in integration data; default is 10000
+    mask         : mask array or file for image
+    dark         : dark image array
+    flip         : vertically flips image to correspond with Dioptas poni file calibration
+
+    returns q, xrd1d each with shape (nwedges, nimages, steps)
+    '''
+
+    if HAS_pyFAI:
+        try:
+            ai,mask = get_integrator(calfile, mask=mask, flip=flip)
+        except:
+            print('Provided calibration file could not be loaded.')
+            return
+
+        nwedges = int(nwedges)
+        nbins = max(1, int(round(360.*CAKE_BINS_PER_DEGREE/nwedges)))
+        attrs = _integrate_attrs(unit=unit, mask=mask, dark=dark)
+        attrs.update({'azimuth_range':(-180,180)})
+
+        rowxrd2d = _stack_row(rowxrd2d, flip=flip)
+        q     = np.zeros((nwedges,len(rowxrd2d),steps))
+        xrd1d = np.zeros((nwedges,len(rowxrd2d),steps))
+        for i,xrd2d in enumerate(rowxrd2d):
+            res = calcXRDcake(xrd2d,ai,steps,nwedges*nbins,attrs)
+            wedges = bin_cake(res, nwedges)
+            if wedges is None:
+                return _integrate_wedges_1d(rowxrd2d, ai, nwedges, steps,
+                                            _integrate_attrs(unit=unit, mask=mask,
+                                                             dark=dark))
+            q[:,i] = res[1]
+            xrd1d[:,i] = wedges
+        return q, xrd1d
+    else:
+        print('pyFAI not imported. Cannot calculate 1D integration.')
+
+def _integrate_wedges_1d(rowxrd2d, ai, nwedges, steps, attrs):
+    "one integrate1d pass per wedge, for a stack of already flipped images"
+    q     = np.zeros((nwedges,len(rowxrd2d),steps))
+    xrd1d = np.zeros((nwedges,len(rowxrd2d),steps))
+    wdg_sz = 360./nwedges
+    for iwdg in range(nwedges):
+        wattrs = dict(attrs)
+        wattrs.update({'azimuth_range':(iwdg*wdg_sz-180, (iwdg+1)*wdg_sz-180)})
+        for i,xrd2d in enumerate(rowxrd2d):
+            q[iwdg,i],xrd1d[iwdg,i] = calcXRD1d(xrd2d,ai,steps,wattrs)
+    return q, xrd1d
+
+def bin_cake(cake, nwedges):
+    '''
+    bins an azimuthal cake from pyFAI integrate2d into equal azimuthal wedges,
+    returning intensities with shape (nwedges, nradial).
+
+    The summed signal and normalization of the cake bins are added over each
+    wedge, which weights the bins by their pixels as 1D integration over the
+    wedge does.  Returns None if pyFAI does not give these sums, as the mean
+    of the cake intensities is not a pixel-weighted average.
+    '''
+    intensity = np.asarray(cake[0])
+    nazim, nrad = intensity.shape
+    shape = (int(nwedges), nazim//int(nwedges), nrad)
+    signal = getattr(cake, 'sum_signal', None)
+    norm   = getattr(cake, 'sum_normalization', None)
+    if signal is None or norm is None:
+        return None
+    signal = np.asarray(signal)
+    norm   = np.asarray(norm)
+    if signal.ndim > 2: signal = signal[...,0]
+    if norm.ndim > 2: norm = norm[...,0]
+    if signal.shape != intensity.shape or norm.shape != intensity.shape:
+        return None
+    signal = signal.reshape(shape).sum(axis=1)
+    norm   = norm.reshape(shape).sum(axis=1)
+    out = np.zeros(signal.shape)
+    ok = norm != 0
+    out[ok] = signal[ok]/norm[ok]
+    return out
+
 def integrate_xrd(xrd2d, calfile, unit='q', steps=10000, file='',  wedge_limits=None,
                   mask=None, dark=None, save=False, verbose=False):
     '''
@@ -133,7 +295,7 @@ def integrate_xrd(xrd2d, calfile, unit='q', steps=10000, file='',  wedge_limits=
     
     if HAS_pyFAI:
         try:
-            ai = pyFAI.load(calfile)
+            ai,_ = get_integrator(calfile)
         except:
             print('Provided calibration file could not be loaded.')
             return
@@ -165,7 +327,7 @@ def calc_cake(xrd2d, calfile, unit='q', mask=None, dark=None,
     
     if HAS_pyFAI:
         try:
-            ai = pyFAI.load(calfile)
+            ai,_ = get_integrator(calfile)
         except:
             print('Provided calibration file could not be loaded.')
             return
@@ -109,18 +109,14 @@ def qv_from_hkl(hklall,a,b,c,alp,bet,gam):
 
 def d_from_hkl(hklall,a,b,c,alp,bet,gam):
 
-    d = np.zeros(len(hklall))
+    h,k,l = np.asarray(hklall, dtype=np.float64).reshape(-1, 3).T
     alp,bet,gam = np.radians(alp),np.radians(bet),np.radians(gam)
-    for i,hkl in enumerate(hklall):
-        h,k,l = hkl
-        x = 1-np.cos(alp)**2 - np.cos(bet)**2 - np.cos(gam)**2 \
-                + 2*np.cos(alp)*np.cos(bet)*np.cos(gam)
-        y =   (h*np.sin(alp)/a)**2 + 2*k*l*(np.cos(bet)*np.cos(gam)-np.cos(alp))/(b*c) \
-            + (k*np.sin(bet)/b)**2 + 2*l*h*(np.cos(gam)*np.cos(alp)-np.cos(bet))/(c*a) \
-            + (l*np.sin(gam)/c)**2 + 2*h*k*(np.cos(alp)*np.cos(bet)-np.cos(gam))/(a*b)
-        d[i] = np.sqrt(x/y)
-
-    return d
+    x = 1-np.cos(alp)**2 - np.cos(bet)**2 - np.cos(gam)**2 \
+            + 2*np.cos(alp)*np.cos(bet)*np.cos(gam)
+    y =   (h*np.sin(alp)/a)**2 + 2*k*l*(np.cos(bet)*np.cos(gam)-np.cos(alp))/(b*c) \
+        + (k*np.sin(bet)/b)**2 + 2*l*h*(np.cos(gam)*np.cos(alp)-np.cos(bet))/(c*a) \
+        + (l*np.sin(gam)/c)**2 + 2*h*k*(np.cos(alp)*np.cos(bet)-np.cos(gam))/(a*b)
+    return np.sqrt(x/y)
 
 def unit_cell_volume(a,b,c,alp,bet,gam):
 
@@ -168,7 +164,7 @@ def generate_hkl(hmax=10,kmax=10,lmax=10,positive_only=True):
         hklall = np.mgrid[0:hmax+1, 0:kmax+1, 0:lmax+1].reshape(3, -1).T
     else:
         hklall = np.mgrid[-hmax:hmax+1, -kmax:kmax+1, -lmax:lmax+1].reshape(3, -1).T
-    return np.array([hkl for hkl in hklall if hkl[0]**2 + hkl[1]**2 + hkl[2]**2 > 0])
+    return hklall[(hklall**2).sum(axis=1) > 0]
 
 
 MODDOC = '''
@@ -3,8 +3,12 @@ from .xsp3_hdf5 import read_xsp3_hdf5
 from .xrf_netcdf import read_xrf_netcdf
 from .xrd_netcdf import read_xrd_netcdf
 from .xrd_hdf5 import read_xrd_hdf5
-from .asciifiles import (readASCII, readMasterFile, readROIFile,
-                         readEnvironFile, read1DXRDFile, parseEnviron)
+from .asciifiles import (readASCII, readMasterFile, getMasterFile,
+                         readROIFile, readEnvironFile, read1DXRDFile,
+                         parseEnviron)
+from .mapstore import (H5Store, MemmapStore, ChunkDirStore, iter_chunks,
+                       read_h5chunk, read_raw_chunk, decode_chunk,
+                       create_store, open_store, STORE_BACKENDS)
 from .xrm_mapfile import (read_xrfmap, read_xrmmap,
                           process_mapfolder,
                           process_mapfolders,
@@ -3,6 +3,7 @@ utilities for reading files from raw scan folder
 """
 import os
 import sys
+import threading
 import numpy
 
 if sys.version[0] == '2':
@@ -30,8 +31,107 @@ def readASCII(fname, nskip=0, isnumeric=True):
         dat = numpy.array(dat)
     return header, dat
 
+MAX_CACHED_MASTERS = 64
+_master_cache = {}
+_master_lock = threading.Lock()
+
+class MasterFileDescriptor(object):
+    """parsed contents of a map Master file
+
+    The file is re-read only when its (mtime, size) changes, and when the
+    file has grown only the appended tail is read and parsed, as while a
+    map is still being collected.
+
+    Attributes
+    ----------
+    header :     list of header lines
+    rows :       list of rows, each a list of words
+    xrftype :    XRF file type from header, or None
+    xrdtype :    XRD file type from header, or None
+    generation : int, incremented whenever the file has to be fully re-read
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.generation = 0
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.mtime, self.size = None, None
+        self.offset = 0
+        self.start = b''
+        self.header = []
+        self.rows = []
+        self.tail = None
+        self.xrftype = None
+        self.xrdtype = None
+
+    def update(self):
+        """read any new data in the file, returning whether it changed"""
+        with self.lock:
+            stat = os.stat(self.fname)
+            if (stat.st_mtime, stat.st_size) == (self.mtime, self.size):
+                return False
+            with open(self.fname, 'rb') as fh:
+                if self.size is not None:
+                    # if rewritten rather than appended to, start over
+                    if (stat.st_size <= self.size or
+                        fh.read(len(self.start)) != self.start):
+                        self._reset()
+                        self.generation += 1
+                fh.seek(self.offset)
+                text = fh.read()
+            if self.offset == 0:
+                self.start = text[:256]
+            self.mtime, self.size = stat.st_mtime, self.offset + len(text)
+
+            # only complete lines are consumed, a partial last line is
+            # kept as self.tail and parsed again on the next update
+            ncomplete = text.rfind(b'\n') + 1
+            self.offset += ncomplete
+            self.tail = None
+            for line in text[:ncomplete].decode('utf-8', 'replace').splitlines():
+                self._add_line(line)
+            if ncomplete < len(text):
+                tail = text[ncomplete:].decode('utf-8', 'replace').split()
+                if len(self.rows) > 0 and len(tail) == len(self.rows[-1]):
+                    self.tail = tail
+            return True
+
+    def _add_line(self, line):
+        line = line.rstrip('\r\n')
+        if line.startswith('#') or line.startswith(';'):
+            self.header.append(line)
+            if line.startswith('#XRF.filetype'):
+                self.xrftype = line.split()[-1]
+            elif line.startswith('#XRD.filetype'):
+                self.xrdtype = line.split()[-1]
+        else:
+            self.rows.append(line.split())
+
+    def get_rows(self):
+        "list of all rows, including a trailing row without newline"
+        if self.tail is None:
+            return self.rows
+        return self.rows + [self.tail]
+
+def getMasterFile(fname):
+    """return an up-to-date MasterFileDescriptor for a Master file,
+    cached on the file name"""
+    fname = os.path.abspath(fname)
+    with _master_lock:
+        master = _master_cache.get(fname, None)
+        if master is None:
+            if len(_master_cache) >= MAX_CACHED_MASTERS:
+                _master_cache.clear()
+            master = _master_cache[fname] = MasterFileDescriptor(fname)
+    master.update()
+    return master
+
 def readMasterFile(fname):
-    return readASCII(fname, nskip=0, isnumeric=False)
+    master = getMasterFile(fname)
+    with master.lock:
+        return master.header[:], [row[:] for row in master.get_rows()]
 
 def readEnvironFile(fname):
     h, d = readASCII(fname, nskip=0, isnumeric=False)
@@ -0,0 +1,240 @@
+"""
+HDF5 chunk layout and compression advisor for XRF counts of XRM maps
+
+Rows of counts (nrow, npts, nchan) from a map are written to temporary
+HDF5 files with candidate chunk shapes and compression filters, and the
+time to write them and to read them with common access patterns is
+measured:
+
+   row:     read full rows, as when processing or rebuilding ROIs
+   roimap:  read a narrow channel range for all pixels, as for a ROI map
+   pixel:   read the spectrum for single pixels
+   rect:    read the spectra for a small rectangle of pixels
+
+The layouts are ranked by a weighted sum of times relative to the
+fastest layout for each pattern, and the chosen layout can be recorded
+in the 'config/layout' group of the map file.
+"""
+import os
+import json
+import time
+import tempfile
+import numpy as np
+import h5py
+
+NSAMPLE_ROWS = 8
+NREADS = 32
+# relative weights of write, read patterns and file size in the score
+LAYOUT_WEIGHTS = {'write': 1.0, 'row': 1.0, 'roimap': 1.0,
+                  'pixel': 1.0, 'rect': 1.0, 'size': 0.5}
+COMPRESSORS = (('gzip', 1, False), ('gzip', 2, False), ('gzip', 4, False),
+               ('gzip', 2, True), ('lzf', None, False), ('lzf', None, True),
+               (None, None, False))
+
+def default_chunks(npts, nchan):
+    "chunk shape as chosen by GSEXRM_MapFile.build_schema()"
+    xnpts = max(npts, 10)
+    nxx = min(xnpts-1, 2**int(np.log2(xnpts)))
+    nxm = 1024
+    if nxx > 256:
+        nxm = min(1024, int(65536*1.0/ nxx))
+    return (1, nxx, nxm)
+
+def candidate_chunks(nrow, npts, nchan):
+    """list of candidate chunk shapes for counts of shape (nrow, npts, nchan)"""
+    out = [default_chunks(npts, nchan),
+           (1, npts, nchan),
+           (1, min(npts, 64), nchan),
+           (1, min(npts, 16), nchan),
+           (min(nrow, 4), min(npts, 32), min(nchan, 256)),
+           (min(nrow, 8), min(npts, 64), min(nchan, 64))]
+    chunks = []
+    for c in out:
+        c = tuple(max(1, min(n, int(x))) for x, n in zip(c, (nrow, npts, nchan)))
+        if c not in chunks:
+            chunks.append(c)
+    return chunks
+
+def candidate_layouts(nrow, npts, nchan, compressors=COMPRESSORS):
+    """list of candidate layouts as dicts of chunks, compression,
+    compression_opts, and shuffle"""
+    return [dict(chunks=c, compression=comp, compression_opts=opts,
+                 shuffle=shuffle)
+            for c in candidate_chunks(nrow, npts, nchan)
+            for comp, opts, shuffle in compressors]
+
+def sample_counts(dset, nrows=NSAMPLE_ROWS, last_row=None):
+    """read a sample of rows evenly spaced through a counts dataset"""
+    nrow = dset.shape[0]
+    if last_row is not None:
+        nrow = min(nrow, last_row+1)
+    rows = np.unique(np.linspace(0, nrow-1, min(nrow, nrows)).astype(int))
+    return np.array([dset[i] for i in rows])
+
+def benchmark_layout(sample, chunks, compression=None, compression_opts=None,
+                     shuffle=False, nreads=NREADS, tmpdir=None):
+    """benchmark writing and reading counts with one layout
+
+    Parameters
+    ---------
+    sample :           ndarray of counts (nrow, npts, nchan)
+    chunks :           tuple of chunk shape
+    compression :      optional, None or str  'gzip' or 'lzf'
+    compression_opts : optional, None or int  gzip level
+    shuffle :          optional, bool [False] use shuffle filter
+    nreads :           optional, int  number of reads for pixels and rectangles
+    tmpdir :           optional, None or str  folder for temporary file
+
+    Returns
+    -------
+    dict of layout, times in seconds for 'write', 'row', 'roimap',
+    'pixel', 'rect', and file 'size' in bytes.
+    """
+    nrow, npts, nchan = sample.shape
+    kws = {'chunks': tuple(chunks), 'shuffle': shuffle}
+    if compression is not None:
+        kws['compression'] = compression
+        if compression != 'lzf':
+            kws['compression_opts'] = compression_opts
+
+    rng = np.random.RandomState(1)
+    pixels = list(zip(rng.randint(0, nrow, nreads), rng.randint(0, npts, nreads)))
+    ry, rx = min(nrow, 4), min(npts, 16)
+    rects = list(zip(rng.randint(0, nrow-ry+1, nreads),
+                     rng.randint(0, npts-rx+1, nreads)))
+    lo = nchan//4
+    hi = min(nchan, lo + max(1, nchan//64))
+
+    fd, fname = tempfile.mkstemp(prefix='xrmlayout_', suffix='.h5', dir=tmpdir)
+    os.close(fd)
+    out = dict(chunks=tuple(chunks), compression=compression,
+               compression_opts=compression_opts, shuffle=shuffle)
+    try:
+        t0 = time.time()
+        with h5py.File(fname, 'w') as h5:
+            dset = h5.create_dataset('counts', sample.shape, sample.dtype, **kws)
+            for i in range(nrow):
+                dset[i] = sample[i]
+        out['write'] = time.time() - t0
+        out['size'] = os.stat(fname).st_size
+
+        with h5py.File(fname, 'r') as h5:
+            dset = h5['counts']
+            t0 = time.time()
+            for i in range(nrow):
+                dset[i]
+            out['row'] = time.time() - t0
+
+        with h5py.File(fname, 'r') as h5:
+            dset = h5['counts']
+            t0 = time.time()
+            dset[:, :, lo:hi].sum(axis=2)
+            out['roimap'] = time.time() - t0
+
+        with h5py.File(fname, 'r') as h5:
+            dset = h5['counts']
+            t0 = time.time()
+            for iy, ix in pixels:
+                dset[iy, ix, :]
+            out['pixel'] = time.time() - t0
+
+        with h5py.File(fname, 'r') as h5:
+            dset = h5['counts']
+            t0 = time.time()
+            for iy, ix in rects:
+                dset[iy:iy+ry, ix:ix+rx, :].sum(axis=(0, 1))
+            out['rect'] = time.time() - t0
+    finally:
+        os.unlink(fname)
+    return out
+
+def advise_layout(sample, layouts=None, weights=None, nreads=NREADS,
+                  tmpdir=None, callback=None):
+    """benchmark candidate layouts for a sample of counts, and rank them
+
+    Parameters
+    ---------
+    sample :     ndarray of counts (nrow, npts, nchan)
+    layouts :    optional, None or list of layout dicts [candidate_layouts()]
+    weights :    optional, None or dict of weights [LAYOUT_WEIGHTS]
+    nreads :     optional, int  number of reads for pixels and rectangles
+    tmpdir :     optional, None or str  folder for temporary files
+    callback :   optional, None or function called with (i, nlayouts, result)
+
+    Returns
+    -------
+    list of benchmark results, sorted by 'score', best first.  The score
+    is the weighted sum of each time or size relative to the best value
+    for that measure.
+    """
+    if layouts is None:
+        layouts = candidate_layouts(*sample.shape)
+    if weights is None:
+        weights = LAYOUT_WEIGHTS
+
+    results = []
+    for i, layout in enumerate(layouts):
+        res = benchmark_layout(sample, nreads=nreads, tmpdir=tmpdir, **layout)
+        results.append(res)
+        if hasattr(callback, '__call__'):
+            callback(i, len(layouts), res)
+
+    for key, wt in weights.items():
+        best = max(1.e-9, min([r[key] for r in results]))
+        for r in results:
+            r['score'] = r.get('score', 0) + wt*r[key]/best
+    return sorted(results, key=lambda r: r['score'])
+
+def format_layout(result):
+    "one-line summary of a benchmark result"
+    comp = '%s' % result['compression']
+    if result['compression'] == 'gzip':
+        comp = 'gzip-%s' % result['compression_opts']
+    if result['shuffle']:
+        comp = '%s+shuffle' % comp
+    chunks = 'x'.join(['%i' % c for c in result['chunks']])
+    return ('%-16s %-14s %7.3f %7.3f %7.3f %7.3f %7.3f %8.2f %7.2f' %
+            (chunks, comp, result['write'], result['row'], result['roimap'],
+             result['pixel'], result['rect'], result['size']/1.e6,
+             result.get('score', 0)))
+
+LAYOUT_HEADER = ('%-16s %-14s %7s %7s %7s %7s %7s %8s %7s' %
+                 ('chunks', 'compression', 'write', 'row', 'roimap',
+                  'pixel', 'rect', 'size(MB)', 'score'))
+
+def record_layout(xrmmap, result, results=None, det=None):
+    """record the chosen layout in the 'config/layout' group of a map
+
+    Parameters
+    ---------
+    xrmmap :     HDF5 group for the map
+    result :     chosen benchmark result, as from advise_layout()
+    results :    optional, None or list of all benchmark results
+    det :        optional, None or str  name of detector benchmarked
+    """
+    grp = xrmmap['config'].require_group('layout')
+    grp.attrs['chunks'] = np.array(result['chunks'])
+    grp.attrs['compression'] = '%s' % result['compression']
+    grp.attrs['compression_opts'] = -1 if result['compression_opts'] is None \
+                                    else result['compression_opts']
+    grp.attrs['shuffle'] = bool(result['shuffle'])
+    grp.attrs['detector'] = '%s' % det
+    grp.attrs['time'] = time.ctime()
+    if results is not None:
+        grp.attrs['benchmark'] = json.dumps(results)
+    return grp
+
+def read_layout(xrmmap):
+    """return keyword arguments for GSEXRM_MapFile for the layout recorded
+    in the 'config/layout' group of a map, or None if no layout is recorded"""
+    if 'config' not in xrmmap or 'layout' not in xrmmap['config']:
+        return None
+    attrs = xrmmap['config/layout'].attrs
+    compression = attrs['compression']
+    if isinstance(compression, bytes):
+        compression = compression.decode('utf-8')
+    opts = int(attrs['compression_opts'])
+    return dict(chunksize=tuple(int(c) for c in attrs['chunks']),
+                compression=None if compression == 'None' else compression,
+                compression_opts=None if opts < 0 else opts,
+                shuffle=bool(attrs['shuffle']))
@@ -0,0 +1,328 @@
+"""
+storage backends for the spectra of XRM maps
+
+The XRF counts of a map are a cube of (nrow, npts, nchan) values, stored
+in the HDF5 map file by default.  The counts can also be copied to one
+of two backends that need only numpy, so that several readers can read
+spectra for random pixels without sharing one HDF5 file handle:
+
+   H5Store:        HDF5 dataset (default)
+   MemmapStore:    uncompressed flat binary file, memory mapped
+   ChunkDirStore:  directory with one .npy file for each chunk
+
+All backends give the shape, dtype, and chunks of the cube, numpy-style
+slicing for reading and writing, and read_chunk() to read the data for
+one chunk, as from iter_chunks().
+"""
+import os
+import json
+import zlib
+import itertools
+import numpy as np
+
+STORE_BACKENDS = ('hdf5', 'memmap', 'chunkdir')
+STORE_HEADER = 'store.json'
+
+def iter_chunks(store, select=None):
+    """generate tuples of slices for the chunks of a dataset or store,
+    in storage order.  For a dataset that is not chunked, slices are for
+    each index of the first dimension.
+
+    with select, a function taking a tuple of slices, only the chunks
+    for which select returns True are given.
+    """
+    shape = store.shape
+    chunks = store.chunks
+    if chunks is None:
+        chunks = (1,) + shape[1:]
+    ranges = [range(0, n, c) for n, c in zip(shape, chunks)]
+    for offset in itertools.product(*ranges):
+        sel = tuple(slice(o, min(o+c, n))
+                    for o, c, n in zip(offset, chunks, shape))
+        if select is None or select(sel):
+            yield sel
+
+def _direct_chunk_ok(dset):
+    "whether chunks of an HDF5 dataset can be read and decompressed directly"
+    return (dset.chunks is not None and
+            hasattr(dset.id, 'read_direct_chunk') and
+            dset.compression in (None, 'gzip') and
+            not dset.shuffle and not dset.fletcher32 and
+            dset.scaleoffset is None and dset.dtype.kind in 'iuf')
+
+def read_raw_chunk(dset, sel):
+    """read the stored bytes for one chunk of an HDF5 dataset, given as the
+    tuple of slices from iter_chunks(), without decompressing them.
+
+    Returns a tuple to be given to decode_chunk(), which can be sent to
+    another process, or None if the chunk cannot be read directly.
+    """
+    if not _direct_chunk_ok(dset):
+        return None
+    offset = tuple(s.start for s in sel)
+    try:
+        fmask, data = dset.id.read_direct_chunk(offset)
+    except Exception:  # chunk not yet written
+        return None
+    if data is None:
+        return None
+    compressed = dset.compression == 'gzip' and not (fmask & 1)
+    return (data, compressed, dset.dtype.str, dset.chunks,
+            tuple(s.stop-s.start for s in sel))
+
+def decode_chunk(raw):
+    "decompress and reshape chunk data from read_raw_chunk()"
+    data, compressed, dtype, chunks, shape = raw
+    if compressed:
+        data = zlib.decompress(data)
+    data = np.frombuffer(data, dtype=dtype).reshape(chunks)
+    return data[tuple(slice(0, n) for n in shape)]
+
+def read_h5chunk(dset, sel):
+    """read the data for one chunk of an HDF5 dataset, given as the
+    tuple of slices from iter_chunks().
+
+    Where possible, the stored chunk is read directly and decompressed
+    with zlib, which releases the GIL, so that chunks can be read in
+    parallel threads.
+    """
+    raw = read_raw_chunk(dset, sel)
+    if raw is not None:
+        return decode_chunk(raw)
+    return dset[sel]
+
+def _normalize_sel(sel, shape):
+    """convert an index of ints and slices with unit step to a tuple of
+    slices, and the axes to be dropped for ints"""
+    if not isinstance(sel, tuple):
+        sel = (sel,)
+    if Ellipsis in sel:
+        i = sel.index(Ellipsis)
+        sel = sel[:i] + (slice(None),)*(len(shape)-len(sel)+1) + sel[i+1:]
+    sel = sel + (slice(None),)*(len(shape)-len(sel))
+    out, drop = [], []
+    for axis, (s, n) in enumerate(zip(sel, shape)):
+        if isinstance(s, slice):
+            start, stop, step = s.indices(n)
+            if step != 1:
+                raise IndexError('only slices with step 1 are supported')
+            out.append(slice(start, max(start, stop)))
+        else:
+            s = int(s)
+            if s < 0:
+                s += n
+            if s < 0 or s >= n:
+                raise IndexError('index %i out of range for axis %i' % (s, axis))
+            out.append(slice(s, s+1))
+            drop.append(axis)
+    return tuple(out), tuple(drop)
+
+class H5Store(object):
+    """spectra in an HDF5 dataset"""
+    backend = 'hdf5'
+    def __init__(self, dset):
+        self.dset = dset
+
+    @property
+    def shape(self):
+        return self.dset.shape
+
+    @property
+    def dtype(self):
+        return self.dset.dtype
+
+    @property
+    def chunks(self):
+        return self.dset.chunks
+
+    def __getitem__(self, sel):
+        return self.dset[sel]
+
+    def __setitem__(self, sel, value):
+        self.dset[sel] = value
+
+    def read_chunk(self, sel):
+        return read_h5chunk(self.dset, sel)
+
+    def resize(self, nrow):
+        self.dset.resize((nrow,) + self.dset.shape[1:])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class MemmapStore(object):
+    """spectra in an uncompressed binary file, memory mapped
+
+    The shape and dtype are kept in a JSON file with '.json' added to
+    the file name.  Chunks are single rows.
+    """
+    backend = 'memmap'
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(self.path + '.json', 'r') as fh:
+            header = json.load(fh)
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.chunks = (1,) + self.shape[1:]
+        self._map()
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunks=None):
+        """create a new store, with all values 0"""
+        shape = tuple(int(n) for n in shape)
+        dtype = np.dtype(dtype)
+        with open(path, 'wb') as fh:
+            fh.truncate(int(np.prod(shape))*dtype.itemsize)
+        with open(path + '.json', 'w') as fh:
+            json.dump({'shape': shape, 'dtype': dtype.str}, fh)
+        return cls(path, mode='r+')
+
+    def _map(self):
+        self.data = None
+        if np.prod(self.shape) > 0:
+            self.data = np.memmap(self.path, dtype=self.dtype,
+                                  mode=self.mode, shape=self.shape)
+
+    def __getitem__(self, sel):
+        return np.array(self.data[sel])
+
+    def __setitem__(self, sel, value):
+        self.data[sel] = value
+
+    def read_chunk(self, sel):
+        return np.array(self.data[sel])
+
+    def resize(self, nrow):
+        self.flush()
+        self.data = None
+        self.shape = (int(nrow),) + self.shape[1:]
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(int(np.prod(self.shape))*self.dtype.itemsize)
+        with open(self.path + '.json', 'w') as fh:
+            json.dump({'shape': self.shape, 'dtype': self.dtype.str}, fh)
+        self._map()
+
+    def flush(self):
+        if self.data is not None and self.mode != 'r':
+            self.data.flush()
+
+    def close(self):
+        self.flush()
+        self.data = None
+
+class ChunkDirStore(object):
+    """spectra in a directory of chunks, each saved as a .npy file
+
+    The shape, dtype and chunks are kept in the file 'store.json' in
+    the directory.  Chunks that have not been written read as 0.
+    """
+    backend = 'chunkdir'
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(self.path, STORE_HEADER), 'r') as fh:
+            header = json.load(fh)
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.chunks = tuple(header['chunks'])
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunks=None):
+        """create a new store, with all values 0"""
+        shape = tuple(int(n) for n in shape)
+        if chunks is None:
+            chunks = (1,) + shape[1:]
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for fname in os.listdir(path):
+            if fname.endswith('.npy'):
+                os.unlink(os.path.join(path, fname))
+        cls._write_header(path, shape, dtype, chunks)
+        return cls(path, mode='r+')
+
+    @staticmethod
+    def _write_header(path, shape, dtype, chunks):
+        with open(os.path.join(path, STORE_HEADER), 'w') as fh:
+            json.dump({'shape': tuple(shape), 'dtype': np.dtype(dtype).str,
+                       'chunks': tuple(int(c) for c in chunks)}, fh)
+
+    def _chunk_file(self, index):
+        return os.path.join(self.path, '%s.npy' % '.'.join(['%i' % i for i in index]))
+
+    def _load_chunk(self, index):
+        fname = self._chunk_file(index)
+        if os.path.exists(fname):
+            return np.load(fname)
+        return np.zeros(self.chunks, dtype=self.dtype)
+
+    def read_chunk(self, sel):
+        index = [s.start//c for s, c in zip(sel, self.chunks)]
+        data = self._load_chunk(index)
+        return data[tuple(slice(0, s.stop-s.start) for s in sel)]
+
+    def _chunk_ranges(self, sel):
+        "chunk indices and slices in chunk and selection for a selection"
+        ranges = []
+        for s, c in zip(sel, self.chunks):
+            axis = []
+            for ic in range(s.start//c, (s.stop+c-1)//c):
+                c0 = ic*c
+                lo, hi = max(s.start, c0), min(s.stop, c0+c)
+                axis.append((ic, slice(lo-c0, hi-c0), slice(lo-s.start, hi-s.start)))
+            ranges.append(axis)
+        return itertools.product(*ranges)
+
+    def __getitem__(self, sel):
+        sel, drop = _normalize_sel(sel, self.shape)
+        out = np.zeros([s.stop-s.start for s in sel], dtype=self.dtype)
+        for parts in self._chunk_ranges(sel):
+            index = [p[0] for p in parts]
+            if os.path.exists(self._chunk_file(index)):
+                data = self._load_chunk(index)
+                out[tuple(p[2] for p in parts)] = data[tuple(p[1] for p in parts)]
+        if len(drop) > 0:
+            out = out.reshape([n for i, n in enumerate(out.shape) if i not in drop])
+        return out
+
+    def __setitem__(self, sel, value):
+        sel, drop = _normalize_sel(sel, self.shape)
+        shape = [s.stop-s.start for s in sel]
+        value = np.asarray(value, dtype=self.dtype)
+        if len(drop) > 0:
+            value = np.expand_dims(value, drop) if value.ndim > 0 else value
+        value = np.broadcast_to(value, shape)
+        for parts in self._chunk_ranges(sel):
+            index = [p[0] for p in parts]
+            data = np.array(self._load_chunk(index))
+            data[tuple(p[1] for p in parts)] = value[tuple(p[2] for p in parts)]
+            np.save(self._chunk_file(index), data)
+
+    def resize(self, nrow):
+        self.shape = (int(nrow),) + self.shape[1:]
+        self._write_header(self.path, self.shape, self.dtype, self.chunks)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def create_store(backend, path, shape, dtype, chunks=None):
+    """create a new 'memmap' or 'chunkdir' store for spectra"""
+    if backend == 'memmap':
+        return MemmapStore.create(path, shape, dtype, chunks=chunks)
+    elif backend == 'chunkdir':
+        return ChunkDirStore.create(path, shape, dtype, chunks=chunks)
+    raise ValueError("unknown map storage backend '%s'" % backend)
+
+def open_store(backend, path, mode='r'):
+    """open an existing 'memmap' or 'chunkdir' store for spectra"""
+    if backend == 'memmap':
+        return MemmapStore(path, mode=mode)
+    elif backend == 'chunkdir':
+        return ChunkDirStore(path, mode=mode)
+    raise ValueError("unknown map storage backend '%s'" % backend)
@@ -4,13 +4,17 @@ import os
 import sys
 import socket
 import time
+import shutil
+import tempfile
 import datetime
 import h5py
 import numpy as np
 import six
 import scipy.stats as stats
 import json
+from six.moves import cPickle as pickle
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 from functools import partial
 import larch
 from larch.utils.debugtime import debugtime
@@ -18,11 +22,13 @@ from larch.utils.strutils import fix_filename, bytes2str, version_ge
 from larch_plugins.io import nativepath, new_filename
 from larch_plugins.xrf import MCA, ROI
 from larch_plugins.xrmmap import (FastMapConfig, read_xrf_netcdf, read_xsp3_hdf5,
-                                  readASCII, readMasterFile, readROIFile,
+                                  readASCII, readMasterFile, getMasterFile,
+                                  readROIFile,
                                   readEnvironFile, parseEnviron, read_xrd_netcdf,
-                                  read_xrd_hdf5)
-from larch_plugins.xrd import (XRD,E_from_lambda,integrate_xrd_row,q_from_twth,
-                               q_from_d,lambda_from_E)
+                                  read_xrd_hdf5, H5Store, iter_chunks,
+                                  read_raw_chunk, decode_chunk, create_store, open_store, STORE_BACKENDS)
+from larch_plugins.xrd import (XRD,E_from_lambda,integrate_xrd_row,integrate_xrd_wedges,
+                               q_from_twth,q_from_d,lambda_from_E)
 from larch_plugins.tomo import tomo_reconstruction,reshape_sinogram,trim_sinogram
 
 
@@ -33,6 +39,19 @@ COMPRESSION = 'gzip'
 DEFAULT_ROOTNAME = 'xrmmap'
 NOT_OWNER = "Not Owner of HDF5 file %s"
 STEPS = 5001
+# number of threads for reading raw row data, and number of rows to
+# read ahead of the HDF5 writer
+NWORKERS = min(4, mp.cpu_count())
+NPREFETCH = 8
+# number of rows between flushes of the HDF5 file while processing
+FLUSH_NROWS = 10
+# number of rows per chunk for GSEXRM_MapFile.process_parallel
+NROWS_CHUNK = 16
+# ROI sums use cumulative sums over channels when the total width of
+# all ROIs is more than this many times the number of channels
+ROI_PREFIXSUM_RATIO = 3
+# number of channels per chunk for cumulative counts datasets
+NCHAN_CUMCOUNTS = 16
 
 def h5str(obj):
     '''strings stored in an HDF5 from Python2 may look like
@@ -245,12 +264,12 @@ class GSEXRM_MapRow:
         self.xrd1d     = None
         self.xrdq_wdg  = None
         self.xrd1d_wdg = None
+        self.roidata   = None
 
         if masterfile is not None:
-            header, rows = readMasterFile(masterfile)
-            for row in header:
-                if row.startswith('#XRF.filetype'): xrftype = row.split()[-1]
-                if row.startswith('#XRD.filetype'): xrdtype = row.split()[-1]
+            master = getMasterFile(masterfile)
+            if master.xrftype is not None: xrftype = master.xrftype
+            if master.xrdtype is not None: xrdtype = master.xrdtype
 
         if FLAGxrf:
             if xrftype is None:
@@ -359,18 +378,10 @@ class GSEXRM_MapRow:
                 self.xrdq,self.xrd1d = integrate_xrd_row(self.xrd2d,poni,**attrs)
 
                 if wdg > 1:
-                    self.xrdq_wdg,self.xrd1d_wdg = [],[]
-                    wdg_sz = 360./int(wdg)
-                    for iwdg in range(wdg):
-                        wdg_lmts = np.array([iwdg*wdg_sz, (iwdg+1)*wdg_sz]) - 180
-
-                        attrs.update({'wedge_limits':wdg_lmts})
-                        q,counts = integrate_xrd_row(self.xrd2d,poni,**attrs)
-                        self.xrdq_wdg  += [q]
-                        self.xrd1d_wdg += [counts]
-
-                    self.xrdq_wdg  = np.einsum('kij->ijk', self.xrdq_wdg)
-                    self.xrd1d_wdg = np.einsum('kij->ijk', self.xrd1d_wdg)
+                    ## wedges share the radial (q) axis of the full image
+                    q,counts = integrate_xrd_wedges(self.xrd2d,poni,wdg,**attrs)
+                    self.xrdq_wdg  = np.einsum('kij->ijk', q)
+                    self.xrd1d_wdg = np.einsum('kij->ijk', counts)
 
         gnpts, ngather  = gdata.shape
         snpts, nscalers = sdata.shape
@@ -467,6 +478,192 @@ class GSEXRM_MapRow:
 
         self.read_ok = True
 
+def roi_sums(counts, roi_lo, roi_hi):
+    """sums of counts over channel ranges
+
+    Parameters
+    ---------
+    counts :  array of counts (ndet, npts, nchan)
+    roi_lo :  array of first channel (nroi, ndet)
+    roi_hi :  array of last channel + 1 (nroi, ndet)
+
+    Returns
+    -------
+    array of sums (nroi, ndet, npts)
+
+    Notes
+    -----
+    When the ROIs are wide or many, the sums are taken as differences of
+    the cumulative sums over channels at the ROI bounds, otherwise each
+    ROI is summed for all detectors at once.
+    """
+    ndet, npts, nchan = counts.shape
+    nroi = roi_lo.shape[0]
+    roi_lo = np.clip(roi_lo, 0, nchan)
+    roi_hi = np.clip(np.maximum(roi_lo, roi_hi), 0, nchan)
+    sum_dtype = np.add.reduce(np.zeros(1, dtype=counts.dtype)).dtype
+
+    if (roi_hi - roi_lo).sum() > ROI_PREFIXSUM_RATIO*ndet*nchan:
+        csum = np.zeros((ndet, npts, nchan+1), dtype=sum_dtype)
+        np.cumsum(counts, axis=2, dtype=sum_dtype, out=csum[:, :, 1:])
+        idet = np.arange(ndet)
+        return csum[idet, :, roi_hi] - csum[idet, :, roi_lo]
+
+    out = np.zeros((nroi, ndet, npts), dtype=sum_dtype)
+    for iroi in range(nroi):
+        lo, hi = roi_lo[iroi], roi_hi[iroi]
+        if (lo == lo[0]).all() and (hi == hi[0]).all():
+            out[iroi] = counts[:, :, lo[0]:hi[0]].sum(axis=2)
+        else:
+            for idet in range(ndet):
+                out[iroi, idet] = counts[idet, :, lo[idet]:hi[idet]].sum(axis=1)
+    return out
+
+def _chunk_roi_sums(store, roi_lo, roi_hi, sel):
+    """ROI sums for one chunk of an (nrow, npts, nchan) counts store,
+    returning the slices and sums (nroi, nrow, npts) for the chunk"""
+    block = store.read_chunk(sel)
+    nr, nx, nc = block.shape
+    c0 = sel[2].start
+    sums = roi_sums(block.reshape((1, nr*nx, nc)),
+                    (roi_lo - c0)[:, None], (roi_hi - c0)[:, None])
+    return sel, sums.reshape((len(roi_lo), nr, nx))
+
+def _chunk_masked_sum(store, mask, weights, sel):
+    """sum of spectra over the selected pixels of one chunk of an
+    (nrow, npts, nchan) counts store, optionally weighted per pixel,
+    returning the slices and sum (nchan) for the chunk"""
+    pixels = mask[sel[0], sel[1]]
+    block = store.read_chunk(sel)[pixels]
+    if weights is None:
+        return sel, block.sum(axis=0)
+    return sel, (block*weights[sel[0], sel[1]][pixels][:, None]).sum(axis=0)
+
+def reduce_maprow(row, roi_table, npts=None):
+    """compute the ROI sums for a GSEXRM_MapRow, using a ROI table from
+    GSEXRM_MapFile.get_roi_table(), storing and returning row.roidata"""
+    nmca, xnpts, nchan = row.counts.shape
+    if npts is None:
+        npts = xnpts
+    npts = min(roi_table['npts'], xnpts, npts)
+
+    if roi_table['version'] == 2:
+        ndet = len(roi_table['mca_dets'])
+        # sum counts as they are stored in the HDF5 file
+        counts = row.counts[:ndet, :npts, :].astype(roi_table['dtype'], copy=False)
+        dtfactor = row.dtfactor[:ndet, :npts].astype(roi_table['dtf_dtype'], copy=False)
+        roi_lo = np.repeat(roi_table['roi_lo'][:, None], ndet, axis=1)
+        roi_hi = np.repeat(roi_table['roi_hi'][:, None], ndet, axis=1)
+
+        # raw, cor: (nroi, ndet+1, npts), with the detector sum last
+        iraw = roi_sums(counts, roi_lo, roi_hi)
+        nroi = len(iraw)
+        raw = np.zeros((nroi, ndet+1, npts), dtype=iraw.dtype)
+        raw[:, :ndet, :] = iraw
+        raw[:, ndet, :] = raw[:, :ndet, :].sum(axis=1)
+        cor = np.zeros((nroi, ndet+1, npts))
+        cor[:, :ndet, :] = raw[:, :ndet, :]*dtfactor
+        cor[:, ndet, :] = cor[:, :ndet, :].sum(axis=1)
+        row.roidata = dict(version=2, npts=npts, names=roi_table['names'],
+                           mca_dets=roi_table['mca_dets'], raw=raw, cor=cor)
+    else:
+        # iraw, icor: (nroi, nmca, npts)
+        nroi = len(roi_table['roi_lo'])
+        iraw = roi_sums(row.counts[:, :npts, :], roi_table['roi_lo'][:, :nmca],
+                        roi_table['roi_hi'][:, :nmca])
+        icor = iraw*row.dtfactor[:, :npts]
+        sisdata = row.sisdata[:npts].transpose()
+        row.roidata = dict(version=1, npts=npts,
+                           det_raw=np.concatenate((sisdata, iraw.reshape((nroi*nmca, npts)))).transpose(),
+                           det_cor=np.concatenate((sisdata, icor.reshape((nroi*nmca, npts)))).transpose(),
+                           sum_raw=np.concatenate((sisdata, iraw.sum(axis=1))).transpose(),
+                           sum_cor=np.concatenate((sisdata, icor.sum(axis=1))).transpose())
+    return row.roidata
+
+def read_maprow(rowargs, roi_table=None, npts=None):
+    """read a row of raw map data and, if a ROI table is given, reduce it
+    with reduce_maprow().  This does not access the HDF5 file or the
+    GSEXRM_MapFile, and so can be run in worker threads or processes.
+
+    Parameters
+    ---------
+    rowargs :   None or (args, kws) for GSEXRM_MapRow, from
+                GSEXRM_MapFile.get_rowargs()
+    roi_table : optional, None or ROI table from GSEXRM_MapFile.get_roi_table()
+    npts :      optional, None or int  number of points per row
+
+    Returns
+    -------
+    GSEXRM_MapRow, or None if rowargs is None
+    """
+    if rowargs is None:
+        return None
+    args, kws = rowargs
+    row = GSEXRM_MapRow(*args, **kws)
+    if roi_table is not None and row.read_ok:
+        reduce_maprow(row, roi_table, npts=npts)
+    return row
+
+def convert_maprows(rowargs, roi_table=None, npts=None, tmpdir=None):
+    """read and reduce a chunk of rows of raw map data, as for
+    GSEXRM_MapFile.process_parallel().
+
+    Parameters
+    ---------
+    rowargs :   list of (args, kws) for GSEXRM_MapRow, from
+                GSEXRM_MapFile.get_rowargs()
+    roi_table : optional, None or ROI table from GSEXRM_MapFile.get_roi_table()
+    npts :      optional, None or int  number of points per row
+    tmpdir :    optional, None or str  folder for chunk file
+
+    Returns
+    -------
+    name of a temporary file holding the pickled list of rows.
+    """
+    rows = [read_maprow(args, roi_table=roi_table, npts=npts)
+            for args in rowargs]
+    fd, fname = tempfile.mkstemp(prefix='xrmrows_', suffix='.pkl', dir=tmpdir)
+    with os.fdopen(fd, 'wb') as fh:
+        pickle.dump(rows, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    return fname
+
+
+def integrate_xrdrows(chunk, poni=None, steps=STEPS, mask=None, flip=True):
+    """integrate a chunk of rows of 2D XRD frames to 1D XRD, as for
+    GSEXRM_MapFile.add_1DXRD().
+
+    Parameters
+    ---------
+    chunk :     tuple of (first row, frames), with frames either an ndarray
+                (nrows, npts, xpix, ypix) or stored chunk data from
+                read_raw_chunk()
+    poni :      pyFAI calibration file
+    steps :     optional, int  number of q steps [STEPS]
+    mask :      optional, None, mask file name, or mask array
+    flip :      optional, bool  flip images vertically [True]
+
+    Returns
+    -------
+    tuple of (first row, q, counts (nrows, npts, steps))
+
+    Notes
+    -----
+    The pyFAI integrator is cached in each process, so that worker
+    processes keep their integrator between chunks.
+    """
+    irow, frames = chunk
+    if isinstance(frames, tuple):
+        frames = decode_chunk(frames)
+    q, counts = None, []
+    for rowframes in frames:
+        rowq, row1d = integrate_xrd_row(rowframes, poni, steps=steps,
+                                        mask=mask, flip=flip)
+        if q is None:
+            q = rowq[0]
+        counts.append(row1d)
+    return irow, q, np.array(counts, dtype=np.float32)
+
+
 class GSEMCA_Detector(object):
     '''Detector class, representing 1 detector element (real or virtual)
     has the following properties (many of these as runtime-calculated properties)
@@ -614,6 +811,7 @@ class GSEXRM_MapFile(object):
                  poni=None, mask=None, azwdgs=0, qstps=STEPS, flip=True,
                  FLAGxrf=True, FLAGxrd1D=False, FLAGxrd2D=False,
                  compression=COMPRESSION, compression_opts=COMPRESSION_OPTS,
+                 shuffle=False,
                  facility='APS', beamline='13-ID-E',run='',proposal='',user=''):
 
         self.filename         = filename
@@ -633,9 +831,14 @@ class GSEXRM_MapFile(object):
         self._pixeltime       = None
         self.masterfile       = None
         self.masterfile_mtime = -1
+        self._master_state    = None
+        self._roi_dsets       = {}
+        self._counts_stores   = {}
         self.compress_args = {'compression': compression}
-        if compression != 'lzf':
+        if compression not in ('lzf', None):
             self.compress_args['compression_opts'] = compression_opts
+        if shuffle:
+            self.compress_args['shuffle'] = True
 
         self.mono_energy  = None
         self.flag_xrf     = FLAGxrf
@@ -892,8 +1095,10 @@ class GSEXRM_MapFile(object):
         self.add_data(group['environ'], 'value',    [six.b(a) for a  in env_val])
 
         cmprstr = '%s' % self.compress_args['compression']
-        if self.compress_args['compression'] != 'lzf':
+        if 'compression_opts' in self.compress_args:
             cmprstr = '%s-%s' % (cmprstr,self.compress_args['compression_opts'])
+        if self.compress_args.get('shuffle', False):
+            cmprstr = '%s+shuffle' % cmprstr
         self.xrmmap.attrs['Compression'] = cmprstr
 
         self.h5root.flush()
@@ -926,14 +1131,19 @@ class GSEXRM_MapFile(object):
 
         self.status = GSEXRM_FileStatus.hasdata
 
-    def process_row(self, irow, flush=False, callback=None):
-
-        row = self.read_rowdata(irow)
+    def process_row(self, irow, flush=False, callback=None, row=None,
+                    flush_row=True):
+        """process a row of raw data, reading it with read_rowdata()
+        if it is not given.  With flush=True, the arrays are resized
+        to the number of rows processed, as for the last row."""
+        if row is None:
+            row = self.read_rowdata(irow)
         if irow == 0:
             self.build_schema(row,verbose=True)
 
-        if row.read_ok:
-            self.add_rowdata(row, callback=callback)
+        if row is not None and row.read_ok:
+            self.add_rowdata(row, callback=callback,
+                             flush=(flush or flush_row))
 
         if flush:
             self.resize_arrays(self.last_row+1)
@@ -944,9 +1154,27 @@ class GSEXRM_MapFile(object):
             if hasattr(callback, '__call__'):
                 callback(filename=self.filename, status='complete')
 
-    def process(self, maxrow=None, force=False, callback=None):
-        "look for more data from raw folder, process if needed"
+    def process(self, maxrow=None, force=False, callback=None,
+                nworkers=None, nprefetch=NPREFETCH, flush_nrows=FLUSH_NROWS):
+        """look for more data from raw folder, process if needed
 
+        Parameters
+        ---------
+        maxrow :      optional, None or int    maximum row to process
+        force :       optional, bool [False]   force re-reading of Master file
+        callback :    optional, None or function to call for each row
+        nworkers :    optional, None or int    number of threads for reading
+                      raw row data [NWORKERS]
+        nprefetch :   optional, int    number of rows to read ahead [NPREFETCH]
+        flush_nrows : optional, int    number of rows between flushes
+                      of the HDF5 file [FLUSH_NROWS]
+
+        Notes
+        -----
+        Raw data for the next rows is read and reduced (dead-time
+        correction and ROI sums) by a pool of worker threads, while
+        the calling thread writes the rows to the HDF5 file in order.
+        """
         if not self.check_hostid():
             raise GSEXRM_Excpetion(NOT_OWNER % self.filename)
         self.reset_flags()
@@ -960,11 +1188,144 @@ class GSEXRM_MapFile(object):
         if maxrow is not None:
             nrows = min(nrows, maxrow)
 
+        if nworkers is None:
+            nworkers = NWORKERS
+        flush_nrows = max(1, flush_nrows)
+        if force or self.folder_has_newdata():
+            irow = self.last_row + 1
+            if irow == 0 and irow < nrows:
+                self.process_row(irow, flush=(nrows-irow<=1), callback=callback)
+                irow = irow + 1
+            roi_table = self.get_roi_table()
+            rows = self.iter_rowdata(range(irow, nrows), roi_table=roi_table,
+                                     nworkers=nworkers, nprefetch=nprefetch)
+            for irow, row in rows:
+                self.process_row(irow, flush=(nrows-irow<=1), callback=callback,
+                                 row=row, flush_row=((irow+1) % flush_nrows == 0))
+
+        print(datetime.datetime.fromtimestamp(time.time()).strftime('End: %Y-%m-%d %H:%M:%S'))
+
+    def iter_rowdata(self, rows, roi_table=None, nworkers=NWORKERS,
+                     nprefetch=NPREFETCH):
+        """generate (irow, row) for a sequence of rows, with the raw data
+        read and reduced with read_maprow() by a pool of nworkers
+        threads, keeping at most nprefetch rows ahead of the caller.
+
+        The row arguments are made with get_rowargs() in the calling
+        thread, so that the workers never touch the HDF5 file or the
+        state of this GSEXRM_MapFile while the caller writes to it.
+        """
+        rows = list(rows)
+        if nworkers < 2 or len(rows) < 2:
+            for irow in rows:
+                yield irow, self._read_reduced_row(irow, roi_table)
+            return
+
+        pool = ThreadPool(nworkers)
+        pending = []
+        inext = 0
+        try:
+            while inext < len(rows) or len(pending) > 0:
+                while inext < len(rows) and len(pending) < max(1, nprefetch):
+                    irow = rows[inext]
+                    args = (self.get_rowargs(irow), roi_table, self.npts)
+                    pending.append((irow, pool.apply_async(read_maprow, args)))
+                    inext += 1
+                irow, result = pending.pop(0)
+                yield irow, result.get()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _read_reduced_row(self, irow, roi_table=None):
+        "read and reduce a row of raw data, for iter_rowdata()"
+        return read_maprow(self.get_rowargs(irow), roi_table=roi_table,
+                           npts=self.npts)
+
+    def process_parallel(self, maxrow=None, force=False, callback=None,
+                         nprocs=None, chunksize=NROWS_CHUNK, tmpdir=None,
+                         flush_nrows=FLUSH_NROWS, nprefetch=NPREFETCH):
+        """look for more data from raw folder, process if needed, using
+        several processes to read the raw data for a single map.
+
+        Parameters
+        ---------
+        maxrow :      optional, None or int    maximum row to process
+        force :       optional, bool [False]   force re-reading of Master file
+        callback :    optional, None or function to call for each row
+        nprocs :      optional, None or int    number of processes [ncpus-1]
+        chunksize :   optional, int    number of rows per chunk [NROWS_CHUNK]
+        tmpdir :      optional, None or str    folder for temporary chunk files
+        flush_nrows : optional, int    number of rows between flushes
+                      of the HDF5 file [FLUSH_NROWS]
+        nprefetch :   optional, int    maximum number of chunks sent to the
+                      processes ahead of the writer [NPREFETCH]
+
+        Notes
+        -----
+        Disjoint ranges of rows are read and reduced by worker processes
+        with convert_maprows(), which save the rows to temporary chunk
+        files.  Only this process, which must own the HDF5 file, writes
+        the chunks to the HDF5 file, in row order.
+
+        Each chunk file holds the reduced rows of a chunk uncompressed,
+        including XRF spectra and any 2D XRD frames.  At most nprefetch
+        chunks are pending, so that no more than nprefetch chunk files
+        exist at a time if the writer is slower than the processes.
+        """
+        if not self.check_hostid():
+            raise GSEXRM_Exception(NOT_OWNER % self.filename)
+        self.reset_flags()
+        if self.status == GSEXRM_FileStatus.created:
+            self.initialize_xrmmap(callback=callback)
+        if (force or len(self.rowdata) < 1 or
+            (self.dimension is None and isGSEXRM_MapFolder(self.folder))):
+            self.read_master()
+
+        nrows = len(self.rowdata)
+        if maxrow is not None:
+            nrows = min(nrows, maxrow)
+
+        if nprocs is None:
+            nprocs = max(1, mp.cpu_count()-1)
+        nprefetch = max(1, nprefetch)
+        nprocs = min(nprocs, nprefetch)
+        flush_nrows = max(1, flush_nrows)
         if force or self.folder_has_newdata():
             irow = self.last_row + 1
-            while irow < nrows:
+            if irow == 0 and irow < nrows:
                 self.process_row(irow, flush=(nrows-irow<=1), callback=callback)
-                irow  = irow + 1
+                irow = irow + 1
+
+            rowargs = []
+            for i in range(irow, nrows):
+                args = self.get_rowargs(i)
+                if args is not None:
+                    rowargs.append((i, args))
+            chunks = [rowargs[i:i+chunksize]
+                      for i in range(0, len(rowargs), max(1, chunksize))]
+
+            chunkdir = tempfile.mkdtemp(prefix='xrmmap_', dir=tmpdir)
+            convert = partial(convert_maprows, roi_table=self.get_roi_table(),
+                              npts=self.npts, tmpdir=chunkdir)
+            pool = mp.Pool(max(1, nprocs))
+            try:
+                results = self._iter_pool(pool, convert,
+                                          ([a for i, a in c] for c in chunks),
+                                          nprefetch)
+                for chunk, fname in zip(chunks, results):
+                    with open(fname, 'rb') as fh:
+                        rows = pickle.load(fh)
+                    os.unlink(fname)
+                    for (irow, args), row in zip(chunk, rows):
+                        self.process_row(irow, flush=(nrows-irow<=1),
+                                         callback=callback, row=row,
+                                         flush_row=((irow+1) % flush_nrows == 0))
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+                shutil.rmtree(chunkdir, ignore_errors=True)
 
         print(datetime.datetime.fromtimestamp(time.time()).strftime('End: %Y-%m-%d %H:%M:%S'))
 
@@ -989,6 +1350,16 @@ class GSEXRM_MapFile(object):
         '''read a row worth of raw data from the Map Folder
         returns arrays of data
         '''
+        rowargs = self.get_rowargs(irow, offset=offset)
+        if rowargs is None:
+            return
+        args, kws = rowargs
+        return GSEXRM_MapRow(*args, **kws)
+
+    def get_rowargs(self, irow, offset=None):
+        '''return the (args, kws) for GSEXRM_MapRow to read a row of
+        raw data from the Map Folder, or None if the row is not available
+        '''
 
         if self.calibration is None:
             try:
@@ -1039,19 +1410,93 @@ class GSEXRM_MapFile(object):
         if offset is not None:
             ioffset = offset
         self.flag_xrf = self.flag_xrf and xrff != '_unused_'
-        return GSEXRM_MapRow(yval, xrff, xrdf, xpsf, sisf, self.folder,
-                             irow=irow, nrows_expected=self.nrows_expected,
-                             ixaddr=self.ixaddr, dimension=self.dimension,
-                             npts=self.npts, reverse=reverse, ioffset=ioffset,
-                             masterfile=self.masterfile, poni=self.calibration,
-                             flip=self.flip, mask=self.maskfile,
-                             wdg=self.azwdgs, steps=self.qstps,
-                             FLAGxrf=self.flag_xrf, FLAGxrd2D=self.flag_xrd2d,
-                             FLAGxrd1D=self.flag_xrd1d)
-
+        args = (yval, xrff, xrdf, xpsf, sisf, self.folder)
+        kws = dict(irow=irow, nrows_expected=self.nrows_expected,
+                   ixaddr=self.ixaddr, dimension=self.dimension,
+                   npts=self.npts, reverse=reverse, ioffset=ioffset,
+                   masterfile=self.masterfile, poni=self.calibration,
+                   flip=self.flip, mask=self.maskfile,
+                   wdg=self.azwdgs, steps=self.qstps,
+                   FLAGxrf=self.flag_xrf, FLAGxrd2D=self.flag_xrd2d,
+                   FLAGxrd1D=self.flag_xrd1d)
+        return args, kws
+
+
+    def get_roi_table(self):
+        """return a table of ROI channel ranges for the XRF detectors, for
+        reduce_rowdata(), or None if no XRF ROIs have been set up yet"""
+        if not self.flag_xrf:
+            return None
+        xrmmap = self.xrmmap
+        mca_dets = [gname for gname in sorted(xrmmap.keys())
+                    if xrmmap[gname].attrs.get('type', None) == 'mca detector']
+        if len(mca_dets) < 1:
+            return None
+        counts = xrmmap[mca_dets[0]]['counts']
+        npts = counts.shape[1]
 
-    def add_rowdata(self, row, callback=None):
-        '''adds a row worth of real data'''
+        if version_ge(self.version, '2.0.0'):
+            if 'roimap' not in xrmmap or 'mcasum' not in xrmmap['roimap']:
+                return None
+            roigrp = xrmmap['roimap']['mcasum']
+            en  = xrmmap['mcasum']['energy'][:]
+            names, roi_lo, roi_hi = [], [], []
+            for roiname in roigrp.keys():
+                en_lim = roigrp[roiname]['limits'][:]
+                names.append(roiname)
+                roi_lo.append(np.abs(en-en_lim[0]).argmin())
+                roi_hi.append(np.abs(en-en_lim[1]).argmin())
+            roi_lo = np.array(roi_lo, dtype=int)
+            roi_hi = np.maximum(roi_lo, np.array(roi_hi, dtype=int))
+            return dict(version=2, npts=npts, mca_dets=mca_dets, names=names,
+                        roi_lo=roi_lo, roi_hi=roi_hi, dtype=counts.dtype,
+                        dtf_dtype=xrmmap[mca_dets[0]]['dtfactor'].dtype)
+
+        if self.roi_slices is None:
+            lims = xrmmap['config/rois/limits'].value
+            nrois, nmca, nx = lims.shape
+
+            self.roi_slices = []
+            for iroi in range(nrois):
+                x = [slice(lims[iroi, i, 0],
+                           lims[iroi, i, 1]) for i in range(nmca)]
+                self.roi_slices.append(x)
+        nmca = max([len(x) for x in self.roi_slices] + [0])
+        roi_lo = np.zeros((len(self.roi_slices), nmca), dtype=int)
+        roi_hi = np.zeros((len(self.roi_slices), nmca), dtype=int)
+        for iroi, x in enumerate(self.roi_slices):
+            roi_lo[iroi, :len(x)] = [sl.start for sl in x]
+            roi_hi[iroi, :len(x)] = [sl.stop for sl in x]
+        roi_hi = np.maximum(roi_lo, roi_hi)
+        return dict(version=1, npts=npts, roi_lo=roi_lo, roi_hi=roi_hi)
+
+    def _get_roi_datasets(self, names, mca_dets):
+        """list of (raw, cor) HDF5 datasets for each ROI, for each of the
+        detectors and then the detector sum, as for reduce_maprow(), kept
+        so that groups are not looked up for every row"""
+        key = (tuple(names), tuple(mca_dets))
+        dsets = self._roi_dsets.get(key, None)
+        if dsets is None or not dsets[0][0].id.valid:
+            roigrp = self.xrmmap['roimap']
+            dsets = []
+            for roiname in names:
+                for detname in list(mca_dets) + ['mcasum']:
+                    grp = roigrp[detname][roiname]
+                    dsets.append((grp['raw'], grp['cor']))
+            self._roi_dsets = {key: dsets}
+        return dsets
+
+    def reduce_rowdata(self, row, roi_table):
+        """compute the ROI sums for a row of raw data, using the ROI table
+        from get_roi_table().  This does not access the HDF5 file, and so
+        can be run in worker threads.  The results are stored as
+        row.roidata, and used by add_rowdata()."""
+        return reduce_maprow(row, roi_table, npts=self.npts)
+
+    def add_rowdata(self, row, callback=None, flush=True):
+        '''adds a row worth of real data.  ROI sums are taken from
+        row.roidata if it was set by reduce_rowdata(), and the HDF5
+        file is flushed if flush=True.'''
 
         if not self.check_hostid():
             raise GSEXRM_Excpetion(NOT_OWNER % self.filename)
@@ -1080,7 +1525,7 @@ class GSEXRM_MapFile(object):
                     nrows, npts =  g[first_det].shape
 
             if thisrow >= nrows:
-                self.resize_arrays(NINIT*(1+nrows/NINIT))
+                self.resize_arrays(NINIT*(1+nrows//NINIT))
 
             sclrgrp = self.xrmmap['scalars']
             for ai,aname in enumerate(re.findall(r"[\w']+", row.sishead[-1])):
@@ -1114,24 +1559,21 @@ class GSEXRM_MapFile(object):
                     grp['inpcounts'][thisrow, :npts] = row.inpcounts[idet, :npts]
                     grp['outcounts'][thisrow, :npts] = row.outcounts[idet, :npts]
                 self.xrmmap['mcasum']['counts'][thisrow, :npts, :nchan] = row.total[:npts, :nchan]
-                roigrp = self.xrmmap['roimap']
-
-                en  = self.xrmmap['mcasum']['energy'][:]
-                for roiname in roigrp['mcasum'].keys():
-                    en_lim = roigrp['mcasum'][roiname]['limits'][:]
-                    roi_slice = slice(np.abs(en-en_lim[0]).argmin(),
-                                      np.abs(en-en_lim[1]).argmin())
-                    sumraw = roigrp['mcasum'][roiname]['raw'][thisrow,]
-                    sumcor = roigrp['mcasum'][roiname]['cor'][thisrow,]
-                    for detname in mca_dets:
-                        mcaraw = self.xrmmap[detname]['counts'][thisrow,][:,roi_slice].sum(axis=1)
-                        mcacor = mcaraw*self.xrmmap[detname]['dtfactor'][thisrow,]
-                        roigrp[detname][roiname]['raw'][thisrow,] = mcaraw
-                        roigrp[detname][roiname]['cor'][thisrow,] = mcacor
-                        sumraw += mcaraw
-                        sumcor += mcacor
-                    roigrp['mcasum'][roiname]['raw'][thisrow,] = sumraw
-                    roigrp['mcasum'][roiname]['cor'][thisrow,] = sumcor
+
+                roidata = getattr(row, 'roidata', None)
+                if roidata is None or roidata['version'] != 2:
+                    roi_table = self.get_roi_table()
+                    if roi_table is not None:
+                        roidata = self.reduce_rowdata(row, roi_table)
+                if roidata is not None:
+                    rnpts = roidata['npts']
+                    dsets = self._get_roi_datasets(roidata['names'],
+                                                   roidata['mca_dets'])
+                    roiraw = roidata['raw'].reshape((len(dsets), rnpts))
+                    roicor = roidata['cor'].reshape((len(dsets), rnpts))
+                    for (dsraw, dscor), raw, cor in zip(dsets, roiraw, roicor):
+                        dsraw[thisrow, :rnpts] = raw
+                        dscor[thisrow, :rnpts] = cor
 
 
         else:
@@ -1148,7 +1590,7 @@ class GSEXRM_MapFile(object):
                         nrows, npts, nchan =  g['counts'].shape
 
                 if thisrow >= nrows:
-                    self.resize_arrays(NINIT*(1+nrows/NINIT))
+                    self.resize_arrays(NINIT*(1+nrows//NINIT))
 
                 _nr, npts, nchan = xrm_dets[0]['counts'].shape
                 npts = min(npts, xnpts, self.npts)
@@ -1171,42 +1613,13 @@ class GSEXRM_MapFile(object):
                 pos[thisrow, :npts, :] = tpos[:npts, :]
 
                 # now add roi map data
+                roidata = getattr(row, 'roidata', None)
+                if roidata is None or roidata['version'] != 1:
+                    roidata = self.reduce_rowdata(row, self.get_roi_table())
                 roimap = self.xrmmap['roimap']
-                det_raw = roimap['det_raw']
-                det_cor = roimap['det_cor']
-                sum_raw = roimap['sum_raw']
-                sum_cor = roimap['sum_cor']
-
-                detraw = list(row.sisdata[:npts].transpose())
-
-                detcor = detraw[:]
-                sumraw = detraw[:]
-                sumcor = detraw[:]
-
-                if self.roi_slices is None:
-                    lims = self.xrmmap['config/rois/limits'].value
-                    nrois, nmca, nx = lims.shape
-
-                    self.roi_slices = []
-                    for iroi in range(nrois):
-                        x = [slice(lims[iroi, i, 0],
-                                   lims[iroi, i, 1]) for i in range(nmca)]
-                        self.roi_slices.append(x)
-
-                for slices in self.roi_slices:
-                    iraw = [row.counts[i, :npts, slices[i]].sum(axis=1)
-                            for i in range(nmca)]
-                    icor = [row.counts[i, :npts, slices[i]].sum(axis=1)*row.dtfactor[i, :npts]
-                            for i in range(nmca)]
-                    detraw.extend(iraw)
-                    detcor.extend(icor)
-                    sumraw.append(np.array(iraw).sum(axis=0))
-                    sumcor.append(np.array(icor).sum(axis=0))
-
-                det_raw[thisrow, :npts, :] = np.array(detraw).transpose()
-                det_cor[thisrow, :npts, :] = np.array(detcor).transpose()
-                sum_raw[thisrow, :npts, :] = np.array(sumraw).transpose()
-                sum_cor[thisrow, :npts, :] = np.array(sumcor).transpose()
+                rnpts = roidata['npts']
+                for aname in ('det_raw', 'det_cor', 'sum_raw', 'sum_cor'):
+                    roimap[aname][thisrow, :rnpts, :] = roidata[aname]
 
         if self.flag_xrd1d:
             if thisrow == 0: self.xrmmap['xrd1D/q'][:] = row.xrdq[0]
@@ -1222,7 +1635,8 @@ class GSEXRM_MapFile(object):
             self.xrmmap['xrd2D/counts'][thisrow,] = row.xrd2d
         self.last_row = thisrow
         self.xrmmap.attrs['Last_Row'] = thisrow
-        self.h5root.flush()
+        if flush:
+            self.h5root.flush()
 
     def build_schema(self, row, verbose=False):
         '''build schema for detector and scan data'''
@@ -1519,7 +1933,38 @@ class GSEXRM_MapFile(object):
 
         self.h5root.flush()
 
-    def add_1DXRD(self, qstps=None):
+    def add_1DXRD(self, qstps=None, force=False, callback=None, nprocs=None,
+                  nprefetch=NPREFETCH):
+        """build 1D XRD data from the 2D XRD frames of the map, using the
+        pyFAI calibration file in the 'xrd1D' group
+
+        Parameters
+        ---------
+        qstps :      optional, None or int  number of q steps [self.qstps]
+        force :      optional, bool [False] replace existing 1D XRD data,
+                     as after recalibration
+        callback :   optional, None or function to call for each row
+        nprocs :     optional, None or int  number of processes [ncpus-1]
+        nprefetch :  optional, int  maximum number of row chunks sent to the
+                     processes ahead of the writer [NPREFETCH]
+
+        Notes
+        -----
+        Frames are read in the order of the stored chunks, and stored
+        chunks are sent undecoded to a pool of processes, each of which
+        decompresses and integrates them with its own cached pyFAI
+        integrator.  Only this process writes to 'xrd1D/counts', in
+        row order.
+
+        Each pending chunk holds the 2D XRD frames for its rows in memory
+        here and in the pool pipes, compressed if read directly from the
+        HDF5 chunk, otherwise decoded: about npts*nx*ny*itemsize bytes per
+        row (e.g. 2 GB for 250 frames of 2048x2048 uint16).  At most
+        nprefetch chunks are pending, so no more than nprefetch processes
+        are kept busy.
+        """
+        if not self.check_hostid():
+            raise GSEXRM_Exception(NOT_OWNER % self.filename)
 
         if os.path.exists(self.xrmmap['xrd1D'].attrs['calfile']):
 
@@ -1539,34 +1984,95 @@ class GSEXRM_MapFile(object):
                            shape2D[0],shape2D[1],shape2D[2],shape2D[3]))
 
             xrd1Dgrp = ensure_subgroup('xrd1D',self.xrmmap)
-            try:
-                xrd1Dgrp.attrs['type'] = 'xrd1D detector'
-                xrd1Dgrp.attrs['desc'] = 'pyFAI calculation from xrd2D data'
-
-                self.xrmmap['xrd1D'].create_dataset('q',          (self.qstps,), np.float32)
-                self.xrmmap['xrd1D'].create_dataset('background', (self.qstps,), np.float32)
-
-                chunksize_1DXRD  = (1, shape2D[1], self.qstps)
-                self.xrmmap['xrd1D'].create_dataset('counts',
-                                       (shape2D[0], shape2D[1], self.qstps),
-                                       np.float32,
-                                       chunks = chunksize_1DXRD)
-
-                attrs = {'steps':self.qstps,'mask':self.maskfile,'flip':self.flip}
-
-                print(datetime.datetime.fromtimestamp(time.time()).strftime('\nStart: %Y-%m-%d %H:%M:%S'))
-                for i in np.arange(shape2D[0]):
-                    print(' Add row %4i' % (i+1))
-                    rowq,row1D = integrate_xrd_row(self.xrmmap['xrd2D/counts'][i],poni,**attrs)
-                    if i == 0: self.xrmmap['xrd1D/q'][:] = rowq[0]
-                    self.xrmmap['xrd1D/counts'][i,] = row1D
-
-                self.flag_xrd1d = True
-                self.xrmmap['flags'].attrs['xrd1D'] = self.flag_xrd1d
-                print(datetime.datetime.fromtimestamp(time.time()).strftime('End: %Y-%m-%d %H:%M:%S'))
-            except:
-                print('1DXRD data already in file.')
-                return
+            if 'counts' in xrd1Dgrp:
+                if not force:
+                    print('1DXRD data already in file.')
+                    return
+                for name in ('q', 'background', 'counts'):
+                    if name in xrd1Dgrp:
+                        del xrd1Dgrp[name]
+
+            xrd1Dgrp.attrs['type'] = 'xrd1D detector'
+            xrd1Dgrp.attrs['desc'] = 'pyFAI calculation from xrd2D data'
+
+            xrd1Dgrp.create_dataset('q',          (self.qstps,), np.float32)
+            xrd1Dgrp.create_dataset('background', (self.qstps,), np.float32)
+
+            chunksize_1DXRD  = (1, shape2D[1], self.qstps)
+            xrd1Dgrp.create_dataset('counts',
+                                    (shape2D[0], shape2D[1], self.qstps),
+                                    np.float32,
+                                    chunks = chunksize_1DXRD)
+
+            nrows = shape2D[0]
+            if self.last_row >= 0:
+                nrows = min(nrows, self.last_row+1)
+
+            print(datetime.datetime.fromtimestamp(time.time()).strftime('\nStart: %Y-%m-%d %H:%M:%S'))
+            integrate = partial(integrate_xrdrows, poni=poni, steps=self.qstps,
+                                mask=self.maskfile, flip=self.flip)
+            chunks = self.iter_xrd2d_chunks(nrows)
+            if nprocs is None:
+                nprocs = max(1, mp.cpu_count()-1)
+            nprocs = min(nprocs, max(1, nprefetch))
+            if nprocs < 2:
+                results = (integrate(chunk) for chunk in chunks)
+                self._write_1DXRD(results, nrows, callback=callback)
+            else:
+                pool = mp.Pool(nprocs)
+                try:
+                    results = self._iter_pool(pool, integrate, chunks,
+                                              max(1, nprefetch))
+                    self._write_1DXRD(results, nrows, callback=callback)
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+
+            self.flag_xrd1d = True
+            self.xrmmap['flags'].attrs['xrd1D'] = self.flag_xrd1d
+            self.h5root.flush()
+            print(datetime.datetime.fromtimestamp(time.time()).strftime('End: %Y-%m-%d %H:%M:%S'))
+
+    def iter_xrd2d_chunks(self, nrows):
+        """generate (first row, frames) for the 2D XRD frames of the first
+        nrows rows, in the order of the stored chunks.  Frames are given
+        as stored chunk data from read_raw_chunk() where possible."""
+        dset = self.xrmmap['xrd2D/counts']
+        chunks = dset.chunks
+        whole = chunks is not None and tuple(chunks[1:]) == tuple(dset.shape[1:])
+        nstep = chunks[0] if whole else 1
+        for irow in range(0, nrows, nstep):
+            sel = (slice(irow, min(irow+nstep, dset.shape[0])),) + \
+                  tuple(slice(0, n) for n in dset.shape[1:])
+            frames = read_raw_chunk(dset, sel) if whole else None
+            if frames is None:
+                frames = dset[sel]
+            yield irow, frames
+
+    def _iter_pool(self, pool, func, tasks, npending):
+        """generate results of func for tasks in order from a process pool,
+        with at most npending tasks sent ahead"""
+        pending = []
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= npending:
+                yield pending.pop(0).get()
+        while len(pending) > 0:
+            yield pending.pop(0).get()
+
+    def _write_1DXRD(self, results, nrows, callback=None):
+        "write results from integrate_xrdrows() to 'xrd1D/counts'"
+        xrd1Dgrp = self.xrmmap['xrd1D']
+        for irow, q, counts in results:
+            counts = counts[:max(0, nrows-irow)]
+            if irow == 0:
+                xrd1Dgrp['q'][:] = q
+            xrd1Dgrp['counts'][irow:irow+len(counts)] = counts
+            if hasattr(callback, '__call__'):
+                callback(row=(irow+len(counts)), maxrow=nrows, filename=self.filename)
+            else:
+                print(' Add row %4i' % (irow+len(counts)))
 
     def get_slice_y(self):
 
@@ -2018,28 +2524,19 @@ class GSEXRM_MapFile(object):
         self.masterfile_mtime = mtime
 
         try:
-            header, rows = readMasterFile(self.masterfile)
-        except IOError:
+            master = getMasterFile(self.masterfile)
+        except (IOError, OSError):
             raise GSEXRM_Exception(
                 "cannot read Master file from '%s'" % self.masterfile)
 
+        with master.lock:
+            header = master.header[:]
+            rows, nrows = master.rows, len(master.rows)
+            tail = master.tail
+            generation = master.generation
+
         self.notes['end_time'] = isotime(os.stat(self.masterfile).st_ctime)
         self.master_header = header
-        # carefully read rows to avoid repeated rows due to bad collection
-        self.rowdata = []
-        _yl, _xl, _s1 = None, None, None
-        for row in rows:
-            yval, xrff, sisf = row[0], row[1], row[2]
-            il = len(self.rowdata)-1
-            if il > -1:
-                _yl, _xl, _s1 = (self.rowdata[il][0],
-                                 self.rowdata[il][1],
-                                 self.rowdata[il][2])
-            # skip repeated rows in master file
-            if yval != _yl and (xrff != _xl or sisf != _s1):
-                self.rowdata.append(row)
-            #else:
-            #    print(" skip row ", yval, xrff, sisf)
         self.scan_version = 1.00
         self.nrows_expected = None
         self.start_time = time.ctime()
@@ -2054,11 +2551,43 @@ class GSEXRM_MapFile(object):
                 self.nrows_expected = int(words[1].strip())
         self.scan_version = float(self.scan_version)
 
+        # rows already read from the same master file are kept, and only
+        # the newly appended rows are added
+        legacy_xrd = self.scan_version < 1.35 and (self.flag_xrd2d or self.flag_xrd1d)
+        nread = 0
+        if (not legacy_xrd and
+            self._master_state is not None and
+            self._master_state[0:2] == (self.masterfile, generation)):
+            nread, nrowdata = self._master_state[2:]
+            del self.rowdata[nrowdata:]
+        else:
+            self.rowdata = []
+
+        # carefully read rows to avoid repeated rows due to bad collection
+        _yl, _xl, _s1 = None, None, None
+        for irow, row in enumerate(rows[nread:nrows] + [tail]):
+            if irow == nrows - nread:
+                # partial last line, not kept as already read
+                self._master_state = (self.masterfile, generation,
+                                      nrows, len(self.rowdata))
+                if row is None:
+                    break
+            yval, xrff, sisf = row[0], row[1], row[2]
+            il = len(self.rowdata)-1
+            if il > -1:
+                _yl, _xl, _s1 = (self.rowdata[il][0],
+                                 self.rowdata[il][1],
+                                 self.rowdata[il][2])
+            # skip repeated rows in master file
+            if yval != _yl and (xrff != _xl or sisf != _s1):
+                self.rowdata.append(row[:])
+            #else:
+            #    print(" skip row ", yval, xrff, sisf)
 
         self.folder_modtime = os.stat(self.masterfile).st_mtime
         self.stop_time = time.ctime(self.folder_modtime)
         try:
-            last_file = os.path.join(self.folder,rows[-1][2])
+            last_file = os.path.join(self.folder,rows[nrows-1][2])
             self.stop_time = time.ctime(os.stat(last_file).st_ctime)
         except:
             pass
@@ -2120,6 +2649,82 @@ class GSEXRM_MapFile(object):
         dgroup = self._det_name(det)
         return self.xrmmap[dgroup]
 
+    def get_counts_store(self, det=None, mapdat=None):
+        '''return the storage for the XRF counts of a detector, as an
+        H5Store for the HDF5 dataset, or a MemmapStore or ChunkDirStore
+        if set with set_counts_store() and up-to-date
+
+        Parameters
+        ---------
+        det :        optional, None or int         index of detector
+        mapdat :     optional, None or map data group for detector
+        '''
+        if mapdat is None:
+            mapdat = self._det_group(det)
+        backend = h5str(mapdat.attrs.get('counts_store', 'hdf5'))
+        if (backend != 'hdf5' and
+            mapdat.attrs.get('counts_store_last_row', -2) == self.last_row):
+            path = os.path.join(os.path.dirname(os.path.abspath(self.filename)),
+                                h5str(mapdat.attrs['counts_path']))
+            store = self._counts_stores.get(path, None)
+            if store is None and os.path.exists(path):
+                store = self._counts_stores[path] = open_store(backend, path)
+            if store is not None and store.shape == mapdat['counts'].shape:
+                return store
+        return H5Store(mapdat['counts'])
+
+    def set_counts_store(self, backend='memmap', det=None):
+        '''copy the XRF counts of detectors to another storage backend, to be
+        used for reading spectra and ROI maps until more rows are added
+
+        Parameters
+        ---------
+        backend :    optional, str ['memmap']  one of 'memmap', 'chunkdir', or
+                     'hdf5' to use only the HDF5 file
+        det :        optional, None or str  name of detector group [all XRF detectors]
+
+        Notes
+        -----
+        The counts are saved next to the HDF5 file, in '<name>_<det>.counts'
+        for 'memmap' and in the folder '<name>_<det>.chunks' for 'chunkdir'.
+        '''
+        if not self.check_hostid():
+            raise GSEXRM_Exception(NOT_OWNER % self.filename)
+        if backend not in STORE_BACKENDS:
+            raise ValueError("unknown map storage backend '%s'" % backend)
+
+        if det is None:
+            dets = [dname for dname, grp in self.xrmmap.items()
+                    if grp.attrs.get('type', '').startswith('mca det') or
+                       grp.attrs.get('type', '').startswith('virtual mca')]
+        else:
+            dets = [det]
+
+        fpath, fname = os.path.split(os.path.abspath(self.filename))
+        fname = os.path.splitext(fname)[0]
+        ext = {'memmap': 'counts', 'chunkdir': 'chunks'}
+        for dname in dets:
+            dgrp = self.xrmmap[dname]
+            if backend == 'hdf5':
+                for attr in ('counts_store', 'counts_path', 'counts_store_last_row'):
+                    if attr in dgrp.attrs:
+                        del dgrp.attrs[attr]
+                continue
+            counts = dgrp['counts']
+            nrow, npts, nchan = counts.shape
+            path = '%s_%s.%s' % (fname, dname, ext[backend])
+            self._counts_stores.pop(os.path.join(fpath, path), None)
+            store = create_store(backend, os.path.join(fpath, path),
+                                 counts.shape, counts.dtype, chunks=counts.chunks)
+            nblock = counts.chunks[0] if counts.chunks is not None else 1
+            for r0 in range(0, nrow, nblock):
+                store[r0:r0+nblock] = counts[r0:r0+nblock]
+            store.close()
+            dgrp.attrs['counts_store'] = backend
+            dgrp.attrs['counts_path'] = path
+            dgrp.attrs['counts_store_last_row'] = self.last_row
+        self.h5root.flush()
+
     def get_energy(self, det=None):
         '''return energy array for a detector'''
         group = self._det_group(det)
@@ -2130,7 +2735,8 @@ class GSEXRM_MapFile(object):
         ny, nx, npos = self.xrmmap['positions/pos'].shape
         return ny, nx
 
-    def get_mca_area(self, areaname, det=None, dtcorrect=True, callback = None):
+    def get_mca_area(self, areaname, det=None, dtcorrect=True, callback=None,
+                     nworkers=None):
         '''return XRF spectra as MCA() instance for
         spectra summed over a pre-defined area
 
@@ -2138,6 +2744,8 @@ class GSEXRM_MapFile(object):
         ---------
         areaname :   str       name of area
         dtcorrect :  optional, bool [True]         dead-time correct data
+        callback :   optional, None or function called with (ichunk, nchunks, npixels)
+        nworkers :   optional, None or int  number of threads for reading counts
 
         Returns
         -------
@@ -2153,49 +2761,15 @@ class GSEXRM_MapFile(object):
         dgroup = self._det_name(det)
         mapdat = self._det_group(det)
 
-        ix, iy, nmca = mapdat['counts'].shape
-
         npix = len(np.where(area)[0])
         if npix < 1:
             return None
         sy, sx = [slice(min(_a), max(_a)+1) for _a in np.where(area)]
         xmin, xmax, ymin, ymax = sx.start, sx.stop, sy.start, sy.stop
-        nx, ny = (xmax-xmin), (ymax-ymin)
-        NCHUNKSIZE = 16384 # 8192
-        use_chunks = nx*ny > NCHUNKSIZE
-        step = int((nx*ny)/NCHUNKSIZE)
 
-        if not use_chunks:
-            try:
-                if hasattr(callback , '__call__'):
-                    callback(1, 1, nx*ny)
-                counts = self.get_counts_rect(ymin, ymax, xmin, xmax,
-                                           mapdat=mapdat, area=area,
-                                           dtcorrect=dtcorrect)
-            except MemoryError:
-                use_chunks = True
-        if use_chunks:
-            counts = np.zeros(nmca)
-            if nx > ny:
-                for i in range(step+1):
-                    x1 = xmin + int(i*nx/step)
-                    x2 = min(xmax, xmin + int((i+1)*nx/step))
-                    if x1 >= x2: break
-                    if hasattr(callback , '__call__'):
-                        callback(i, step, (x2-x1)*ny)
-                    counts += self.get_counts_rect(ymin, ymax, x1, x2, mapdat=mapdat,
-                                                det=det, area=area,
-                                                dtcorrect=dtcorrect)
-            else:
-                for i in range(step+1):
-                    y1 = ymin + int(i*ny/step)
-                    y2 = min(ymax, ymin + int((i+1)*ny/step))
-                    if y1 >= y2: break
-                    if hasattr(callback , '__call__'):
-                        callback(i, step, nx*(y2-y1))
-                    counts += self.get_counts_rect(y1, y2, xmin, xmax, mapdat=mapdat,
-                                                det=det, area=area,
-                                                dtcorrect=dtcorrect)
+        counts = self.get_counts_mask(area, mapdat=mapdat, det=det,
+                                      dtcorrect=dtcorrect, callback=callback,
+                                      nworkers=nworkers)
 
         ltime, rtime = self.get_livereal_rect(ymin, ymax, xmin, xmax, det=det,
                                               dtcorrect=dtcorrect, area=area)
@@ -2260,52 +2834,96 @@ class GSEXRM_MapFile(object):
         if mapdat is None:
             mapdat = self._det_group(det)
 
-        nx, ny = (xmax-xmin, ymax-ymin)
         sx = slice(xmin, xmax)
         sy = slice(ymin, ymax)
 
-        ix, iy, nmca = mapdat['counts'].shape
-        cell   = mapdat['counts'].regionref[sy, sx, :]
-        counts = mapdat['counts'][cell]
-        counts = counts.reshape(ny, nx, nmca)
-        if dtcorrect:
-            if det in range(1, self.ndet+1):
-                cell   = mapdat['dtfactor'].regionref[sy, sx]
-                dtfact = mapdat['dtfactor'][cell].reshape(ny, nx)
-                dtfact = dtfact.reshape(dtfact.shape[0], dtfact.shape[1], 1)
-                counts = counts * dtfact
-            elif det is None: # indicating sum of deadtime-corrected spectra
-                _md    = self._det_group(self.ndet)
-                cell   = _md['counts'].regionref[sy, sx, :]
-                _cts   = _md['counts'][cell].reshape(ny, nx, nmca)
-                cell   = _md['dtfactor'].regionref[sy, sx]
-                dtfact = _md['dtfactor'][cell].reshape(ny, nx)
-                dtfact = dtfact.reshape(dtfact.shape[0], dtfact.shape[1], 1)
-                counts = _cts * dtfact
-                for _idet in range(1, self.ndet):
-                    _md    = self._det_group(_idet)
-                    cell   = _md['counts'].regionref[sy, sx, :]
-                    _cts   = _md['counts'][cell].reshape(ny, nx, nmca)
-                    cell   = _md['dtfactor'].regionref[sy, sx]
-                    dtfact = _md['dtfactor'][cell].reshape(ny, nx)
-                    dtfact = dtfact.reshape(dtfact.shape[0], dtfact.shape[1], 1)
-                    counts += _cts * dtfact
-
-        elif det is None: # indicating sum un-deadtime-corrected spectra
-            _md    = self._det_group(self.ndet)
-            cell   = _md['counts'].regionref[sy, sx, :]
-            counts = _md['counts'][cell].reshape(ny, nx, nmca)
-            for _idet in range(1, self.ndet):
-                _md    = self._det_group(_idet)
-                cell   = _md['counts'].regionref[sy, sx, :]
-                _cts   = _md['counts'][cell].reshape(ny, nx, nmca)
-                counts += _cts
-
+        mask = np.zeros(mapdat['counts'].shape[:2], dtype=bool)
         if area is not None:
-            counts = counts[area[sy, sx]]
+            mask[sy, sx] = area[sy, sx]
         else:
-            counts = counts.sum(axis=0)
-        return counts.sum(axis=0)
+            mask[sy, sx] = True
+        return self.get_counts_mask(mask, mapdat=mapdat, det=det,
+                                    dtcorrect=dtcorrect)
+
+    def get_counts_mask(self, mask, mapdat=None, det=None, dtcorrect=True,
+                        callback=None, nworkers=None):
+        '''return counts summed over the pixels of a map selected by a mask,
+        optionally applying deadtime correction
+
+        Parameters
+        ---------
+        mask :       ndarray of bool (nrow, npts)  pixels to sum
+        mapdat :     optional, None or map data
+        det :        optional, None or int         index of detector
+        dtcorrect :  optional, bool [True]         dead-time correct data
+        callback :   optional, None or function called with (ichunk, nchunks, npixels)
+        nworkers :   optional, None or int  number of threads for reading counts
+
+        Returns
+        -------
+        ndarray for XRF counts
+
+        Notes
+        -----
+        Only the HDF5 chunks of the counts that contain selected pixels are
+        read, and these are read and summed in a pool of threads.
+
+        With det=None, the spectra of the detectors are summed, with dead-time
+        correction for each pixel if dtcorrect is True.  If mapdat is None,
+        the map data is taken from the 'det' parameter.
+        '''
+        self._det_name(det)
+        if mapdat is None:
+            mapdat = self._det_group(det)
+
+        if det in range(1, self.ndet+1):
+            groups = [(mapdat, dtcorrect)]
+        elif det is None:
+            groups = [(self._det_group(i), dtcorrect) for i in range(1, self.ndet+1)]
+        else:
+            groups = [(mapdat, False)]
+
+        tasks = []
+        for grp, use_dtf in groups:
+            dset = self.get_counts_store(mapdat=grp)
+            nrow, npts, nchan = dset.shape
+            _mask = np.zeros((nrow, npts), dtype=bool)
+            ny, nx = min(nrow, mask.shape[0]), min(npts, mask.shape[1])
+            _mask[:ny, :nx] = mask[:ny, :nx]
+            if not _mask.any():
+                continue
+            weights = None
+            if use_dtf:
+                sy, sx = [slice(min(_a), max(_a)+1) for _a in np.where(_mask)]
+                weights = np.zeros((nrow, npts))
+                weights[sy, sx] = grp['dtfactor'][sy, sx]
+            func = partial(_chunk_masked_sum, dset, _mask, weights)
+            select = lambda sel, m=_mask: m[sel[0], sel[1]].any()
+            tasks.extend([(func, sel) for sel in iter_chunks(dset, select=select)])
+
+        nchan = mapdat['counts'].shape[2]
+        counts = np.zeros(nchan, dtype=np.float64 if dtcorrect else np.int64)
+
+        def add_chunk(i, sel, csum):
+            counts[sel[2]] += csum
+            if hasattr(callback , '__call__'):
+                callback(i, len(tasks), mask[sel[0], sel[1]].sum())
+
+        if nworkers is None:
+            nworkers = NWORKERS
+        if nworkers < 2 or len(tasks) < 2:
+            for i, (func, sel) in enumerate(tasks):
+                add_chunk(i, *func(sel))
+        else:
+            pool = ThreadPool(nworkers)
+            try:
+                results = pool.imap_unordered(lambda task: task[0](task[1]), tasks)
+                for i, (sel, csum) in enumerate(results):
+                    add_chunk(i, sel, csum)
+            finally:
+                pool.terminate()
+                pool.join()
+        return counts
 
     def get_livereal_rect(self, ymin, ymax, xmin, xmax, det=None,
                           area=None, dtcorrect=True):
@@ -2871,6 +3489,7 @@ class GSEXRM_MapFile(object):
 
     def save_roi(self,roiname,det,raw,cor,range,type,units):
 
+        self._roi_dsets = {}
         ds = ensure_subgroup(roiname,self.xrmmap['roimap'][det])
         ds.create_dataset('raw',    data=raw   )
         ds.create_dataset('cor',    data=cor   )
@@ -2900,49 +3519,175 @@ class GSEXRM_MapFile(object):
 
         return roigroup,det_list,sumdet
 
-    def add_xrfroi(self, Erange, roiname, unit='keV'):
+    def add_xrfroi(self, Erange, roiname, unit='keV', nworkers=None):
 
+        self.add_xrfrois([(roiname, Erange)], unit=unit, nworkers=nworkers)
+
+    def add_xrfrois(self, rois, unit='keV', nworkers=None):
+        '''add several XRF ROIs, reading the counts for each detector once
+
+        Parameters
+        ---------
+        rois :       list of (roiname, Erange) for the ROIs
+        unit :       optional, str ['keV']  unit of Erange, 'keV', 'eV', or 'channels'
+        nworkers :   optional, None or int  number of threads for reading counts
+
+        '''
         if not self.flag_xrf:
             return
 
-        if unit == 'eV': Erange[:] = [x/1000. for x in Erange] ## eV to keV
-
         roigroup,det_list,sumdet  = self.build_mca_roimap()
 
-        if 'sum_name' in roigroup and roiname in roigroup['sum_name']:
-            raise ValueError("Name '%s' exists in 'roimap/sum_name' arrays." % roiname)
-        for det in det_list+[sumdet]:
-            if roiname in roigroup[det]:
-                raise ValueError("Name '%s' exists in 'roimap/%s' arrays." % (roiname,det))
-
-        roi_limits,dtfctrs,icounts = [],[],[]
+        names, eranges = [], []
+        for roiname, Erange in rois:
+            if unit == 'eV': Erange = [x/1000. for x in Erange] ## eV to keV
+            if 'sum_name' in roigroup and roiname in roigroup['sum_name']:
+                raise ValueError("Name '%s' exists in 'roimap/sum_name' arrays." % roiname)
+            for det in det_list+[sumdet]:
+                if roiname in roigroup[det] or roiname in names:
+                    raise ValueError("Name '%s' exists in 'roimap/%s' arrays." % (roiname,det))
+            names.append(roiname)
+            eranges.append(Erange)
+
+        sumraw, sumcor = 0, 0
         for det in det_list:
             xrmdet = self.xrmmap[det]
-            if unit.startswith('chan'):
-                imin,imax = Erange
-            else:
-                Eaxis = xrmdet['energy'][:]
+            roi_limits = []
+            for Erange in eranges:
+                if unit.startswith('chan'):
+                    imin,imax = Erange
+                else:
+                    Eaxis = xrmdet['energy'][:]
 
-                imin = (np.abs(Eaxis-Erange[0])).argmin()
-                imax = (np.abs(Eaxis-Erange[1])).argmin()+1
+                    imin = (np.abs(Eaxis-Erange[0])).argmin()
+                    imax = (np.abs(Eaxis-Erange[1])).argmin()+1
+                roi_limits += [[int(imin), int(imax)]]
+            roi_limits = np.array(roi_limits)
 
+            detraw = self.get_xrfroi_sums(det, roi_limits[:, 0], roi_limits[:, 1],
+                                          nworkers=nworkers)
+            detcor = detraw*xrmdet['dtfactor'][:]
+            for i, roiname in enumerate(names):
+                self.save_roi(roiname,det,detraw[i],detcor[i],eranges[i],'energy',unit)
+            sumraw = sumraw + detraw
+            sumcor = sumcor + detcor
 
-            roi_limits += [[int(imin), int(imax)]]
-            dtfctrs += [xrmdet['dtfactor']]
-            icounts += [np.array(xrmdet['counts'][:])]
+        if sumdet is not None:
+            for i, roiname in enumerate(names):
+                self.save_roi(roiname,sumdet,sumraw[i],sumcor[i],eranges[i],'energy',unit)
 
-        detraw = [icnt[:,:,slice(*islc)].sum(axis=2)        for icnt,islc        in zip(icounts,roi_limits)]
-        detcor = [icnt[:,:,slice(*islc)].sum(axis=2)*dtfctr for icnt,islc,dtfctr in zip(icounts,roi_limits,dtfctrs)]
-        detraw = np.einsum('kij->ijk', detraw)
-        detcor = np.einsum('kij->ijk', detcor)
+    def get_xrfroi_sums(self, det, roi_lo, roi_hi, nworkers=None):
+        '''return sums of raw counts over channel ranges for all pixels
+        of an XRF detector
 
-        sumraw = detraw.sum(axis=2)
-        sumcor = detcor.sum(axis=2)
+        Parameters
+        ---------
+        det :        str     name of detector group
+        roi_lo :     list of first channel for each ROI
+        roi_hi :     list of last channel + 1 for each ROI
+        nworkers :   optional, None or int  number of threads for reading counts
 
-        for i,det in enumerate(det_list):
-            self.save_roi(roiname,det,detraw[:,:,i],detcor[:,:,i],Erange,'energy',unit)
-        if sumdet is not None:
-            self.save_roi(roiname,sumdet,sumraw,sumcor,Erange,'energy',unit)
+        Returns
+        -------
+        array of sums (nroi, nrow, npts)
+
+        Notes
+        -----
+        If the detector has an up-to-date 'cumcounts' dataset from
+        build_cumulative_counts(), each sum is the difference of two
+        channels of that.  Otherwise the counts are read one HDF5 chunk
+        at a time, skipping chunks outside all ROIs, and summed for all
+        ROIs in one pass.
+        '''
+        dgrp = self.xrmmap[det]
+        counts = dgrp['counts']
+        nrow, npts, nchan = counts.shape
+        roi_lo = np.clip(np.asarray(roi_lo, dtype=int), 0, nchan)
+        roi_hi = np.clip(np.maximum(roi_lo, np.asarray(roi_hi, dtype=int)), 0, nchan)
+
+        if 'cumcounts' in dgrp:
+            cum = dgrp['cumcounts']
+            if (cum.shape == counts.shape and
+                cum.attrs.get('last_row', -2) == self.last_row):
+                out = np.zeros((len(roi_lo), nrow, npts), dtype=cum.dtype)
+                for iroi, (lo, hi) in enumerate(zip(roi_lo, roi_hi)):
+                    if hi > lo:
+                        out[iroi] = cum[:, :, hi-1]
+                        if lo > 0:
+                            out[iroi] -= cum[:, :, lo-1]
+                return out
+
+        def in_rois(sel):
+            c0, c1 = sel[2].start, sel[2].stop
+            return ((roi_lo < c1) & (roi_hi > c0) & (roi_hi > roi_lo)).any()
+
+        sum_dtype = np.add.reduce(np.zeros(1, dtype=counts.dtype)).dtype
+        out = np.zeros((len(roi_lo), nrow, npts), dtype=sum_dtype)
+        store = self.get_counts_store(mapdat=dgrp)
+        chunks = iter_chunks(store, select=in_rois)
+        func = partial(_chunk_roi_sums, store, roi_lo, roi_hi)
+        if nworkers is None:
+            nworkers = NWORKERS
+        if nworkers < 2:
+            for sel, sums in six.moves.map(func, chunks):
+                out[:, sel[0], sel[1]] += sums
+        else:
+            pool = ThreadPool(nworkers)
+            try:
+                for sel, sums in pool.imap_unordered(func, chunks):
+                    out[:, sel[0], sel[1]] += sums
+            finally:
+                pool.terminate()
+                pool.join()
+        return out
+
+    def build_cumulative_counts(self, det=None):
+        '''build 'cumcounts' datasets of counts summed over channels for
+        XRF detectors, so that the sum over any channel range for each
+        pixel can be read from two channels
+
+        Parameters
+        ---------
+        det :        optional, None or str  name of detector group [all XRF detectors]
+
+        Notes
+        -----
+        The dataset is chunked with NCHAN_CUMCOUNTS channels per chunk,
+        and is not used by get_xrfroi_sums() once more rows are added.
+        '''
+        if not self.check_hostid():
+            raise GSEXRM_Exception(NOT_OWNER % self.filename)
+
+        if det is None:
+            dets = [dname for dname, grp in self.xrmmap.items()
+                    if grp.attrs.get('type', '').startswith('mca det')]
+        else:
+            dets = [det]
+
+        for dname in dets:
+            dgrp = self.xrmmap[dname]
+            counts = self.get_counts_store(mapdat=dgrp)
+            nrow, npts, nchan = counts.shape
+            dtype = np.float64
+            if counts.dtype.kind in 'iu':
+                dtype = np.int64
+                if nchan*np.iinfo(counts.dtype).max < np.iinfo(np.int32).max:
+                    dtype = np.int32
+            chunks = counts.chunks
+            if chunks is None:
+                chunks = (1, npts, nchan)
+            if 'cumcounts' in dgrp:
+                del dgrp['cumcounts']
+            cum = dgrp.create_dataset('cumcounts', (nrow, npts, nchan), dtype,
+                                      chunks=(chunks[0], chunks[1],
+                                              min(nchan, NCHAN_CUMCOUNTS)),
+                                      **self.compress_args)
+            for r0 in range(0, nrow, chunks[0]):
+                for p0 in range(0, npts, chunks[1]):
+                    sel = (slice(r0, r0+chunks[0]), slice(p0, p0+chunks[1]))
+                    cum[sel] = np.cumsum(counts[sel], axis=2, dtype=dtype)
+            cum.attrs['last_row'] = self.last_row
+        self.h5root.flush()
 
     def check_roi(self, roiname, det=None):
 
@@ -3222,9 +3967,11 @@ def read_fake2(filename, root=None):
 
 read_xrmmap = read_xrfmap
 
-def process_mapfolder(path, take_ownership=False, **kws):
+def process_mapfolder(path, take_ownership=False, nprocs=None, **kws):
     """process a single map folder
     with optional keywords passed to GSEXRM_MapFile
+
+    with nprocs > 1, the map is processed with nprocs processes
     """
     if os.path.isdir(path) and isGSEXRM_MapFolder(path):
         print( '\n build map for: %s' % path)
@@ -3238,7 +3985,10 @@ def process_mapfolder(path, take_ownership=False, **kws):
             if take_ownership:
                 g.take_ownership()
             if g.check_ownership():
-                g.process()
+                if nprocs is not None and nprocs > 1:
+                    g.process_parallel(nprocs=nprocs)
+                else:
+                    g.process()
             else:
                 print( 'Skipping file %s: not owner' % path)
         except KeyboardInterrupt:
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+""" Larch Tests: q-index searches of the cif database """
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import larch
+from larch_plugins.cifdb import cifDB
+from larch_plugins.cifdb import cifdb
+from larch_plugins.cifdb.cifdb import CifQIndex
+
+AMCSD_DB = os.path.join(os.path.dirname(cifdb.__file__), 'amcsd_cif.db')
+
+PEAKS = [1.23, 2.05, 2.51, 2.52, 3.04, 3.71, 5.55, 8.9]
+
+def dense_search(db, peaks, qmin=0.2, qmax=10.0, qstep=0.01, list=None,
+                 qtol=None):
+    '''scores of amcsd_by_q() from the full (entries, q) array of peaks'''
+    imin, imax = 0, len(db.axis)
+    if qmax < np.max(db.axis): imax = abs(db.axis-qmax).argmin()
+    if qmin > np.min(db.axis): imin = abs(db.axis-qmin).argmin()
+    qaxis = db.axis[imin:imax]
+    stepq = (qaxis[1]-qaxis[0])
+
+    amcsd, q_amcsd = db.return_q_matches(list=list, qmin=qmin, qmax=qmax)
+    q_amcsd = np.array(q_amcsd)
+    if qstep > stepq:
+        new_qaxis = np.arange(np.min(qaxis), np.max(qaxis)+stepq, qstep)
+        new_q_amcsd = np.zeros((len(q_amcsd), len(new_qaxis)))
+        for n, q in enumerate(qaxis):
+            k = np.abs(new_qaxis-q).argmin()
+            new_q_amcsd[:, k] = np.maximum(new_q_amcsd[:, k], q_amcsd[:, n])
+        qaxis, q_amcsd = new_qaxis, new_q_amcsd
+
+    total_peaks = q_amcsd.sum(axis=1)
+    if qtol is None:
+        peaks_true = np.zeros(len(qaxis))
+        for p in peaks:
+            peaks_true[np.abs(qaxis-p).argmin()] = 1
+        match_peaks = (peaks_true*q_amcsd).sum(axis=1)
+    else:
+        match_peaks = np.zeros(len(q_amcsd))
+        for p in peaks:
+            weight = np.maximum(1 - np.abs(qaxis-p)/qtol, 0)
+            match_peaks += (weight*q_amcsd).max(axis=1)
+    miss_peaks = np.maximum(total_peaks - match_peaks, 0)
+    scores = match_peaks - miss_peaks
+    return sorted(zip(scores, amcsd, total_peaks, match_peaks, miss_peaks),
+                  reverse=True)
+
+class TestCifQIndex(unittest.TestCase):
+    '''q-index searches of the cif database'''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='larch_cifdb_')
+        dbname = os.path.join(self.tmpdir, 'amcsd_test.db')
+        shutil.copy(AMCSD_DB, dbname)
+        self.db = cifDB(dbname=dbname)
+        self.qindex = self.db.get_qindex(save=False)
+        self.amcsd = [row[0] for row in self.db.query(self.db.ciftbl.c.amcsd_id).all()]
+
+    def tearDown(self):
+        self.db.close_database()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def compare(self, result, expected, places=10):
+        self.assertEqual(len(result), len(expected))
+        for res, exp in zip(result, expected):
+            self.assertEqual(res[1], exp[1])
+            for r, e in zip(res[:1]+res[2:], exp[:1]+exp[2:]):
+                self.assertAlmostEqual(float(r), float(e), places=places)
+
+    def test_index(self):
+        "index has the peaks of every entry"
+        self.assertEqual(sorted(self.qindex.amcsd.tolist()), sorted(self.amcsd))
+        amcsd, q_amcsd = self.db.return_q_matches()
+        for i, row in zip(amcsd, q_amcsd):
+            j = self.qindex.amcsd.tolist().index(i)
+            bins = self.qindex.entry_bins[self.qindex.entry_ptr[j]:self.qindex.entry_ptr[j+1]]
+            self.assertEqual(sorted(bins.tolist()), np.flatnonzero(row).tolist())
+
+    def test_search(self):
+        "amcsd_by_q() gives the same scores as the full peak array"
+        for kws in (dict(), dict(qstep=0.05), dict(qmin=1.0, qmax=6.0),
+                    dict(qmin=1.5, qmax=7.5, qstep=0.03),
+                    dict(list=self.amcsd[::3]),
+                    dict(list=self.amcsd[5:40], qstep=0.1, qmin=2.0)):
+            self.compare(self.db.amcsd_by_q(PEAKS, **kws),
+                         dense_search(self.db, PEAKS, **kws))
+
+    def test_search_qtol(self):
+        "with qtol, peaks match nearby bins weighted by distance"
+        for kws in (dict(qtol=0.02), dict(qtol=0.05, qstep=0.02),
+                    dict(qtol=0.1, qmin=1.0, qmax=6.0, list=self.amcsd[::2])):
+            self.compare(self.db.amcsd_by_q(PEAKS, **kws),
+                         dense_search(self.db, PEAKS, **kws))
+
+        # weights fall off linearly with distance from a peak of an entry
+        # with no other peaks nearby
+        q = self.db.axis
+        qindex = self.qindex
+        for j, entry in enumerate(qindex.amcsd):
+            bins = qindex.entry_bins[qindex.entry_ptr[j]:qindex.entry_ptr[j+1]]
+            near = [i for i in bins if 10 < i < len(q)-10 and
+                    sum(abs(bins-i) <= 10) == 1]
+            if len(near) > 0:
+                entry, i = int(entry), near[0]
+                break
+        for dq, weight in ((0, 1.0), (0.5*0.04, 0.5), (0.75*0.04, 0.25), (0.05, 0.0)):
+            res = dict((r[1], r[3]) for r in
+                       self.db.amcsd_by_q([q[i]+dq], qtol=0.04, list=[entry]))
+            self.assertAlmostEqual(res[entry], weight, places=6)
+
+    def test_save_load(self):
+        "index files are read only with a matching tag"
+        fname = os.path.join(self.tmpdir, 'qindex.npz')
+        self.qindex.save(fname)
+        qindex = CifQIndex.load(fname, tag=self.qindex.tag)
+        self.assertTrue(qindex is not None)
+        for attr in ('axis', 'amcsd', 'entry_ptr', 'entry_bins', 'bin_entries'):
+            self.assertTrue(np.all(getattr(qindex, attr) == getattr(self.qindex, attr)))
+        self.assertTrue(CifQIndex.load(fname, tag='other') is None)
+        self.assertTrue(self.db.qindex_file().startswith(larch.site_config.usr_larchdir))
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestCifQIndex,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=13).run(suite)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+""" Larch Tests: analytic Jacobian for feffit """
+import unittest
+import os
+import numpy as np
+
+from utils import TestCase
+from larch.fitting import group2params, params2group
+from larch_plugins.xafs.feffdat import PATH_PARS
+from larch_plugins.xafs.feffit import _pathparam_derivs
+
+FEFFIT_SETUP = """
+cu = read_ascii('../xafsdata/cu.chi', labels='k chi')
+pars = group(amp    = param(0.9, vary=True),
+             del_e0 = param(2.0, vary=True),
+             sig2   = param(0.006, vary=True),
+             c3     = param(0.0001, vary=True),
+             del_r  = param(0.01, vary=True),
+             alpha  = param(0.002, vary=True))
+
+path1 = feffpath('feff0001.dat', s02='amp', e0='del_e0', sigma2='sig2',
+                 deltar='del_r', third='c3')
+path2 = feffpath('feff0002.dat', s02='amp', e0='del_e0',
+                 sigma2='sig2*1.5', deltar='alpha*reff')
+path3 = feffpath('feff0003.dat', s02='amp', e0='del_e0',
+                 sigma2='sig2*2', deltar='alpha*reff', ei='0.5',
+                 fourth='1.e-5')
+trans = feffit_transform(kmin=3, kmax=15, kw=2, dk=3, window='hanning',
+                         rmin=1.4, rmax=4.0)
+dset = feffit_dataset(data=cu, pathlist=[path1, path2, path3], transform=trans)
+"""
+
+VARIABLES = ('amp', 'del_e0', 'sig2', 'c3', 'del_r', 'alpha')
+
+class TestFeffitJacobian(TestCase):
+    '''analytic Jacobian for feffit'''
+    def setUp(self):
+        TestCase.setUp(self)
+        self.setup_fit()
+        self.dset.prepare_fit()
+
+    def setup_fit(self):
+        "define parameters and dataset, reading files from examples/feffit"
+        origdir = os.getcwd()
+        os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'examples', 'feffit'))
+        try:
+            self.session.run(FEFFIT_SETUP)
+        finally:
+            os.chdir(origdir)
+        self.assertTrue(len(self.session.get_errors()) == 0)
+        self.pars = self.getSym('pars')
+        self.dset = self.getSym('dset')
+
+    def test_chi_deriv(self):
+        "derivatives of chi(k) for each path parameter"
+        stack = self.dset._pathstack
+        k = self.dset.model.k
+        pathpars = self.dset._pathparams(self.pars)
+        cchi, dchi = stack.calc_chi_deriv(k, pathpars)
+        self.assertEqual(dchi.shape, (3, len(PATH_PARS), len(k)))
+        self.assertTrue(np.allclose(cchi, stack.calc_chi(k, pathpars)[0]))
+
+        for ipar, name in enumerate(PATH_PARS):
+            step = 1.e-6*max(abs(pathpars[:, ipar]).max(), 1.e-2)
+            up, down = pathpars.copy(), pathpars.copy()
+            up[:, ipar] += step
+            down[:, ipar] -= step
+            numer = (stack.calc_chi(k, up)[0] - stack.calc_chi(k, down)[0])/(2*step)
+            scale = max(abs(numer).max(), 1.e-12)
+            self.assertTrue(abs(dchi[:, ipar] - numer).max() < 1.e-5*scale, name)
+
+    def test_dataset_jacobian(self):
+        "Jacobian of the dataset residual for the fit variables"
+        dset = self.dset
+        params = group2params(self.pars, _larch=self.session._larch)
+        var_names = [name for name, par in params.items()
+                     if par.vary and par.expr is None]
+        params2group(params, self.pars)
+        pathpars = dset._pathparams(self.pars)
+        dpathpars = _pathparam_derivs(params, self.pars, [dset], var_names)[0]
+        jac = dset._jacobian(pathpars, dpathpars)
+        self.assertEqual(jac.shape[1], len(var_names))
+
+        for ivar, name in enumerate(var_names):
+            par = params[name]
+            val0 = par.value
+            step = 1.e-6*max(abs(val0), 1.e-2)
+            resid = []
+            for val in (val0 + step, val0 - step):
+                par.value = val
+                params.update_constraints()
+                params2group(params, self.pars)
+                resid.append(dset._residual(self.pars))
+            par.value = val0
+            numer = (resid[0] - resid[1])/(2*step)
+            err = abs(jac[:, ivar] - numer).max()/abs(numer).max()
+            self.assertTrue(err < 1.e-5, '%s: relative error %g' % (name, err))
+        params.update_constraints()
+        params2group(params, self.pars)
+
+    def test_feffit_analytic_jacobian(self):
+        "fits with the analytic Jacobian match fits with finite differences"
+        results = {}
+        for analytic in (False, True):
+            self.setup_fit()
+            self.session.run("out = feffit(pars, dset, analytic_jacobian=%s)" % analytic)
+            self.assertTrue(len(self.session.get_errors()) == 0)
+            results[analytic] = [getattr(self.pars, name).value for name in VARIABLES]
+        for name, val, ref in zip(VARIABLES, results[True], results[False]):
+            self.assertAlmostEqual(val, ref, places=4, msg=name)
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestFeffitJacobian,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=13).run(suite)
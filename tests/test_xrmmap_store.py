@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+""" Larch Tests: storage backends for XRM map spectra """
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import h5py
+
+import larch
+from larch_plugins.xrmmap import (H5Store, MemmapStore,
+                                  GSEXRM_MapFile, iter_chunks,
+                                  create_store, open_store)
+from larch_plugins.xrmmap.mapstore import _normalize_sel
+
+SHAPE = (5, 7, 16)
+CHUNKS = (2, 3, 16)
+
+class TestMapStore(unittest.TestCase):
+    '''storage backends for spectra of XRM maps'''
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='larch_mapstore_')
+        rng = np.random.RandomState(3)
+        self.data = rng.randint(0, 1000, size=SHAPE).astype(np.uint32)
+        self.h5file = h5py.File(os.path.join(self.tmpdir, 'map.h5'), 'w')
+        self.dset = self.h5file.create_dataset('counts', data=self.data,
+                                               chunks=CHUNKS, maxshape=(None,)+SHAPE[1:],
+                                               compression='gzip')
+
+    def tearDown(self):
+        self.h5file.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_stores(self):
+        stores = [H5Store(self.dset)]
+        for backend in ('memmap', 'chunkdir'):
+            path = os.path.join(self.tmpdir, 'map.%s' % backend)
+            store = create_store(backend, path, SHAPE, self.data.dtype,
+                                 chunks=CHUNKS)
+            store[:] = self.data
+            store.close()
+            stores.append(open_store(backend, path, mode='r+'))
+        return stores
+
+    def test_roundtrip(self):
+        "data written to each store reads back the same"
+        for store in self.make_stores():
+            self.assertEqual(tuple(store.shape), SHAPE)
+            self.assertEqual(store.dtype, self.data.dtype)
+            self.assertTrue(np.all(store[:] == self.data), store.backend)
+
+    def test_partial_write(self):
+        "writing parts of chunks does not change the rest of the chunks"
+        for store in self.make_stores():
+            expected = self.data.copy()
+            store[1:4, 2:5, 3:9] = 7
+            expected[1:4, 2:5, 3:9] = 7
+            store[2, 6] = np.arange(16)
+            expected[2, 6] = np.arange(16)
+            self.assertTrue(np.all(store[:] == expected), store.backend)
+
+    def test_indexing(self):
+        "ints, slices, and ellipsis give the same results as numpy"
+        sels = [(2,), (-1,), (1, 3), (1, 3, 5), (slice(1, 4), 2),
+                (Ellipsis, 4), (2, Ellipsis), (1, Ellipsis, slice(2, 9)),
+                (slice(None), slice(2, 6), slice(0, 16)),
+                (slice(3, 1),), (slice(-3, None), -2)]
+        for store in self.make_stores():
+            for sel in sels:
+                out = store[sel]
+                self.assertEqual(out.shape, self.data[sel].shape,
+                                 '%s %s' % (store.backend, sel))
+                self.assertTrue(np.all(out == self.data[sel]),
+                                '%s %s' % (store.backend, sel))
+
+    def test_normalize_sel(self):
+        "selections are converted to slices and dropped axes"
+        sel, drop = _normalize_sel((1, Ellipsis, -1), SHAPE)
+        self.assertEqual(sel, (slice(1, 2), slice(0, 7), slice(15, 16)))
+        self.assertEqual(drop, (0, 2))
+        sel, drop = _normalize_sel(slice(None), SHAPE)
+        self.assertEqual(sel, (slice(0, 5), slice(0, 7), slice(0, 16)))
+        self.assertEqual(drop, ())
+        self.assertRaises(IndexError, _normalize_sel, (5,), SHAPE)
+        self.assertRaises(IndexError, _normalize_sel, (slice(0, 4, 2),), SHAPE)
+
+    def test_read_chunk(self):
+        "read_chunk() for each chunk gives the same as dset[sel]"
+        for store in self.make_stores():
+            sels = list(iter_chunks(store))
+            self.assertTrue(len(sels) > 1)
+            for sel in sels:
+                self.assertTrue(np.all(store.read_chunk(sel) == self.dset[sel]),
+                                '%s %s' % (store.backend, sel))
+
+    def test_chunkdir_layout(self):
+        "chunkdir stores one .npy file per written chunk"
+        path = os.path.join(self.tmpdir, 'layout.chunks')
+        store = create_store('chunkdir', path, SHAPE, self.data.dtype,
+                             chunks=CHUNKS)
+        store[0:2, 0:3] = 1
+        store[4, 6] = 2
+        self.assertEqual(sorted(os.listdir(path)),
+                         ['0.0.0.npy', '2.2.0.npy', 'store.json'])
+        chunk = np.load(os.path.join(path, '2.2.0.npy'))
+        self.assertEqual(chunk.shape, CHUNKS)
+        self.assertTrue(np.all(store[0:2, 3:] == 0))
+
+        # creating the store again removes the old chunks
+        store = create_store('chunkdir', path, SHAPE, self.data.dtype,
+                             chunks=CHUNKS)
+        self.assertEqual(os.listdir(path), ['store.json'])
+        self.assertTrue(np.all(store[:] == 0))
+
+    def test_resize(self):
+        "stores can grow by rows, keeping the existing data"
+        nrow = SHAPE[0] + 3
+        for store in self.make_stores():
+            store.resize(nrow)
+            self.assertEqual(tuple(store.shape), (nrow,) + SHAPE[1:])
+            self.assertTrue(np.all(store[:SHAPE[0]] == self.data), store.backend)
+            store[nrow-1] = 9
+            self.assertTrue(np.all(store[nrow-1] == 9), store.backend)
+            if store.backend != 'hdf5':
+                store.close()
+                reopened = open_store(store.backend, store.path)
+                self.assertEqual(tuple(reopened.shape), (nrow,) + SHAPE[1:])
+                self.assertTrue(np.all(reopened[:SHAPE[0]] == self.data))
+
+    def test_counts_store_fallback(self):
+        "get_counts_store() uses the HDF5 data once more rows are added"
+        path = 'map_det1.counts'
+        store = create_store('memmap', os.path.join(self.tmpdir, path),
+                             SHAPE, self.data.dtype)
+        store[:] = self.data
+        store.close()
+        grp = self.h5file.require_group('det1')
+        grp['counts'] = self.h5file['counts']
+        grp.attrs['counts_store'] = 'memmap'
+        grp.attrs['counts_path'] = path
+        grp.attrs['counts_store_last_row'] = 4
+
+        mapfile = larch.Group(filename=self.h5file.filename, last_row=4,
+                              _counts_stores={})
+        get_counts_store = GSEXRM_MapFile.get_counts_store
+
+        store = get_counts_store(mapfile, mapdat=grp)
+        self.assertTrue(isinstance(store, MemmapStore))
+        self.assertTrue(np.all(store[:] == self.data))
+
+        mapfile.last_row = 5
+        store = get_counts_store(mapfile, mapdat=grp)
+        self.assertTrue(isinstance(store, H5Store))
+
+        # a store with the wrong shape is not used either
+        mapfile.last_row = 4
+        self.dset.resize((SHAPE[0]+1,) + SHAPE[1:])
+        store = get_counts_store(mapfile, mapdat=grp)
+        self.assertTrue(isinstance(store, H5Store))
+
+if __name__ == '__main__':  # pragma: no cover
+    for suite in (TestMapStore,):
+        suite = unittest.TestLoader().loadTestsFromTestCase(suite)
+        unittest.TextTestRunner(verbosity=13).run(suite)